@@ -37,6 +37,7 @@ setup(
                       "John Ford"]),
     author_email=", ".join(["stevensheffey4@gmail.com"]),
     packages=["timechange",],
+    scripts=["bin/timechange"],
     license="MIT",
     long_description=open("README.rst","r").read(),
 )
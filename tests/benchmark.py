@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+"""Benchmarks for the transforms, csv conversion and the training input pipeline
+Writes the results to a JSON file, which can be compared with the results of an earlier run:
+    python3 benchmark.py --output results.json
+    python3 benchmark.py --output new.json --compare results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+#Add one level up to timechange
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import timechange
+from timechange import transform, worker, dataset, metrics, synth
+
+"""Benchmark parameters
+"""
+#Series lengths and channel counts to time the transforms on
+TRANSFORM_LENGTHS = [1000, 10000, 100000]
+TRANSFORM_CHANNELS = [1, 3]
+#Number of files per wave type, and rows and columns per file, for the conversion benchmarks
+CONVERT_FILES = 200
+CONVERT_ROWS = 5000
+CONVERT_COLUMNS = 3
+#Batch size and number of batches for the training input benchmarks
+TRAIN_BATCH_SIZE = 64
+TRAIN_BATCHES = 200
+#Number of times to repeat each timing. The fastest run is reported
+REPEATS = 5
+#Ratio of new to old time above which --compare reports a regression
+REGRESSION_THRESHOLD = 1.2
+
+def time_call(function, repeats):
+    """Times a function
+    Keyword arguments:
+    function -- function to call without arguments
+    repeats -- number of times to call it
+    Returns a tuple of (fastest time, mean time) in seconds"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times)
+
+def result(name, parameters, seconds, mean_seconds, amount, unit, **extra):
+    """Builds a result entry
+    Keyword arguments:
+    name -- name of the benchmark
+    parameters -- dict of the parameters the benchmark ran with
+    seconds -- fastest time of a run
+    mean_seconds -- mean time of a run
+    amount -- amount of work done in a run, used for the throughput
+    unit -- what amount counts, such as rows
+    extra -- other values to store
+    """
+    entry = {"name": name, "parameters": parameters, "seconds": seconds, "mean_seconds": mean_seconds,
+             "throughput": amount / seconds if seconds > 0 else None, "unit": "{}/s".format(unit)}
+    entry.update(extra)
+    print("{} {}: {:.6f}s, {:.1f} {}/s".format(name, json.dumps(parameters, sort_keys=True), seconds,
+                                              entry["throughput"] or 0.0, unit))
+    return entry
+
+def benchmark_transforms(lengths, channel_counts, repeats, random_state=None):
+    """Times each transform on a single series
+    Keyword arguments:
+    lengths -- series lengths to try
+    channel_counts -- channel counts to try
+    repeats -- number of times to repeat each timing
+    random_state -- numpy RandomState to generate the series with
+    Returns a list of result entries"""
+    results = []
+    for length in lengths:
+        for channels in channel_counts:
+            time_series = synth.generate("sine", [length], channels, random_state)[0]
+            for name, function in (("simple_fourier", transform.simple_fourier),
+                                   ("nothing", transform.nothing),
+                                   ("stft", transform.stft),
+                                   ("gasf", transform.gramian_field),
+                                   ("recurrence", transform.recurrence_plot),
+                                   ("spectrogram", transform.spectrogram)):
+                seconds, mean_seconds = time_call(lambda: function(time_series), repeats)
+                results.append(result("transform." + name, {"length": length, "channels": channels},
+                                      seconds, mean_seconds, length * channels, "rows"))
+    return results
+
+def make_project(parent_folder, num_files, num_rows, num_columns, seed=None):
+    """Creates a project of random waves, one label per wave type
+    Keyword arguments:
+    parent_folder -- folder to create the project and its source files in
+    num_files -- number of files per wave type
+    num_rows -- rows per file
+    num_columns -- columns per file
+    seed -- seed for the random waves
+    Returns the TimeChange object"""
+    source_folder = os.path.join(parent_folder, "source")
+    synth.write_files(source_folder, num_files, min_rows=num_rows, max_rows=num_rows, channels=num_columns, seed=seed)
+    time_change = timechange.TimeChange("BENCHMARK_PROJECT", parent_folder)
+    time_change.add_training_files(source_folder)
+    return time_change
+
+def check_conversion(failures, progress, expected_files):
+    """Raises an exception if a convert_all_csv run failed or didn't convert the expected number of files
+    Keyword arguments:
+    failures -- failures returned by convert_all_csv
+    progress -- metrics.Metrics the run counted with
+    expected_files -- number of files the run should have converted"""
+    if failures:
+        raise Exception("{} file(s) failed to convert, first failure: {}".format(len(failures), sorted(failures.items())[0]))
+    converted = progress.counters.get("files", 0)
+    if converted != expected_files:
+        raise Exception("Expected {} converted file(s), but {} were converted".format(expected_files, converted))
+
+def benchmark_conversion(project_path, outputs, job_counts, repeats):
+    """Times complete convert_all_csv runs
+    Keyword arguments:
+    project_path -- path to a timechange project
+    outputs -- output settings to try, such as png
+    job_counts -- numbers of processes to try
+    repeats -- number of times to repeat each timing
+    Returns a list of result entries"""
+    results = []
+    num_files = sum(len(os.listdir(label.path)) for label in os.scandir(os.path.join(project_path, "csv")))
+    num_bytes = sum(csv_file.stat().st_size for label in os.scandir(os.path.join(project_path, "csv"))
+                    for csv_file in os.scandir(label.path))
+    for output in outputs:
+        for jobs in job_counts:
+            with open(os.path.join(project_path, "transform.conf"), "w") as config_file:
+                config_file.write(timechange.default_transform_config.replace("output=png", "output=" + output))
+            progress = None
+            def convert():
+                nonlocal progress
+                #Without a manifest every file is converted again
+                try:
+                    os.remove(os.path.join(project_path, worker.index.MANIFEST_FILE_NAME))
+                except FileNotFoundError:
+                    pass
+                progress = metrics.Metrics("transform")
+                check_conversion(worker.convert_all_csv(project_path, jobs, progress=progress), progress, num_files)
+            seconds, mean_seconds = time_call(convert, repeats)
+            #Stage times of the last run
+            stages = progress.snapshot()["stages"]
+            results.append(result("convert_all_csv", {"output": output, "jobs": jobs, "files": num_files},
+                                  seconds, mean_seconds, num_files, "files",
+                                  bytes_per_second=num_bytes / seconds, stages=stages))
+            #An incremental run with nothing to do
+            def convert_unchanged():
+                progress = metrics.Metrics("transform")
+                check_conversion(worker.convert_all_csv(project_path, jobs, progress=progress), progress, 0)
+            seconds, mean_seconds = time_call(convert_unchanged, repeats)
+            results.append(result("convert_all_csv.unchanged", {"output": output, "jobs": jobs, "files": num_files},
+                                  seconds, mean_seconds, num_files, "files"))
+    return results
+
+def benchmark_batches(project_path, batch_size, num_batches, repeats):
+    """Times how fast training batches are delivered from the transformed data
+    Batches are timed both as they're made and made ahead of time by dataset.prefetch
+    Keyword arguments:
+    project_path -- path to a timechange project
+    batch_size -- samples per batch
+    num_batches -- number of batches to draw per run
+    repeats -- number of times to repeat each timing
+    Returns a list of result entries"""
+    source = "npy" if worker.index.load_manifest(project_path).get("tensors") else "png"
+    results = []
+    for queue_size in (0, 4):
+        batches, _ = worker._training_batches(project_path, batch_size)
+        if queue_size > 0:
+            batches = dataset.prefetch(batches, queue_size)
+        def draw():
+            for _ in range(num_batches):
+                next(batches)
+        seconds, mean_seconds = time_call(draw, repeats)
+        results.append(result("training_batches", {"source": source, "batch_size": batch_size, "batches": num_batches,
+                                                    "prefetch": queue_size},
+                              seconds, mean_seconds, num_batches, "batches",
+                              samples_per_second=num_batches * batch_size / seconds))
+    return results
+
+def compare(results, old_results, threshold):
+    """Prints how each benchmark changed since an earlier run
+    Keyword arguments:
+    results -- result entries of this run
+    old_results -- result entries of the earlier run
+    threshold -- ratio of new to old time above which a benchmark counts as a regression
+    Returns the number of regressions"""
+    old_times = {(entry["name"], json.dumps(entry["parameters"], sort_keys=True)): entry["seconds"] for entry in old_results}
+    regressions = 0
+    for entry in results:
+        key = (entry["name"], json.dumps(entry["parameters"], sort_keys=True))
+        if key not in old_times:
+            continue
+        ratio = entry["seconds"] / old_times[key]
+        if ratio > threshold:
+            regressions += 1
+        print("{} {} {}: {:.2f}x the old time".format("REGRESSION" if ratio > threshold else "ok", key[0], key[1], ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks timechange")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to write the results to")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="ratio of new to old time above which a benchmark counts as a regression")
+    parser.add_argument("--repeats", type=int, default=REPEATS, help="number of times to repeat each timing")
+    parser.add_argument("--quick", action="store_true", help="use small data sets, for checking the benchmarks run")
+    parser.add_argument("--seed", type=int, default=413, help="seed for the random waves")
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    lengths, num_files, num_rows, num_batches = TRANSFORM_LENGTHS, CONVERT_FILES, CONVERT_ROWS, TRAIN_BATCHES
+    if args.quick:
+        lengths, num_files, num_rows, num_batches = lengths[:2], 10, 1000, 20
+    results = benchmark_transforms(lengths, TRANSFORM_CHANNELS, args.repeats, np.random.RandomState(args.seed))
+    parent_folder = tempfile.mkdtemp(prefix="timechange-benchmark-")
+    try:
+        time_change = make_project(parent_folder, num_files, num_rows, CONVERT_COLUMNS, args.seed)
+        results += benchmark_conversion(time_change.project_path, ["png", "npy"], sorted({1, os.cpu_count() or 1}), args.repeats)
+        #The last conversion wrote npy shards
+        results += benchmark_batches(time_change.project_path, TRAIN_BATCH_SIZE, num_batches, args.repeats)
+        #Convert again to read the pngs
+        with open(os.path.join(time_change.project_path, "transform.conf"), "w") as config_file:
+            config_file.write(timechange.default_transform_config)
+        worker.convert_all_csv(time_change.project_path)
+        results += benchmark_batches(time_change.project_path, TRAIN_BATCH_SIZE, num_batches, args.repeats)
+        time_change.worker_queue.put({"command":"shutdown"})
+    finally:
+        shutil.rmtree(parent_folder)
+    report = {"timechange": {"numpy": np.__version__, "python": platform.python_version(),
+                             "platform": platform.platform(), "cpus": os.cpu_count()},
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "seed": args.seed,
+              "quick": args.quick,
+              "results": results}
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print("Results written to {}".format(args.output))
+    if args.compare:
+        with open(args.compare) as old_file:
+            regressions = compare(results, json.load(old_file)["results"], args.threshold)
+        if regressions:
+            print("{} benchmark(s) regressed".format(regressions))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -34,13 +34,13 @@ import os
 import shutil
 import json
 import numpy as np
-from scipy import signal
 #Set up the keras image backend
 from keras.backend import common as K
 K.set_image_dim_ordering('th')
 #Add one level up to timechange
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import timechange
+from timechange import synth
 
 """DEBUG
 """
@@ -64,19 +64,8 @@ MIN_ROWS = 100
 MAX_ROWS = 1000
 #Number of columns per training sample
 NUM_COLUMNS = 3
-#Bounds and parameters for sample waves
-SAMPLE_LEFT_BOUND = 0.0
-SAMPLE_RIGHT_BOUND = 100.0
-SAMPLE_AMPLITUDE_MIN = -5.0
-SAMPLE_AMPLITUDE_MAX = 5.0
-SAMPLE_FREQUENCY_MIN = -100.0
-SAMPLE_FREQUENCY_MAX = 100.0
-SAMPLE_SHIFT_MIN = -10.0
-SAMPLE_SHIFT_MAX = 10.0
 #Number of samples to validate per category
 NUM_VALIDATION_SAMPLES = 1000
-#Types of waves to generate
-WAVE_TYPES = ["sine", "square", "sawtooth"]
 #Parameters for data conversion
 CONVERT_CHUNK_SIZE=64
 #Metaparameters for training
@@ -102,25 +91,6 @@ time_change = timechange.TimeChange(PROJECT_NAME, PROJECT_PARENT)
 Sample data generation
 =======================================
 """
-#Generate random data for a specific wave function
-def random_wave(wave_type, length):
-    #Generate random parameters
-    amplitude = np.random.uniform(SAMPLE_AMPLITUDE_MIN,SAMPLE_AMPLITUDE_MAX)
-    frequency = np.random.uniform(SAMPLE_FREQUENCY_MIN,SAMPLE_FREQUENCY_MAX)
-    shift = np.random.uniform(SAMPLE_SHIFT_MIN,SAMPLE_SHIFT_MAX)
-    #Generate the linear space
-    wave_space = np.linspace(SAMPLE_LEFT_BOUND, SAMPLE_RIGHT_BOUND, length, endpoint=True, dtype=np.float32)
-    #Apply the random changes to the wave
-    wave_space = frequency * (wave_space - shift)
-    #Generate the wave
-    if wave_type == 'sine':
-        return amplitude * np.sin(wave_space)
-    elif wave_type == 'square':
-        return amplitude * signal.square(wave_space)
-    elif wave_type == 'sawtooth':
-        return amplitude * signal.sawtooth(wave_space)
-    else:
-        raise Exception("Invalid wave type")
 #Set data folder and schema
 data_folder = SAMPLE_DATA_FOLDER
 #Same as the csv header
@@ -130,32 +100,9 @@ if os.path.isdir(SAMPLE_DATA_FOLDER):
     print("Sample data already exists, continuing to training")
 else:
     print("Generating sample training data")
-    for wave_type in ("sine","square","sawtooth"):
-        os.makedirs(os.path.join(SAMPLE_DATA_FOLDER, wave_type))
-    #Used to display progress
-    last_progress = 0
-    progress_step = NUM_TRAINING_SAMPLES // 10
-    #Generate the training data
-    for sample_num in range(NUM_TRAINING_SAMPLES):
-        #Generate a sample file name. Used for all waves because they"re sorted by folder
-        sample_file_name = "SAMPLE_{0:05d}.csv".format(sample_num)
-        #Generate a csv file for each wave type
-        for wave_type in WAVE_TYPES:
-            #Generate a bunch of wave rows
-            sample_length = np.random.randint(MIN_ROWS, MAX_ROWS)
-            wave_data = np.array([random_wave(wave_type,
-                                sample_length)
-                                for _ in range(NUM_COLUMNS)
-                               ])
-            np.savetxt(os.path.join(SAMPLE_DATA_FOLDER, wave_type, sample_file_name),
-                       wave_data.T,
-                       delimiter=",",
-                       header=",".join(column_names),
-                       comments="")
-        #For printing progress
-        if (sample_num - progress_step) >= last_progress:
-            print("Generating samples: {}% done".format((sample_num / NUM_TRAINING_SAMPLES) * 100))
-            last_progress = sample_num
+    #Generate the training data, one folder per wave type
+    synth.write_files(SAMPLE_DATA_FOLDER, NUM_TRAINING_SAMPLES,
+                      min_rows=MIN_ROWS, max_rows=MAX_ROWS - 1, channels=NUM_COLUMNS, seed=413)
     print("Finished generating training data")
 
 """
@@ -199,35 +146,20 @@ time_change.train(num_epochs=NUM_EPOCHS)
 time_change.save_model()
 
 #Generate a validation data set
-#TODO: modularize this so it's not so copy-paste
 print("Generating validation data")
-for wave_type in ("sine","square","sawtooth"):
-    try:
-        os.makedirs(os.path.join(VALIDATION_DATA_FOLDER, wave_type))
-    except FileExistsError:
-        pass #Files already created, no problem. They are overwritten anyway
+#Files already created are overwritten
+validation_files = synth.write_files(VALIDATION_DATA_FOLDER, NUM_VALIDATION_SAMPLES,
+                                     min_rows=MIN_ROWS, max_rows=MAX_ROWS - 1, channels=NUM_COLUMNS, seed=414)
 
 #Used to display progress
 last_progress = 0
 progress_step = NUM_VALIDATION_SAMPLES // 10
-#Generate the training data
+#Convert the validation data
 for sample_num in range(NUM_VALIDATION_SAMPLES):
-    #Generate a sample file name. Used for all waves because they"re sorted by folder
+    #Sample file name. Used for all waves because they're sorted by folder
     sample_file_name = "SAMPLE_{0:05d}.csv".format(sample_num)
-    #Generate a csv file for each wave type
-    for wave_type in WAVE_TYPES:
-        #Generate a bunch of wave rows
-        sample_length = np.random.randint(MIN_ROWS, MAX_ROWS)
-        wave_data = np.array([random_wave(wave_type,
-                            sample_length)
-                            for _ in range(NUM_COLUMNS)
-                           ])
-        #Generate a csv file for the data
-        np.savetxt(os.path.join(VALIDATION_DATA_FOLDER, wave_type, sample_file_name),
-                   wave_data.T,
-                   delimiter=",",
-                   header=",".join(column_names),
-                   comments="")
+    #Generate a training image for each wave type
+    for wave_type in validation_files:
         #Generate a training image manually
         time_change.convert_csv(
                 os.path.join(VALIDATION_DATA_FOLDER, wave_type, sample_file_name),
@@ -235,7 +167,7 @@ for sample_num in range(NUM_VALIDATION_SAMPLES):
                 output_file_path=os.path.join(VALIDATION_DATA_FOLDER, wave_type, "{}.png".format(sample_file_name))) 
     #For printing progress
     if (sample_num - progress_step) >= last_progress:
-        print("Generating samples: {}% done".format((sample_num / NUM_VALIDATION_SAMPLES) * 100))
+        print("Converting samples: {}% done".format((sample_num / NUM_VALIDATION_SAMPLES) * 100))
         last_progress = sample_num
 print("Finished generating validation data")
 
@@ -30,17 +30,20 @@ THE SOFTWARE.
 """
 
 from collections import defaultdict
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue
 from threading import Thread
+from itertools import count
 import sys
 import os
 from os import path
 import shutil
 from configparser import ConfigParser
-import numpy as np
-import pandas
-from PIL import Image
+#pandas, PIL, scipy and keras are loaded by the jobs that need them, so importing timechange stays fast
 from . import worker
+from . import index
+from . import predict
 
 #Keras includes
 
@@ -50,9 +53,22 @@ default_parameter_config = """[DEFAULT]
 #Settings for the chosen type will be stored under a
 #section of the same name
 model_type = convolutional_basic
+#File in the project folder to append job progress metrics to,
+#one JSON object per line. Leave empty to only send them to the result queue
+metrics_file =
+#Number of samples per training batch
+batch_size = 64
+#Number of passes over the training data
+num_epochs = 20
+#Seed for shuffling the training data every epoch. Leave empty for a random shuffle
+shuffle_seed =
+#Number of batches to prepare in the background while training. 0 prepares them as needed
+prefetch = 4
 
 [convolutional_basic]
 #The number of convolutional blocks to use for the model
+#Features have to be at least 3 * 2 ** (num_blocks - 1) pixels high and wide, 12 for 3 blocks
+#Transforms pad short files further when their features would be smaller
 num_blocks = 3
 #The number of filters for these blocks (comma-separated list)
 #If the size of this list is less than num_blocks, the last value
@@ -67,12 +83,62 @@ learning_rate = 1e-2
 default_transform_config = """[DEFAULT]
 #CSV columns to read
 columns=
-#Type of transform to run
+#Type of transform to run (fft, stft, spectrogram, gasf, gadf, recurrence or nothing)
+#gasf and gadf make Gramian angular summation and difference fields, recurrence makes recurrence plots
 method=fft
+#Modules to import that register more transform methods (comma-separated), see transform.register
+plugins=
 #Size of the chunks
 chunk_size=64
 #Size of the fft output
 fft_size=128
+#Samples between the starts of consecutive chunks, only used by the stft method
+#Empty uses half a chunk, a quarter of chunk_size overlaps chunks by 75%
+hop_size=
+#Window applied to each chunk or segment by the stft and spectrogram methods,
+#such as hann, hamming, blackman or boxcar for none
+window=hann
+#Spectrogram settings, only used by the spectrogram method
+#Samples per segment. Empty uses chunk_size
+nperseg=
+#Samples shared by consecutive segments. Empty uses half a segment
+noverlap=
+#Scale power in decibels instead of linearly
+log_scale=true
+#Decibels below each channel's peak that are shown as black when log_scale is set
+db_range=80
+#Width and height of each channel's image made by the gasf, gadf and recurrence methods
+#Series are shrunk to this many points by averaging. Empty uses 64
+image_size=
+#Fraction of each channel's value range within which two points count as recurring,
+#only used by the recurrence method. Empty draws distances instead of recurring points
+threshold=
+#Formats to write transformed data in (comma-separated)
+#png writes images, npy writes memory-mapped feature shards for training
+output=png
+#Float type to compute features in (float32 or float64)
+dtype=float32
+#Number of files to transform per vectorized call
+batch_size=32
+#Files are read in blocks of rows instead of all at once if they have to be
+#padded to more rows than this. Only used by the fft method. 0 never streams
+stream_rows=1000000
+#How files of different lengths are brought to the same length before they are transformed
+#max pads every file to the longest one
+#percentile pads files to length_percentile percent of the lengths and truncates longer files
+#bucket splits the lengths into length_buckets ranges and pads files to the longest in their range,
+#making features of a different size per range
+#resample stretches or shrinks every file to resample_length rows
+length_policy=max
+#Percentile of the file lengths to pad to with the percentile policy
+length_percentile=95
+#Most length ranges to make with the bucket policy
+length_buckets=4
+#Rows to resample files to with the resample policy. Empty uses the median length
+resample_length=
+#Number of processes to transform files with
+#Values less than 1 use one process per cpu
+jobs=1
 """
 class TimeChange:
     def __init__(self, project_name="default", parent_folder=None):
@@ -102,34 +168,14 @@ class TimeChange:
             #Create a transform file
             with open(path.join(self.project_path, "transform.conf"), "w") as config_file:
                 config_file.write(default_transform_config)
+            #Create an empty file index
+            index.save_index(self.project_path, {"files": {}})
         else:
             #Existing project
-            #Folder names and the file types within them
-            folder_structure = {'csv':'csv', 'images':'png', 'models':'h5'}
-            #Iterate over folder structure
-            for folder_name, file_type in folder_structure.items():
-                #Check if directory exists
-                if path.exists(path.join(self.project_path, folder_name)):
-                    #Check if all files in that folder are csv files
-                    for label in os.scandir(path.join(self.project_path, folder_name)):
-                        #So this works on 1 and 2-layer folders
-                        try:
-                            #Scan subdirectories
-                            for entry in os.scandir(path.join(self.project_path, folder_name, label.name)):
-                                #TODO: allow other extensions for ex: image
-                                if not entry.name.endswith(file_type):
-                                    raise Exception("{} is not a {} file".format(
-                                        path.join(self.project_path, folder_name, entry.name),
-                                        file_type))
-                        except NotADirectoryError:
-                            #Scan subfiles
-                            #TODO: allow other extensions for ex: image
-                            if not label.name.endswith(file_type):
-                                raise Exception("{} is not a {} file".format(
-                                    path.join(self.project_path, folder_name, label.name),
-                                    file_type))
-
-                else:
+            #Check that the project folders exist
+            #Their contents are only scanned by verify(), so opening a project doesn't take longer as it grows
+            for folder_name in ("csv", "images", "models"):
+                if not path.exists(path.join(self.project_path, folder_name)):
                     #directory does not exist
                     raise Exception("{} cannot be a timechange project because {} does not exist".format(
                         self.project_path,
@@ -139,21 +185,81 @@ class TimeChange:
                 raise Exception("{} cannot be a timechange project because {} does not exist".format(
                     self.project_path,
                     path.join(self.project_path, "parameters.conf")))
+            #Projects made before the file index have nothing to check against, so check every file
+            #and index them once. Otherwise the first file added would become the only one the index holds
+            if not path.exists(path.join(self.project_path, index.INDEX_FILE_NAME)):
+                self._check_files()
+                index.rebuild_index(self.project_path)
         #Stores what csv columns to use
         #TODO: store this value in a file instead of as a private member
         self.columns = None #Default values
+        #In-memory listing of the csv files, mapping label -> sorted list of filenames
+        #Built on first use and kept up to date by the add and remove methods
+        self._listing = None
         # Create a queue to communicate with the worker thread
         self.worker_queue = Queue()
         # Create a queue to recieve messages from the worker thread
         self.result_queue = Queue()
+        #Makes ids for the jobs sent to the worker thread
+        self._job_ids = count(1)
+        #Model used by predict, loaded on first use
+        self._predictor = None
         # Start a worker thread, passing argument
         self.worker = Thread(target=worker.worker_thread, name="worker", args=(self.project_path, self.worker_queue, self.result_queue), daemon=True)
         self.worker.start()
-    def add_training_file(self, label, file_path):
+    def _check_files(self):
+        """Checks that every file in the project folders has the right type
+        raises Exception if a file has the wrong type or a folder is missing
+        """
+        #Folder names and the file types within them
+        folder_structure = {'csv':'csv', 'images':'png', 'models':'h5'}
+        #Iterate over folder structure
+        for folder_name, file_type in folder_structure.items():
+            #Check if directory exists
+            if path.exists(path.join(self.project_path, folder_name)):
+                #Check if all files in that folder are csv files
+                for label in os.scandir(path.join(self.project_path, folder_name)):
+                    #So this works on 1 and 2-layer folders
+                    try:
+                        #Scan subdirectories
+                        for entry in os.scandir(path.join(self.project_path, folder_name, label.name)):
+                            #TODO: allow other extensions for ex: image
+                            if not entry.name.endswith(file_type):
+                                raise Exception("{} is not a {} file".format(
+                                    path.join(self.project_path, folder_name, entry.name),
+                                    file_type))
+                    except NotADirectoryError:
+                        #Scan subfiles
+                        #TODO: allow other extensions for ex: image
+                        if not label.name.endswith(file_type):
+                            raise Exception("{} is not a {} file".format(
+                                path.join(self.project_path, folder_name, label.name),
+                                file_type))
+
+            else:
+                #directory does not exist
+                raise Exception("{} cannot be a timechange project because {} does not exist".format(
+                    self.project_path,
+                    path.join(self.project_path, folder_name)))
+    def verify(self):
+        """Checks every file in the project against the file index and the transform manifest
+        The index is repaired so it matches the csv files on disk.
+        raises Exception if the project folders hold files of the wrong type
+        Returns a dict counting the index entries that were added, removed and updated,
+        and the csv files whose transformed data is out of date or missing
+        """
+        self._check_files()
+        summary = index.rebuild_index(self.project_path)
+        #The index may have changed, so rebuild the listing from it next time
+        self._listing = None
+        return summary
+    def add_training_file(self, label, file_path, cache=False):
         """Adds a training file to the dataset under a specific label
         Keyword arguments:
         label -- the label to store the filename under
         filename -- the filename to add to the database
+        cache -- whether to parse the file into a columnar cache now, so transforms
+                 can memory map its columns instead of parsing the text every run
         """
         #If the folder for the label doesn't exist, create it
         if not path.exists(path.join(self.project_path, "csv", label)):
@@ -161,7 +267,71 @@ class TimeChange:
         #Copy the csv file into the project
         #Uses the name of the original file.
         #TODO: generate better name
-        shutil.copyfile(file_path, path.join(self.project_path, "csv", label, path.split(file_path)[1]))
+        filename = path.split(file_path)[1]
+        #Files already in place, such as ones add_training_files hardlinked, are left as they are
+        index.link_file(file_path, path.join(self.project_path, "csv", label, filename), "copy")
+        #Record the file's row count so transforms don't have to recount it
+        index.update_index(self.project_path, added={label: {filename: self._file_info(label, filename, cache)}})
+        self._add_to_listing(label, [filename])
+    def add_training_files(self, files, link="auto", cache=False, jobs=None):
+        """Adds many training files to the dataset at once
+        Files are linked into the project where the filesystem allows it and copied in parallel otherwise.
+        The file index is updated with a single write at the end.
+        Keyword arguments:
+        files -- a folder with a subfolder of csv files per label, or an iterable of (label, file path) pairs
+        link -- how to put files into the project, see index.link_file. Defaults to the cheapest available
+        cache -- whether to parse the files into columnar caches, as in add_training_file
+        jobs -- number of files to import at the same time
+        Returns a dict mapping the path of every file that failed to import to its error message
+        """
+        if isinstance(files, str):
+            #Walk the label folders
+            folder = files
+            files = [(label.name, csv_file.path)
+                     for label in os.scandir(folder) if label.is_dir()
+                     for csv_file in os.scandir(label.path) if csv_file.name.endswith(".csv")]
+        else:
+            files = list(files)
+        #Create the label folders up front so the imports don't race to make them
+        for label in set(label for label, _ in files):
+            os.makedirs(path.join(self.project_path, "csv", label), exist_ok=True)
+        def import_file(label_and_path):
+            label, file_path = label_and_path
+            filename = path.split(file_path)[1]
+            try:
+                index.link_file(file_path, path.join(self.project_path, "csv", label, filename), link)
+                return label, filename, self._file_info(label, filename, cache), None
+            except Exception as err:
+                return label, file_path, None, str(err)
+        #Imports are mostly waiting on the disk, so threads are enough to run them in parallel
+        added = {}
+        failures = {}
+        with ThreadPoolExecutor(max_workers=jobs or min(32, (os.cpu_count() or 1) * 4)) as executor:
+            #Successful imports give back the filename, failed ones the original path
+            for label, name, info, error in executor.map(import_file, files):
+                if error is None:
+                    added.setdefault(label, {})[name] = info
+                else:
+                    failures[name] = error
+        #Record all the files at once
+        index.update_index(self.project_path, added=added)
+        for label, entries in added.items():
+            self._add_to_listing(label, entries)
+        return failures
+    def _file_info(self, label, filename, cache):
+        """Generates the index entry of a csv file in the project, caching its columns if asked to
+        Falls back to an uncached entry if the file can't be cached"""
+        csv_path = path.join(self.project_path, "csv", label, filename)
+        cache_file = index.cache_path(self.project_path, label, filename)
+        if cache:
+            try:
+                return worker.cache_csv(csv_path, cache_file)
+            except Exception:
+                pass
+        #Don't leave a cache of an older file with the same name behind
+        if path.exists(cache_file):
+            os.remove(cache_file)
+        return index.file_info(csv_path)
     def remove_training_file(self, label, filename):
         """Removes a training file from a label
         Keyword arguments:
@@ -169,11 +339,25 @@ class TimeChange:
         filename -- the filename to add to the project
         """
         #Removes the file with the given name from the label's directory
-        os.remove(file_path, path.join(self.project_path, "csv", label, path.split(file_path)[1]))
+        os.remove(path.join(self.project_path, "csv", label, filename))
+        #Removes its columnar cache
+        if path.exists(index.cache_path(self.project_path, label, filename)):
+            os.remove(index.cache_path(self.project_path, label, filename))
+        #Forget the file's row count
+        index.update_index(self.project_path, removed=[(label, filename)])
+        filenames = self._get_listing().get(label, [])
+        position = bisect_left(filenames, filename)
+        if position < len(filenames) and filenames[position] == filename:
+            del filenames[position]
         #Check to see if this was the last entry for a label
-        if len(os.scandir(path.join(self.project_path, "csv", label))) == 0:
+        if not filenames:
+            self._listing.pop(label, None)
             #If this was the last entry, delete the label
-            shutil.rmtree(path.join(self.project_path, "csv", label))
+            #Files put into the folder by hand aren't listed, and keep it
+            try:
+                os.rmdir(path.join(self.project_path, "csv", label))
+            except OSError:
+                pass
     def set_columns(self, columns):
         """Sets the CSV columns to be used by the transform process"""
         #Load the config for transform parameters
@@ -199,36 +383,176 @@ class TimeChange:
         return transform_config["DEFAULT"]
     def get_csv_columns(self):
         """Reads a csv file and returns the column names
+        Column names stored with a columnar cache are used when there is one
         """
+        for entries in index.load_index(self.project_path)["files"].values():
+            for info in entries.values():
+                if "columns" in info:
+                    return list(info["columns"])
+            break
         try:
+            import pandas
             example_csv = os.scandir(os.scandir(path.join(self.project_path, "csv")).__next__().path).__next__().path
             return list(pandas.read_csv(example_csv, nrows=1).columns)
         except:
             return []
+    def _get_listing(self):
+        """Returns the in-memory listing of csv files, building it if needed
+        The listing comes from the file index, which is complete once the project is opened.
+        An index deleted since is rebuilt from the csv folder first, so the listing never comes from a partial one.
+        Files put into the csv folder by hand only show up after verify()."""
+        if self._listing is None:
+            if not path.exists(path.join(self.project_path, index.INDEX_FILE_NAME)):
+                index.rebuild_index(self.project_path)
+            files = index.load_index(self.project_path)["files"]
+            self._listing = {label: sorted(entries) for label, entries in files.items() if entries}
+        return self._listing
+    def _add_to_listing(self, label, filenames):
+        """Adds filenames to the in-memory listing, keeping it sorted"""
+        if self._listing is None:
+            #Nothing to update until the listing is built
+            return
+        label_filenames = self._listing.setdefault(label, [])
+        for filename in filenames:
+            position = bisect_left(label_filenames, filename)
+            if position == len(label_filenames) or label_filenames[position] != filename:
+                label_filenames.insert(position, filename)
+    def _filename_range(self, label, prefix):
+        """Returns the sorted filenames of a label and the (start, end) range of them that starts with prefix"""
+        filenames = self._get_listing().get(label, [])
+        if not prefix:
+            return filenames, 0, len(filenames)
+        #Every name starting with prefix sorts between prefix and prefix with its last character incremented
+        start = bisect_left(filenames, prefix)
+        end = bisect_left(filenames, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return filenames, start, end
     def get_csv_labels(self):
         """Returns a list of csv labels from the project tree."""
-        return sorted([folder.name for folder in os.scandir(path.join(self.project_path, "csv"))])
-    def get_csv_filenames(self, label):
-        """Returns a list of csv filenames for a specific label from the project tree."""
-        return sorted([csv_file.name for csv_file in os.scandir(path.join(self.project_path, "csv", label))])
+        return sorted(self._get_listing())
+    def get_label_counts(self):
+        """Returns a dict mapping each csv label to its number of csv files"""
+        listing = self._get_listing()
+        return {label: len(listing[label]) for label in sorted(listing)}
+    def get_csv_filenames(self, label, offset=0, limit=None, prefix=None):
+        """Returns a list of csv filenames for a specific label from the project tree.
+        Keyword arguments:
+        label -- the label to list
+        offset -- number of filenames to skip
+        limit -- most filenames to return, or None for all of them
+        prefix -- only list filenames starting with this
+        """
+        filenames, start, end = self._filename_range(label, prefix)
+        start = min(start + offset, end)
+        if limit is not None:
+            end = min(start + limit, end)
+        return filenames[start:end]
+    def iter_csv_filenames(self, label, prefix=None):
+        """Iterates over the csv filenames for a specific label in sorted order without copying the listing
+        Keyword arguments:
+        label -- the label to list
+        prefix -- only list filenames starting with this
+        """
+        filenames, start, end = self._filename_range(label, prefix)
+        for position in range(start, end):
+            yield filenames[position]
 
-    def convert_all_csv(self):
+    def _submit(self, command, priority, profile):
+        """Queues a job on the worker thread
+        Keyword arguments:
+        command -- command dict, see worker.Scheduler
+        priority -- jobs with a higher priority start first
+        profile -- whether to profile the job
+        Returns the job's id, which tags every message the job puts on the result queue"""
+        job_id = next(self._job_ids)
+        self.worker_queue.put(dict(command, id=job_id, priority=priority, profile=profile))
+        return job_id
+    def cancel(self, job_id):
+        """Tells the worker thread to cancel a queued or running job
+        Running transforms stop after their current batch of files, and training stops at the end of its epoch
+        Keyword arguments:
+        job_id -- id returned when the job was queued
+        """
+        self.worker_queue.put({"command":"cancel", "id":job_id})
+    def convert_all_csv(self, jobs=None, priority=0, profile=False):
         """Tells the worker thread to perform transformation on the csv data
+        Keyword arguments:
+        jobs -- number of processes to transform files with. Defaults to the jobs value in transform.conf
+        priority -- jobs with a higher priority start first
+        profile -- profile the job and add the profile to its result message, see profiling.JobProfiler
         Preconditions
             CSV files have been added to the project with add_training_file
+        Returns the job's id
         """
-        self.worker_queue.put({"command":"transform"})
-    def build_model(self):
+        return self._submit({"command":"transform", "jobs":jobs}, priority, profile)
+    def build_model(self, priority=0, profile=False):
         """Tells the worker thread to build a keras model based on project_path/parameters.conf
+        Keyword arguments:
+        priority -- jobs with a higher priority start first
+        profile -- profile the job and add the profile to its result message, see profiling.JobProfiler
         Preconditions
             A project_path/parameters.conf is a valid model parameter file
+        Returns the job's id
         """
-        self.worker_queue.put({"command":"build_model"})
-    def train(self):
+        return self._submit({"command":"build_model"}, priority, profile)
+    def train(self, priority=0, profile=False):
         """Tells the worker thread to start training a keras model based on the image data
+        Keyword arguments:
+        priority -- jobs with a higher priority start first
+        profile -- profile the job and add the profile to its result message, see profiling.JobProfiler
         Preconditions
             Data has been generated with convert_all_csv
             A valid model has been generated with build_model
+        Returns the job's id
+        """
+        return self._submit({"command":"train"}, priority, profile)
+    def transform_and_train(self, jobs=None, min_batches=4, priority=0, profile=False):
+        """Tells the worker thread to transform the csv data and train on it at the same time
+        Training starts as soon as the transform has made min_batches batches of features, and a model is
+        built first if there isn't one that fits the data
+        Keyword arguments:
+        jobs -- number of processes to transform files with. Defaults to the jobs value in transform.conf
+        min_batches -- number of batches of features to wait for before training
+        priority -- jobs with a higher priority start first
+        profile -- profile the job and add the profile to its result message, see profiling.JobProfiler
+        Preconditions
+            CSV files have been added to the project with add_training_file
+            A project_path/parameters.conf is a valid model parameter file
+        Returns the job's id
+        """
+        return self._submit({"command":"pipeline", "jobs":jobs, "min_batches":min_batches}, priority, profile)
+    def predict_in_background(self, inputs, batch_size=predict.PREDICT_BATCH_SIZE, priority=0, profile=False):
+        """Tells the worker thread to classify time series with the project's trained model
+        Unlike the other jobs, predictions run alongside transforms and training
+        Keyword arguments:
+        inputs -- csv file paths or arrays, as in predict
+        batch_size -- most inputs to transform and run through the model at once
+        priority -- jobs with a higher priority start first
+        profile -- profile the job and add the profile to its result message, see profiling.JobProfiler
+        Preconditions
+            Data has been generated with convert_all_csv
+            A model has been trained with train
+        Returns the job's id. Its result message holds the probabilities of each label as a list,
+        and the labels in order
+        """
+        return self._submit({"command":"predict", "inputs":inputs, "batch_size":batch_size}, priority, profile)
+    def predict(self, inputs, batch_size=predict.PREDICT_BATCH_SIZE):
+        """Classifies time series with the project's trained model
+        The model is loaded from project_path/models/latest.h5 on the first call and kept for later ones.
+        It is reloaded when training saves new weights.
+        Inputs are transformed in memory with the parameters of the last transform, so no images are written.
+        Keyword arguments:
+        inputs -- a csv file path, or an array of shape (samples, columns) holding the columns used for training,
+                  or a list of them
+        batch_size -- most inputs to transform and run through the model at once
+        Preconditions
+            Data has been generated with convert_all_csv
+            A model has been trained with train
+        Returns an array of shape (inputs, labels) with the probability of each label,
+        in the order of get_prediction_labels()
         """
-        self.worker_queue.put({"command":"train"})
-        return {"acc":[0], "loss":[0]}
+        if self._predictor is None or not self._predictor.is_current():
+            self._predictor = predict.Predictor(self.project_path)
+        return self._predictor.predict(inputs, batch_size)
+    def get_prediction_labels(self):
+        """Returns the labels predict gives probabilities for, in order"""
+        return predict.class_labels(self.project_path)
@@ -30,5 +30,15 @@ THE SOFTWARE.
 
 #This file will be executed when the user runs
 #python -m timechange
+#which opens the GUI, or
+#python -m timechange transform|train|predict|serve <project> ...
+#which runs a command without it, see cli.py
 
-from . import gui
+import sys
+
+if len(sys.argv) > 1:
+    from . import cli
+    sys.exit(cli.main(sys.argv[1:]))
+else:
+    from . import gui
+    gui.main()
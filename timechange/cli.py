@@ -0,0 +1,224 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For the command line
+import argparse
+import sys
+#For writing predictions
+import csv
+#For reading jobs' messages
+import json
+import os
+from os import path
+from queue import Queue, Empty
+from threading import Thread
+#No Tk, keras, pandas or PIL here, so batch jobs start quickly. The jobs load what they need
+from . import worker
+from .predict import Predictor, PREDICT_BATCH_SIZE
+
+#Message types that end a job
+FINAL_MESSAGES = ("success", "error", "cancelled")
+
+def _format_progress(event):
+    """Formats a progress event from a job as one line
+    Keyword arguments:
+    event -- progress event, see metrics.Metrics
+    """
+    parts = ["{}: {:.1f}s".format(event["job"], event["elapsed"])]
+    counters = event["counters"]
+    if "epoch" in event:
+        parts.append("epoch {}".format(event["epoch"] + 1))
+        parts.extend("{} {:.4g}".format(name, value) for name, value in sorted(event["logs"].items()))
+    elif "total" in event:
+        parts.append("{}/{} files".format(counters.get("files", 0), event["total"]))
+    else:
+        parts.extend("{} {}".format(counter, amount) for counter, amount in sorted(counters.items()))
+    for counter in ("files", "samples"):
+        if counter in event["rates"]:
+            parts.append("{:.1f} {}/s".format(event["rates"][counter], counter))
+    return ", ".join(parts)
+
+def run_jobs(project_path, commands, quiet=False):
+    """Runs job commands on a worker scheduler and prints their messages until they have finished
+    Ctrl+C cancels the jobs, which stop at the next batch or epoch
+    Keyword arguments:
+    project_path -- path to a timechange project
+    commands -- list of command dicts, see worker.Scheduler
+    quiet -- print only errors
+    Returns whether every job succeeded"""
+    input_queue = Queue()
+    output_queue = Queue()
+    scheduler = worker.Scheduler(project_path, input_queue, output_queue)
+    thread = Thread(target=scheduler.run, name="worker", daemon=True)
+    thread.start()
+    job_ids = ["job-{}".format(number) for number in range(1, len(commands) + 1)]
+    for job_id, command in zip(job_ids, commands):
+        input_queue.put(dict(command, id=job_id))
+    input_queue.put({"command": "shutdown"})
+    succeeded = True
+    while thread.is_alive() or not output_queue.empty():
+        try:
+            message = output_queue.get(timeout=0.1)
+        except Empty as _:
+            continue
+        except KeyboardInterrupt as _:
+            print("Cancelling...", file=sys.stderr)
+            for job_id in job_ids:
+                scheduler.cancel(job_id)
+            continue
+        if message["type"] == "progress":
+            if not quiet:
+                print(_format_progress(message), file=sys.stderr)
+        elif message["type"] == "error":
+            succeeded = False
+            print("{} failed: {}".format(message["job"], message["message"]), file=sys.stderr)
+        elif message["type"] == "cancelled":
+            succeeded = False
+            print("{} cancelled".format(message["job"]), file=sys.stderr)
+        elif message["type"] == "success" and not quiet:
+            print("{} finished".format(message["job"]), file=sys.stderr)
+        if "profile" in message:
+            print("{} profile: {}".format(message["job"], json.dumps(message["profile"])), file=sys.stderr)
+    return succeeded
+
+def transform(args):
+    """Runs the transform command"""
+    return run_jobs(args.project, [{"command": "transform", "jobs": args.jobs, "profile": args.profile}], args.quiet)
+
+def train(args):
+    """Runs the train command"""
+    if args.transform:
+        #The pipeline builds a model that fits the data as it goes
+        commands = [{"command": "pipeline", "jobs": args.jobs, "profile": args.profile}]
+    else:
+        commands = [{"command": "build_model", "profile": args.profile},
+                    {"command": "train", "profile": args.profile}]
+    return run_jobs(args.project, commands, args.quiet)
+
+def _csv_files(inputs):
+    """Lists csv files to predict, expanding folders into the csv files inside them"""
+    for input_path in inputs:
+        if path.isdir(input_path):
+            yield from sorted(entry.path for entry in os.scandir(input_path)
+                              if entry.is_file() and entry.name.endswith(".csv"))
+        else:
+            yield input_path
+
+def _predict_files(predictor, files, batch_size, failures):
+    """Classifies csv files, leaving out the ones that fail
+    Keyword arguments:
+    predictor -- predict.Predictor to classify with
+    files -- paths of the csv files
+    batch_size -- most files to classify at once
+    failures -- dict to add the path of every file that failed to, mapping it to its error message
+    Returns a list of (file path, class probabilities) for the files that were classified"""
+    #Read each file on its own, so an unreadable file doesn't stop the others
+    read_files = []
+    series = []
+    for file_path in files:
+        try:
+            series.append(predictor.read(file_path))
+            read_files.append(file_path)
+        except Exception as err:
+            failures[file_path] = str(err)
+    if not series:
+        return []
+    try:
+        return list(zip(read_files, predictor.predict_series(series, batch_size)))
+    except Exception as err:
+        if len(series) == 1:
+            failures[read_files[0]] = str(err)
+            return []
+    #Something in the batch couldn't be transformed or classified, so find out which files it was
+    results = []
+    for file_path, data in zip(read_files, series):
+        try:
+            results.append((file_path, predictor.predict_series([data], batch_size)[0]))
+        except Exception as err:
+            failures[file_path] = str(err)
+    return results
+
+def predict(args):
+    """Runs the predict command, writing a csv line of class probabilities per input to stdout
+    Files that can't be read or classified are reported on stderr, and the others are still classified"""
+    predictor = Predictor(args.project)
+    files = list(_csv_files(args.inputs))
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["input", "prediction"] + predictor.labels)
+    #Maps file path -> error message
+    failures = {}
+    for start in range(0, len(files), args.batch_size):
+        batch = files[start:start + args.batch_size]
+        for file_path, row in _predict_files(predictor, batch, args.batch_size, failures):
+            writer.writerow([file_path, predictor.labels[row.argmax()]] + ["{:.6g}".format(value) for value in row])
+    if failures:
+        print("{} file(s) failed to predict:".format(len(failures)), file=sys.stderr)
+        for file_path, error in sorted(failures.items()):
+            print("{}: {}".format(file_path, error), file=sys.stderr)
+    return not failures
+
+def main(argv=None):
+    """Runs a timechange command without the GUI
+    Keyword arguments:
+    argv -- command line arguments, or None to use sys.argv
+    Returns the exit status"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == "serve":
+        #The server has its own arguments
+        from . import serve
+        serve.main(argv[1:])
+        return 0
+    parser = argparse.ArgumentParser(prog="timechange", description="Runs timechange jobs without the GUI")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+    transform_parser = commands.add_parser("transform", help="convert a project's csv files")
+    transform_parser.set_defaults(run=transform)
+    train_parser = commands.add_parser("train", help="build a model from parameters.conf and train it")
+    train_parser.add_argument("--transform", action="store_true",
+                              help="transform the csv files as well, training while the transform runs")
+    train_parser.set_defaults(run=train)
+    for job_parser in (transform_parser, train_parser):
+        job_parser.add_argument("project", help="path to the timechange project")
+        job_parser.add_argument("--jobs", type=int, help="number of processes to transform files with. "
+                                "Defaults to the jobs value in transform.conf")
+        job_parser.add_argument("--profile", action="store_true", help="profile the jobs, see profiling.JobProfiler")
+        job_parser.add_argument("--quiet", action="store_true", help="print only errors")
+    predict_parser = commands.add_parser("predict", help="classify csv files with a project's trained model")
+    predict_parser.add_argument("project", help="path to the timechange project")
+    predict_parser.add_argument("inputs", nargs="+", help="csv files, or folders of csv files, to classify")
+    predict_parser.add_argument("--batch-size", type=int, default=PREDICT_BATCH_SIZE, help="most files to classify at once")
+    predict_parser.set_defaults(run=predict)
+    commands.add_parser("serve", help="serve predictions over HTTP, see serve --help")
+    args = parser.parse_args(argv)
+    args.project = path.abspath(args.project)
+    try:
+        return 0 if args.run(args) else 1
+    except Exception as err:
+        print("{} failed: {}".format(args.command, err), file=sys.stderr)
+        return 1
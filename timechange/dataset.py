@@ -0,0 +1,468 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For navigating filesystems
+import os
+from os import path
+#For handing samples from the transform to training and prefetching batches
+from threading import Condition, Event, Thread
+from queue import Queue, Full
+#For decoding png images in parallel
+from concurrent.futures import ThreadPoolExecutor
+#For storing and memory-mapping features
+import numpy as np
+#For reading the shard layout from the transform manifest
+from . import index
+
+#Folder within a project that stores the feature shards
+TENSOR_FOLDER = "tensors"
+
+def shard_path(project_path, label, bucket=None):
+    """Returns the path of a label's feature shard
+    Keyword arguments:
+    project_path -- path to a timechange project
+    label -- the label the shard stores features for
+    bucket -- length the shard's series were padded to if files are bucketed by length, otherwise None
+    """
+    if bucket is None:
+        return path.join(project_path, TENSOR_FOLDER, "{}.npy".format(label))
+    return path.join(project_path, TENSOR_FOLDER, str(bucket), "{}.npy".format(label))
+
+def tensor_buckets(tensors):
+    """Lists the shard buckets recorded in the tensors entry of a transform manifest
+    Projects whose files aren't bucketed by length have a single bucket
+    Keyword arguments:
+    tensors -- the manifest's tensors entry
+    Returns a list of (bucket, shape, labels) tuples, where bucket is the padded length or None,
+    shape is the shape of a single stored sample and labels maps label -> csv filename -> shard row"""
+    if "buckets" in tensors:
+        return [(bucket["length"], tuple(bucket["shape"]), bucket["labels"]) for bucket in tensors["buckets"]]
+    return [(None, tuple(tensors["shape"]), tensors["labels"])]
+
+def combine_shapes(shapes):
+    """Combines the shapes of samples into one shape, with None for the sizes that differ
+    Keyword arguments:
+    shapes -- iterable of shapes with the same number of dimensions"""
+    shapes = list(shapes)
+    return tuple(size if all(shape[axis] == size for shape in shapes) else None for axis, size in enumerate(shapes[0]))
+
+class ShardWriter:
+    """Writes the features of one label into a contiguous .npy shard
+    Rows are written in the order they arrive. The shard is created on the first write and only
+    replaces the existing shard when the writer is closed"""
+    def __init__(self, project_path, label, num_rows, bucket=None, shape=None):
+        """Constructor
+        Keyword arguments:
+        project_path -- path to a timechange project
+        label -- the label to write a shard for
+        num_rows -- the most rows that will be written
+        bucket -- length the series were padded to if files are bucketed by length, otherwise None
+        shape -- shape of the features of a row, or None to take the shape of the first features written
+        """
+        self.path = shard_path(project_path, label, bucket)
+        self.num_rows = num_rows
+        self.shape = None if shape is None else tuple(shape)
+        #Created on the first write, once the feature shape is known
+        self.shard = None
+        #Maps csv filename -> shard row
+        self.rows = {}
+    def write(self, filename, features):
+        """Writes the features of a csv file to the next row of the shard
+        Keyword arguments:
+        filename -- name of the csv file the features came from
+        features -- float array of shape (channels, height, width)
+        Raises an exception if the features don't have the shape of the shard's rows
+        """
+        if self.shape is None:
+            self.shape = features.shape
+        if features.shape != self.shape:
+            raise Exception("Features of {} have shape {}, but the shard stores features of shape {}".format(
+                filename, features.shape, self.shape))
+        if self.shard is None:
+            os.makedirs(path.dirname(self.path), exist_ok=True)
+            self.shard = np.lib.format.open_memmap(self.path + ".tmp", mode="w+", dtype=np.float32,
+                                                   shape=(self.num_rows,) + self.shape)
+        row = len(self.rows)
+        self.shard[row] = features
+        self.rows[filename] = row
+    def close(self):
+        """Replaces the label's shard with the newly written one
+        Returns a dict mapping csv filename -> shard row. Rows of files that failed to convert are left empty"""
+        if self.shard is None:
+            #Nothing was written, so the label has no shard
+            try:
+                os.remove(self.path)
+            except FileNotFoundError as _:
+                pass
+            return {}
+        self.shard.flush()
+        #Release the memory map before moving the file
+        self.shard = None
+        os.replace(self.path + ".tmp", self.path)
+        return self.rows
+
+class Dataset:
+    """Base class of data sets that hold every sample of a project
+    Subclasses set labels, input_shape and num_samples and implement take.
+    Samples of different shapes are kept in groups of consecutive indices, listed in groups as
+    (start, stop) ranges. input_shape then holds None for the sizes that differ"""
+    #A single group of every sample, unless a subclass sets its own
+    groups = None
+    def take(self, sample_indices):
+        """Gathers samples into a batch
+        Keyword arguments:
+        sample_indices -- sorted array of sample indices
+        Returns a tuple of (features, one-hot labels)"""
+        raise NotImplementedError
+    def batches(self, batch_size, shuffle=True, seed=None):
+        """Generates (features, one-hot labels) batches forever, as keras' fit_generator expects
+        Every batch is drawn from a single group, so its samples have the same shape
+        Keyword arguments:
+        batch_size -- number of samples per batch
+        shuffle -- whether to shuffle the samples every epoch
+        seed -- seed for the shuffle
+        """
+        random_state = np.random.RandomState(seed)
+        groups = self.groups or [(0, self.num_samples)]
+        while True:
+            batches = []
+            for group_start, group_stop in groups:
+                if shuffle:
+                    order = group_start + random_state.permutation(group_stop - group_start)
+                else:
+                    order = np.arange(group_start, group_stop)
+                batches.extend(order[start:start + batch_size] for start in range(0, len(order), batch_size))
+            if shuffle and len(groups) > 1:
+                #Mix the groups, so training doesn't see one shape at a time
+                batches = [batches[position] for position in random_state.permutation(len(batches))]
+            for batch in batches:
+                #Sorted indices read each shard front to back
+                yield self.take(np.sort(batch))
+
+class TensorDataset(Dataset):
+    """Memory-mapped view of a project's feature shards
+    Samples are read straight from the shards, so the dataset never has to fit in memory.
+    Each length bucket is a group of samples"""
+    def __init__(self, project_path):
+        """Constructor
+        raises Exception if the project has no feature shards
+        Keyword arguments:
+        project_path -- path to a timechange project
+        """
+        manifest = index.load_manifest(project_path)
+        if manifest is None or manifest.get("tensors") is None:
+            raise Exception("There is no tensor data stored. Please transform the data with output=npy")
+        buckets = tensor_buckets(manifest["tensors"])
+        #Labels in sorted order, which sets the class index of each label
+        self.labels = sorted(set(label for _, _, labels in buckets for label in labels))
+        #Shape of a single stored sample (channels, height, width)
+        self.shape = combine_shapes(shape for _, shape, _ in buckets)
+        #Shape of a single sample as the model sees it. Stored channels are copied into 3 image channels
+        self.input_shape = (3,) + self.shape[1:]
+        #Memory map each shard, bucket by bucket
+        self.shards = []
+        #Class index of each shard
+        self.classes = []
+        #Rows of each shard that hold a sample
+        self.rows = []
+        for bucket, _, labels in buckets:
+            for label in sorted(labels):
+                self.shards.append(np.load(shard_path(project_path, label, bucket), mmap_mode="r"))
+                self.classes.append(self.labels.index(label))
+                self.rows.append(np.array(sorted(labels[label].values()), dtype=np.int64))
+        #Index of the first sample of each shard
+        self.offsets = np.cumsum([0] + [len(rows) for rows in self.rows])
+        self.num_samples = int(self.offsets[-1])
+        #Samples of a bucket have consecutive indices
+        bucket_offsets = np.cumsum([0] + [sum(len(rows) for rows in labels.values()) for _, _, labels in buckets])
+        self.groups = [(int(start), int(stop)) for start, stop in zip(bucket_offsets[:-1], bucket_offsets[1:])]
+    def take(self, sample_indices):
+        """Gathers samples into a batch
+        Keyword arguments:
+        sample_indices -- sorted array of sample indices
+        Returns a tuple of (features, one-hot labels)"""
+        labels = np.zeros((len(sample_indices), len(self.labels)), dtype=np.float32)
+        #Find the shard each sample lives in
+        shard_ids = np.searchsorted(self.offsets, sample_indices, side="right") - 1
+        #Every sample of the batch has the shape of the first one's bucket
+        input_shape = (3,) + self.shards[shard_ids[0]].shape[2:]
+        #Samples from consecutive rows of one shard are sliced straight out of the memory map
+        if shard_ids[0] == shard_ids[-1]:
+            shard_id = shard_ids[0]
+            rows = self.rows[shard_id][sample_indices - self.offsets[shard_id]]
+            if rows[-1] - rows[0] == len(rows) - 1:
+                labels[:, self.classes[shard_id]] = 1.0
+                #Copy channels with a broadcast view rather than new memory
+                return np.broadcast_to(self.shards[shard_id][rows[0]:rows[-1] + 1], (len(rows),) + input_shape), labels
+        features = np.empty((len(sample_indices),) + input_shape, dtype=np.float32)
+        for shard_id in np.unique(shard_ids):
+            mask = shard_ids == shard_id
+            features[mask] = self.shards[shard_id][self.rows[shard_id][sample_indices[mask] - self.offsets[shard_id]]]
+            labels[mask, self.classes[shard_id]] = 1.0
+        return features, labels
+
+class ImageDataset(Dataset):
+    """A project's png images, decoded once and held in memory
+    Every channel of a transformed image holds the same values, so a single channel is kept per image
+    and copied into three when batches are made. Values are scaled to 0-1 like the png pixels were.
+    Images of the same size are a group of samples"""
+    def __init__(self, project_path, jobs=None):
+        """Constructor
+        raises Exception if the project has no images
+        Keyword arguments:
+        project_path -- path to a timechange project
+        jobs -- number of threads to decode images with. Defaults to one per cpu
+        """
+        #Load PIL only when images are read
+        from PIL import Image
+        image_folder = path.join(project_path, "images")
+        #Labels in sorted order, which sets the class index of each label
+        self.labels = sorted(label.name for label in os.scandir(image_folder) if label.is_dir())
+        image_paths = []
+        classes = []
+        for class_index, label in enumerate(self.labels):
+            for image_file in sorted(os.scandir(path.join(image_folder, label)), key=lambda entry: entry.name):
+                if image_file.name.endswith(".png"):
+                    image_paths.append(image_file.path)
+                    classes.append(class_index)
+        if not image_paths:
+            raise Exception("There are no images stored. Please transform the data first")
+        self.num_samples = len(image_paths)
+        def read_size(image_path):
+            #Only reads the header
+            with Image.open(image_path) as img:
+                return img.size
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+            #Images of different length buckets have different sizes, so order the samples by size
+            sizes = list(executor.map(read_size, image_paths))
+            order = sorted(range(self.num_samples), key=lambda position: sizes[position])
+            image_paths = [image_paths[position] for position in order]
+            self.classes = np.array([classes[position] for position in order], dtype=np.int64)
+            sizes = [sizes[position] for position in order]
+            #Decode the images in parallel, straight into one array per size
+            self.images = []
+            self.groups = []
+            #Array and row each sample is decoded into
+            slots = []
+            for start in range(self.num_samples):
+                if start == 0 or sizes[start] != sizes[start - 1]:
+                    stop = start + sizes[start:].count(sizes[start])
+                    width, height = sizes[start]
+                    self.images.append(np.empty((stop - start, 1, height, width), dtype=np.uint8))
+                    self.groups.append((start, stop))
+                slots.append((self.images[-1], start - self.groups[-1][0]))
+            def decode(position):
+                with Image.open(image_paths[position]) as img:
+                    images, row = slots[position]
+                    images[row, 0] = np.asarray(img.convert("L"))
+            list(executor.map(decode, range(self.num_samples)))
+        self.group_starts = np.array([start for start, _ in self.groups], dtype=np.int64)
+        self.input_shape = (3,) + combine_shapes(images.shape[2:] for images in self.images)
+    def take(self, sample_indices):
+        """Gathers samples into a batch
+        Keyword arguments:
+        sample_indices -- sorted array of sample indices
+        Returns a tuple of (features, one-hot labels)"""
+        labels = np.zeros((len(sample_indices), len(self.labels)), dtype=np.float32)
+        labels[np.arange(len(sample_indices)), self.classes[sample_indices]] = 1.0
+        #Every sample of the batch is in the first one's group
+        group = np.searchsorted(self.group_starts, sample_indices[0], side="right") - 1
+        images = self.images[group]
+        features = images[sample_indices - self.group_starts[group]].astype(np.float32)
+        features *= 1.0 / 255.0
+        #Copy channels with a broadcast view rather than new memory
+        return np.broadcast_to(features, (len(sample_indices), 3) + images.shape[2:]), labels
+
+def prefetch(batches, queue_size=4):
+    """Makes batches on a background thread, so the next ones are ready while the current one is used
+    Broadcast and memory-mapped batches are copied into plain arrays on the background thread
+    Keyword arguments:
+    batches -- generator of (features, labels) batches
+    queue_size -- most batches to make ahead of time
+    Yields the batches in order. Errors raised while making a batch are raised here"""
+    batch_queue = Queue(maxsize=queue_size)
+    stopped = Event()
+    def put(item):
+        #Wait for room, giving up if the consumer has gone away
+        while not stopped.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+    def fill():
+        try:
+            for features, labels in batches:
+                if not put(((np.ascontiguousarray(features), labels), None)):
+                    return
+        except Exception as err:
+            put((None, err))
+            return
+        put((None, None))
+    Thread(target=fill, name="prefetch", daemon=True).start()
+    try:
+        while True:
+            batch, error = batch_queue.get()
+            if error is not None:
+                raise error
+            if batch is None:
+                return
+            yield batch
+    finally:
+        #Let the background thread finish when the consumer stops early
+        stopped.set()
+
+class StreamDataset:
+    """Samples handed over from a running transform, so training can start before the transform finishes
+    The transform offers every sample as it is made. A uniformly random subset of at most capacity
+    samples is held in memory, and batches are drawn from it until the transform closes the stream"""
+    def __init__(self, capacity=4096, max_bytes=1 << 30, seed=None):
+        """Constructor
+        Keyword arguments:
+        capacity -- most samples to hold in memory
+        max_bytes -- most bytes of features to hold in memory. Lowers the capacity for large samples
+        seed -- seed for choosing the held samples and the batches
+        """
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.random_state = np.random.RandomState(seed)
+        #Guards everything below and wakes up readers when samples arrive
+        self.condition = Condition()
+        #Labels in sorted order and the number of samples the transform will make, set by start
+        self.labels = None
+        self.num_samples = None
+        #Shape of a single stored sample (channels, height, width), set by the first sample
+        self.shape = None
+        #Shape of a single sample as the model sees it, set by the first sample
+        self.input_shape = None
+        #Axes of a stored sample whose size differs between samples, set by start
+        self.varying = ()
+        #Held samples and their class indices, allocated with the first sample
+        self.features = None
+        self.classes = None
+        #Number of samples offered and held so far
+        self.offered = 0
+        self.held = 0
+        #Set once the transform is finished
+        self.done = False
+        self.error = None
+    def start(self, labels, num_samples, varying=()):
+        """Called by the transform once it knows what it will make
+        Keyword arguments:
+        labels -- names of every label in the data set
+        num_samples -- number of samples in the finished data set
+        varying -- axes of a sample (channels, height, width) whose size differs between samples,
+                   such as the height of features of files bucketed by length
+        """
+        with self.condition:
+            self.labels = sorted(labels)
+            self.num_samples = num_samples
+            self.varying = tuple(varying)
+            self.condition.notify_all()
+    def offer(self, label, load):
+        """Offers a sample to the stream
+        Keyword arguments:
+        label -- label of the sample
+        load -- function returning the sample's features, a float array of shape (channels, height, width)
+                Only called if the sample is kept
+        """
+        #Reservoir sampling keeps every sample offered so far equally likely to be held
+        with self.condition:
+            if self.offered < self.capacity:
+                slot = self.offered
+            else:
+                slot = self.random_state.randint(0, self.offered + 1)
+            self.offered += 1
+        if slot >= self.capacity:
+            return
+        #Load outside the lock so batches can still be drawn meanwhile
+        features = load()
+        with self.condition:
+            if self.features is None:
+                self.shape = features.shape
+                self.input_shape = (3,) + tuple(None if axis in self.varying else size
+                                                for axis, size in enumerate(self.shape) if axis > 0)
+                self.capacity = max(1, min(self.capacity, self.max_bytes // (features.size * 4)))
+                #Samples are held one by one, as they can have different shapes
+                self.features = [None] * self.capacity
+                self.classes = np.empty(self.capacity, dtype=np.int64)
+            if any(size is not None and size != actual for size, actual in zip(self.input_shape[1:], features.shape[1:])):
+                raise Exception("Every sample in a stream must fit its input shape")
+            if slot >= self.capacity:
+                return
+            self.features[slot] = np.asarray(features, dtype=np.float32)
+            self.classes[slot] = self.labels.index(label)
+            self.held = min(self.held + 1, self.capacity)
+            self.condition.notify_all()
+    def close(self, error=None):
+        """Called by the transform once it has finished
+        Keyword arguments:
+        error -- message of the error that stopped the transform, if any
+        """
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+    def wait(self, num_samples):
+        """Waits until the stream holds enough samples to train on, or the transform has finished
+        raises Exception if the transform failed
+        Keyword arguments:
+        num_samples -- number of samples to wait for
+        Returns the number of samples held"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.done or (self.labels is not None and self.held >= num_samples))
+            if self.error is not None:
+                raise Exception(self.error)
+            return self.held
+    def batches(self, batch_size, min_samples=1):
+        """Generates random (features, one-hot labels) batches from the held samples until the transform finishes
+        raises Exception if the transform failed
+        Keyword arguments:
+        batch_size -- number of samples per batch
+        min_samples -- number of samples to hold before the first batch
+        """
+        self.wait(min_samples)
+        while True:
+            with self.condition:
+                if self.error is not None:
+                    raise Exception(self.error)
+                if self.done or self.held == 0:
+                    return
+                #Draw the batch from samples with the shape of a random held sample
+                shape = self.features[self.random_state.randint(0, self.held)].shape
+                candidates = [slot for slot in range(self.held) if self.features[slot].shape == shape]
+                sample_indices = np.sort(self.random_state.choice(candidates, min(batch_size, len(candidates)), replace=False))
+                #Copy the samples out, as held samples can be replaced at any time
+                features = np.stack([self.features[slot] for slot in sample_indices])
+                classes = self.classes[sample_indices]
+            labels = np.zeros((len(classes), len(self.labels)), dtype=np.float32)
+            labels[np.arange(len(classes)), classes] = 1.0
+            #Copy channels with a broadcast view rather than new memory
+            yield np.broadcast_to(features, (len(classes), 3) + shape[1:]), labels
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 from tkinter import *
 import time
 from tkinter.ttk import *
@@ -82,16 +83,23 @@ class LoadFilesScreen(Frame):
 
 
     def addFiles(self):
+        files = []
         for item in self.IMPORTFILES.get_children():
             file = self.IMPORTFILES.item(item)["text"]
             label = self.IMPORTFILES.item(item)["values"][0]
             if label == "":
             	label = "unlabeled"
             fullpath = self.IMPORTFILES.item(item)["values"][1]
-            self.parent.tc.add_training_file(label, fullpath)
+            files.append((label, fullpath))
+        #Import everything in one call
+        failures = self.parent.tc.add_training_files(files)
         self.parent.columns = self.parent.tc.get_csv_columns()
         self.parent.TransformDataScreen.refresh()
-        messagebox.showinfo("Success", "Successfully added files")
+        if failures:
+            messagebox.showerror("Error", "Failed to add {} file(s):\n{}".format(
+                len(failures), "\n".join("{}: {}".format(name, error) for name, error in sorted(failures.items())[:10])))
+        else:
+            messagebox.showinfo("Success", "Successfully added files")
     def __init__(self, parent):
         Frame.__init__(self, parent)
         self.parent = parent
@@ -186,8 +194,8 @@ class PickHeaders(Frame):
         #Create configuration for fft parameters
         #Label for method input
         method_label = Label(self, text="Method : ")
-        #Types of transforms that can be performed
-        methods = ["fft", "spectrogram", "nothing"]
+        #Types of transforms that can be performed, including any loaded from plugins
+        methods = list(timechange.transform.TRANSFORMS)
         #Get the default parameters
         transform_defaults = self.parent.tc.get_transform_parameters()
         #Used to store the chosen method
@@ -359,10 +367,15 @@ class Application(Frame):
         self.columns = []
         self.pack()
 
-root = Tk()
-app = Application(master=root)
-app.mainloop()
-try:
-    root.destroy()
-except:
-    print("root frame already destroyed!")
+def main():
+    """Opens the timechange window and runs it until it is closed"""
+    root = Tk()
+    app = Application(master=root)
+    app.mainloop()
+    try:
+        root.destroy()
+    except:
+        print("root frame already destroyed!")
+
+if __name__ == "__main__":
+    main()
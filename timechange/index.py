@@ -0,0 +1,273 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For reading and writing the index file
+import json
+#For hashing file contents
+import hashlib
+#For navigating filesystems
+import os
+from os import path
+#For copying files
+import shutil
+#For keeping index updates from different threads apart
+from threading import Lock
+
+#Name of the index file within a project folder
+INDEX_FILE_NAME = "index.json"
+#Name of the file recording the last transform run
+MANIFEST_FILE_NAME = "transform_manifest.json"
+#Folder within a project that stores the columnar caches of csv files
+CACHE_FOLDER = "cache"
+#Size of the blocks read when counting rows and hashing files
+COUNT_BUFFER_SIZE = 1 << 20
+#Guards read-modify-write cycles on index files
+index_lock = Lock()
+#ioctl request that clones a file's extents on Linux copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+def _reflink(source, destination):
+    """Makes destination a copy-on-write clone of source
+    raises OSError if the platform or filesystem doesn't support it"""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination)
+            raise
+
+def link_file(source, destination, link="auto"):
+    """Puts a file into a project without copying its data where the filesystem allows it
+    Keyword arguments:
+    source -- path of the file to import
+    destination -- path to import it to. An existing file is replaced
+    link -- "reflink" for a copy-on-write clone, "hardlink", "symlink", "copy",
+            or "auto" to try a reflink, then a hardlink, then fall back to a copy
+    Returns the method that was used, or None if the destination already is the source file"""
+    #Removing the destination would delete the only copy of a file that is already in place
+    if path.exists(destination) and path.samefile(source, destination):
+        return None
+    if path.lexists(destination):
+        os.remove(destination)
+    if link == "auto":
+        for method in ("reflink", "hardlink"):
+            try:
+                return link_file(source, destination, method)
+            except OSError:
+                pass
+        link = "copy"
+    if link == "reflink":
+        _reflink(source, destination)
+    elif link == "hardlink":
+        os.link(source, destination)
+    elif link == "symlink":
+        os.symlink(path.abspath(source), destination)
+    elif link == "copy":
+        shutil.copyfile(source, destination)
+    else:
+        raise Exception("Invalid link type")
+    return link
+
+def cache_path(project_path, label, csv_file_name):
+    """Returns the path of the columnar cache of a csv file
+    Keyword arguments:
+    project_path -- path to a timechange project
+    label -- the label the csv file is stored under
+    csv_file_name -- name of the csv file"""
+    return path.join(project_path, CACHE_FOLDER, label, "{}.npy".format(path.splitext(csv_file_name)[0]))
+
+def count_rows(file_path):
+    """Counts the data rows in a csv file, not including the header
+    Reads the file in large binary blocks and counts newlines, so no lines are decoded or stored
+    Keyword arguments:
+    file_path -- path to the csv file"""
+    num_lines = 0
+    last_byte = b"\n"
+    with open(file_path, "rb") as file_handle:
+        while True:
+            block = file_handle.read(COUNT_BUFFER_SIZE)
+            if not block:
+                break
+            num_lines += block.count(b"\n")
+            last_byte = block[-1:]
+    #Count a final line that has no trailing newline
+    if last_byte != b"\n":
+        num_lines += 1
+    #Don't count the header
+    return num_lines - 1
+
+def hash_file(file_path):
+    """Computes a hex digest of a file's contents
+    Keyword arguments:
+    file_path -- path to the file"""
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file_handle:
+        while True:
+            block = file_handle.read(COUNT_BUFFER_SIZE)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_info(file_path):
+    """Generates the index entry for a csv file
+    Keyword arguments:
+    file_path -- path to the csv file"""
+    #Stat before reading, so a file changed while it's counted doesn't look current afterwards
+    stat = os.stat(file_path)
+    return {"rows": count_rows(file_path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def is_current(info, stat):
+    """Returns whether an index entry still describes a csv file
+    A file edited in place can keep its size, so its modification time has to match too.
+    Entries from before modification times were recorded are never current
+    Keyword arguments:
+    info -- the file's index entry
+    stat -- os.stat result of the csv file"""
+    return info.get("size") == stat.st_size and info.get("mtime") == stat.st_mtime_ns
+
+def load_index(project_path):
+    """Loads the file index of a project
+    The index is a dict with a "files" entry mapping label -> csv filename -> file info
+    File info holds the row count, size and modification time of the file. Files with a columnar cache also
+    have their column names and a "cached" flag
+    An empty index is returned if the project does not have one yet
+    Keyword arguments:
+    project_path -- path to a timechange project"""
+    try:
+        with open(path.join(project_path, INDEX_FILE_NAME), "r") as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return {"files": {}}
+
+def _write_json(file_path, data):
+    """Writes data to a json file through a temporary file, so a crash never leaves a partial file behind"""
+    with open(file_path + ".tmp", "w") as json_file:
+        json.dump(data, json_file)
+    os.replace(file_path + ".tmp", file_path)
+
+def save_index(project_path, index):
+    """Writes the file index of a project
+    Keyword arguments:
+    project_path -- path to a timechange project
+    index -- the index to write"""
+    _write_json(path.join(project_path, INDEX_FILE_NAME), index)
+
+def update_index(project_path, added=None, removed=()):
+    """Adds and removes index entries with a single write
+    Keyword arguments:
+    project_path -- path to a timechange project
+    added -- dict mapping label -> csv filename -> file info to add or replace
+    removed -- iterable of (label, csv filename) pairs to remove"""
+    with index_lock:
+        index = load_index(project_path)
+        files = index.setdefault("files", {})
+        for label, entries in (added or {}).items():
+            files.setdefault(label, {}).update(entries)
+        for label, filename in removed:
+            files.get(label, {}).pop(filename, None)
+            #Drop labels that no longer have files
+            if label in files and not files[label]:
+                del files[label]
+        save_index(project_path, index)
+        return index
+
+def load_manifest(project_path):
+    """Loads the record of the last transform run
+    The manifest stores the transform parameters, the padding length and the size, modification time
+    and content hash of every csv file that was converted
+    Returns None if the project has not been transformed since manifests were introduced
+    Keyword arguments:
+    project_path -- path to a timechange project"""
+    try:
+        with open(path.join(project_path, MANIFEST_FILE_NAME), "r") as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+def save_manifest(project_path, manifest):
+    """Writes the record of a transform run
+    Keyword arguments:
+    project_path -- path to a timechange project
+    manifest -- the manifest to write"""
+    _write_json(path.join(project_path, MANIFEST_FILE_NAME), manifest)
+
+def rebuild_index(project_path):
+    """Brings the file index in line with the csv files on disk and checks them against the transform manifest
+    Files missing from the index or changed since they were indexed are recounted and entries of
+    removed files are dropped, along with any columnar caches that no longer match
+    Keyword arguments:
+    project_path -- path to a timechange project
+    Returns a dict counting the index entries that were added, removed and updated, the csv files
+    that weren't transformed or changed since ("untransformed") and the transformed files whose png
+    is missing ("missing_images")"""
+    summary = {"added": 0, "removed": 0, "updated": 0, "untransformed": 0, "missing_images": 0}
+    with index_lock:
+        index = load_index(project_path)
+        #Entries left in here after the scan belong to removed csv files
+        old_files = index.get("files", {})
+        files = {}
+        for label in os.scandir(path.join(project_path, "csv")):
+            if not label.is_dir():
+                continue
+            for csv_file in os.scandir(label.path):
+                info = old_files.get(label.name, {}).pop(csv_file.name, None)
+                if info is None:
+                    info = file_info(csv_file.path)
+                    summary["added"] += 1
+                elif not is_current(info, csv_file.stat()):
+                    if info.get("cached") and path.exists(cache_path(project_path, label.name, csv_file.name)):
+                        os.remove(cache_path(project_path, label.name, csv_file.name))
+                    info = file_info(csv_file.path)
+                    summary["updated"] += 1
+                files.setdefault(label.name, {})[csv_file.name] = info
+        for label, entries in old_files.items():
+            for csv_file_name, info in entries.items():
+                if info.get("cached") and path.exists(cache_path(project_path, label, csv_file_name)):
+                    os.remove(cache_path(project_path, label, csv_file_name))
+                summary["removed"] += 1
+        index["files"] = files
+        save_index(project_path, index)
+    #Check the state of the transformed data
+    manifest = load_manifest(project_path) or {"files": {}}
+    write_png = "png" in (manifest.get("parameters") or {}).get("output", ["png"])
+    for label, entries in files.items():
+        for csv_file_name, info in entries.items():
+            entry = manifest["files"].get(label, {}).get(csv_file_name)
+            if entry is None or entry["size"] != info["size"]:
+                summary["untransformed"] += 1
+            elif write_png and not path.exists(path.join(project_path, "images", label,
+                                                         "{}.png".format(path.splitext(csv_file_name)[0]))):
+                summary["missing_images"] += 1
+    return summary
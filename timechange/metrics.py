@@ -0,0 +1,158 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For writing metrics files
+import json
+#For timing stages
+import time
+from contextlib import contextmanager
+#For keeping updates from different threads apart
+from threading import Lock
+
+#Least number of seconds between two progress events of a job
+PROGRESS_INTERVAL = 1.0
+
+class StageTimer:
+    """Per-stage timers and counters
+    Stages add up the time spent on one step of a job, like reading csv files or encoding pngs.
+    Counters add up amounts, like the number of files or bytes read.
+    Used on its own where events can't be sent, like conversions in worker processes,
+    and merged into a Metrics object afterwards"""
+    def __init__(self):
+        """Constructor"""
+        #Maps stage -> [total seconds, count]
+        self.stages = {}
+        #Maps counter -> total
+        self.counters = {}
+    @contextmanager
+    def time(self, stage):
+        """Context manager that adds the time spent inside it to a stage
+        Keyword arguments:
+        stage -- name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+    def add_time(self, stage, seconds, count=1):
+        """Adds time to a stage
+        Keyword arguments:
+        stage -- name of the stage
+        seconds -- seconds spent on the stage
+        count -- number of times the stage ran in that time
+        """
+        totals = self.stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += count
+    def count(self, counter, amount=1):
+        """Adds to a counter
+        Keyword arguments:
+        counter -- name of the counter
+        amount -- amount to add
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+    def stats(self):
+        """Returns the totals as a picklable dict for Metrics.merge"""
+        return {"stages": self.stages, "counters": self.counters}
+
+class Metrics(StageTimer):
+    """Stage timers and counters of a worker job, reported as progress events
+    Events have the form
+        {"type": "progress", "job": name, "id": job id, "elapsed": seconds since the job started,
+         "stages": {stage: {"seconds": total seconds, "count": times run}},
+         "counters": {counter: total}, "rates": {counter: total per second}, "done": bool}
+    plus any extra values passed to emit. They are put on the result queue and appended to a
+    JSON lines file if one is given. Safe to update from several threads"""
+    def __init__(self, job, job_id=None, output_queue=None, metrics_path=None, interval=PROGRESS_INTERVAL):
+        """Constructor
+        Keyword arguments:
+        job -- name of the job, such as transform
+        job_id -- id of the job
+        output_queue -- queue to send progress events on, or None
+        metrics_path -- path of a file to append progress events to, or None
+        interval -- least number of seconds between two progress events, unless forced
+        """
+        StageTimer.__init__(self)
+        self.job = job
+        self.job_id = job_id
+        self.output_queue = output_queue
+        self.metrics_path = metrics_path
+        self.interval = interval
+        self.start = time.perf_counter()
+        #Time of the last progress event
+        self.last_emit = None
+        self.lock = Lock()
+    def add_time(self, stage, seconds, count=1):
+        with self.lock:
+            StageTimer.add_time(self, stage, seconds, count)
+    def count(self, counter, amount=1):
+        with self.lock:
+            StageTimer.count(self, counter, amount)
+    def merge(self, stats):
+        """Adds totals gathered by a StageTimer
+        Keyword arguments:
+        stats -- dict from StageTimer.stats
+        """
+        for stage, (seconds, count) in stats["stages"].items():
+            self.add_time(stage, seconds, count)
+        for counter, amount in stats["counters"].items():
+            self.count(counter, amount)
+    def snapshot(self, done=False, **extra):
+        """Builds a progress event from the current totals
+        Keyword arguments:
+        done -- whether the job has finished
+        extra -- other values to include in the event
+        Returns the event dict"""
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            event = {"type": "progress", "job": self.job, "id": self.job_id, "elapsed": elapsed,
+                     "stages": {stage: {"seconds": seconds, "count": count} for stage, (seconds, count) in self.stages.items()},
+                     "counters": dict(self.counters),
+                     "rates": {counter: amount / elapsed for counter, amount in self.counters.items()} if elapsed > 0 else {},
+                     "done": done}
+        event.update(extra)
+        return event
+    def emit(self, force=False, done=False, **extra):
+        """Sends a progress event, at most once per interval unless forced
+        Keyword arguments:
+        force -- send the event even if one was sent less than interval seconds ago
+        done -- whether the job has finished. Finished events are always sent
+        extra -- other values to include in the event
+        """
+        now = time.perf_counter()
+        if not (force or done) and self.last_emit is not None and now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+        event = self.snapshot(done, **extra)
+        if self.output_queue is not None:
+            self.output_queue.put(event)
+        if self.metrics_path is not None:
+            with self.lock, open(self.metrics_path, "a") as metrics_file:
+                metrics_file.write(json.dumps(dict(event, time=time.time())) + "\n")
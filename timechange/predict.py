@@ -0,0 +1,202 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For navigating filesystems
+import os
+from os import path
+#For handling time series data
+import numpy as np
+#For transforming inputs the way the training data was
+from . import transform
+from . import worker
+from . import index
+from . import dataset
+#For timing prediction stages
+from .metrics import StageTimer
+
+#Name of the weights file within the project's models folder
+WEIGHTS_FILE_NAME = "latest.h5"
+#Most inputs to transform and run through the model at once
+PREDICT_BATCH_SIZE = 256
+
+def class_labels(project_path):
+    """Finds the labels of a project's transformed data, in the order of the model's outputs
+    Keyword arguments:
+    project_path -- path to a timechange project"""
+    manifest = index.load_manifest(project_path)
+    if manifest is not None and manifest.get("tensors") is not None:
+        return sorted(set(label for _, _, labels in dataset.tensor_buckets(manifest["tensors"]) for label in labels))
+    return sorted(label.name for label in os.scandir(path.join(project_path, "images")) if label.is_dir())
+
+class Predictor:
+    """Classifies time series with a project's trained model
+    The model is built and its weights are loaded once, when the predictor is created.
+    Inputs are transformed in memory with the parameters of the project's last transform run,
+    and encoded the way the model saw them during training"""
+    def __init__(self, project_path):
+        """Constructor
+        raises Exception if the project hasn't been transformed or has no saved weights
+        Keyword arguments:
+        project_path -- path to a timechange project
+        """
+        self.project_path = project_path
+        manifest = index.load_manifest(project_path)
+        if manifest is None or "parameters" not in manifest:
+            raise Exception("The data has not been transformed. Please transform the data and train a model first")
+        self.weights_path = path.join(project_path, "models", WEIGHTS_FILE_NAME)
+        if not path.exists(self.weights_path):
+            raise Exception("There are no saved weights. Please train a model first")
+        parameters = manifest["parameters"]
+        self.columns = parameters["columns"]
+        self.method = parameters["method"]
+        self.max_length = manifest["max_length"]
+        #Inputs are brought to the lengths the training files were, see worker.length_targets
+        self.length_policy = parameters.get("length_policy", "max")
+        self.lengths = manifest.get("lengths", [self.max_length])
+        #Keyword arguments for transform.extract_batch, as convert_all_csv passes them
+        transform.load_plugins(parameters.get("plugins", []))
+        self.options = worker.extract_options(parameters)
+        #Models trained on pngs saw features rounded to 8 bits
+        self.quantize = manifest.get("tensors") is None
+        self.labels = class_labels(project_path)
+        self.num_classes, self.input_shape = worker.get_data_shape(project_path)
+        #Record which weights were loaded, so callers can tell when they are out of date
+        self.weights_mtime = os.stat(self.weights_path).st_mtime_ns
+        self.model = worker.build_model(project_path, (self.num_classes, self.input_shape))
+        self.model.load_weights(self.weights_path)
+    def is_current(self):
+        """Returns whether the loaded weights are still the project's latest ones"""
+        try:
+            return os.stat(self.weights_path).st_mtime_ns == self.weights_mtime
+        except FileNotFoundError as _:
+            return False
+    def read(self, data):
+        """Reads a single input into an array of shape (channels, samples)
+        Safe to call from any thread
+        Keyword arguments:
+        data -- path to a csv file or file object with csv text,
+                or an array of shape (samples, columns) or (samples,) holding the selected columns
+        """
+        if isinstance(data, str) or hasattr(data, "read"):
+            series = worker.read_csv(data, self.columns)
+        else:
+            series = np.asarray(data, dtype=np.float64)
+            if series.ndim == 1:
+                series = series[:, np.newaxis]
+            if series.ndim != 2:
+                raise Exception("Arrays to predict must have the shape (samples, columns)")
+            series = series.T
+            if self.columns is not None and series.shape[0] != len(self.columns):
+                raise Exception("Inputs must have {} columns, one for each of {}".format(len(self.columns), ", ".join(self.columns)))
+        if self.length_policy == "max" and series.shape[1] > self.max_length:
+            raise Exception("Inputs can't have more rows than the longest training file ({})".format(self.max_length))
+        return series
+    def features(self, inputs):
+        """Transforms inputs into model inputs
+        raises Exception if inputs in different length buckets make features of different sizes
+        Keyword arguments:
+        inputs -- list of csv file paths or arrays, see read
+        Returns a float32 array of shape (inputs, channels, height, width)"""
+        series = [self.read(data) for data in inputs]
+        features = None
+        for positions, group_features in self._features(series):
+            if features is None:
+                features = np.empty((len(series),) + group_features.shape[1:], dtype=np.float32)
+            elif group_features.shape[1:] != features.shape[1:]:
+                raise Exception("Inputs of different lengths make features of different sizes. Please use predict instead")
+            features[positions] = group_features
+        if features is None:
+            return np.empty((0,) + tuple(size or 0 for size in self.input_shape), dtype=np.float32)
+        return features
+    def _features(self, series):
+        """Transforms inputs already read with read into model inputs
+        Inputs with the same number of channels and target length are transformed together
+        Keyword arguments:
+        series -- list of arrays of shape (channels, samples)
+        Returns a list with (positions, features) for every group of inputs transformed together,
+        where features is a float32 array of shape (inputs in the group, channels, height, width)"""
+        series = list(series)
+        #Maps (number of channels, length) -> positions of the inputs
+        groups = {}
+        for position, data in enumerate(series):
+            length = worker.target_length(data.shape[1], self.lengths)
+            if self.length_policy != "max":
+                series[position] = worker.fit_length(data, length, self.length_policy)
+            groups.setdefault((data.shape[0], length), []).append(position)
+        results = []
+        for (num_channels, length), positions in groups.items():
+            batch = np.zeros((len(positions), num_channels, length), dtype=self.options["dtype"])
+            for row, position in enumerate(positions):
+                batch[row, :, :series[position].shape[1]] = series[position]
+            #Drop the single channel axis
+            group_features = transform.extract_batch(batch, self.method, channels=1, **self.options)[..., 0]
+            if self.quantize:
+                #Round like save_image does, then scale back like the png loader does
+                group_features = (group_features * 255).astype(np.uint8).astype(np.float32)
+                group_features *= 1.0 / 255.0
+            else:
+                group_features = group_features.astype(np.float32, copy=False)
+            results.append((positions, np.broadcast_to(group_features[:, np.newaxis],
+                                                       (len(positions), 3) + group_features.shape[1:])))
+        return results
+    def predict(self, inputs, batch_size=PREDICT_BATCH_SIZE):
+        """Classifies inputs
+        Keyword arguments:
+        inputs -- a csv file path or array, or a list of them, see read
+        batch_size -- most inputs to transform and run through the model at once
+        Returns an array of shape (inputs, classes) of class probabilities, in the order of labels"""
+        if isinstance(inputs, str) or (isinstance(inputs, np.ndarray) and inputs.ndim <= 2):
+            inputs = [inputs]
+        return self._predict(list(inputs), batch_size, self.read, StageTimer())
+    def predict_series(self, series, batch_size=PREDICT_BATCH_SIZE, timer=None):
+        """Classifies inputs already read with read
+        Keyword arguments:
+        series -- list of arrays of shape (channels, samples)
+        batch_size -- most inputs to transform and run through the model at once
+        timer -- StageTimer to add the time spent transforming and predicting to, or None
+        Returns an array of shape (inputs, classes) of class probabilities, in the order of labels"""
+        return self._predict(list(series), batch_size, None, timer if timer is not None else StageTimer())
+    def _predict(self, inputs, batch_size, read, timer):
+        """Classifies inputs in chunks of batch_size, reading each chunk with read if it isn't None"""
+        probabilities = np.empty((len(inputs), self.num_classes), dtype=np.float32)
+        #Keep the padded batches to a bounded size
+        batch_size = max(1, min(batch_size, worker.BATCH_SAMPLES // max(1, max(self.lengths))))
+        for start in range(0, len(inputs), batch_size):
+            series = inputs[start:start + batch_size]
+            if read is not None:
+                with timer.time("read"):
+                    series = [read(data) for data in series]
+            with timer.time("transform"):
+                groups = [(positions, np.ascontiguousarray(features)) for positions, features in self._features(series)]
+            with timer.time("predict"):
+                #Each group has its own feature size
+                for positions, features in groups:
+                    probabilities[start + np.array(positions)] = self.model.predict(features, batch_size=len(features))
+            timer.count("inputs", len(series))
+        return probabilities
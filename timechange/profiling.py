@@ -0,0 +1,129 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For profiling the thread a job runs on
+import cProfile
+import pstats
+#For sampling stacks
+import sys
+import time
+from threading import Event, Thread, get_ident
+#For navigating filesystems
+import os
+from os import path
+
+#Folder within a project that stores profiles
+PROFILE_FOLDER = "profiles"
+#Seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+#Number of hot functions to report
+TOP_FUNCTIONS = 10
+
+class JobProfiler:
+    """Profiles the thread it is started on
+    Function times are recorded with cProfile and saved as a .pstats file. The thread's stack is also
+    sampled at a fixed interval and saved as collapsed stacks, one "frame;frame;frame count" line per
+    distinct stack, which flame graph tools read directly.
+    Only the starting thread is profiled, so conversions running in worker processes (jobs > 1) show up
+    as time spent waiting on them. Use jobs=1 to profile the conversions themselves.
+    Python 3.12 and later allow one cProfile profiler at a time. Jobs profiled while another one is,
+    like the two halves of a pipeline, only get the stack samples"""
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """Constructor
+        Keyword arguments:
+        interval -- seconds between two stack samples
+        """
+        self.interval = interval
+        #Set to None if cProfile can't be used
+        self.profile = cProfile.Profile()
+        #Maps collapsed stack -> number of samples
+        self.stacks = {}
+        self.stopped = Event()
+        self.sampler = None
+    def start(self):
+        """Starts profiling the calling thread"""
+        try:
+            self.profile.enable()
+        except ValueError as _:
+            #Another profiler is active
+            self.profile = None
+        self.sampler = Thread(target=self._sample, name="profiler", args=(get_ident(),), daemon=True)
+        self.sampler.start()
+    def stop(self):
+        """Stops profiling. Must be called from the thread profiling was started on"""
+        if self.profile is not None:
+            self.profile.disable()
+        self.stopped.set()
+        self.sampler.join()
+    def _sample(self, thread_id):
+        """Samples a thread's stack until stop is called
+        Keyword arguments:
+        thread_id -- ident of the thread to sample
+        """
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append("{} ({}:{})".format(code.co_name, path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if frames:
+                stack = ";".join(reversed(frames))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+    def top(self, count=TOP_FUNCTIONS):
+        """Finds the functions that took the most time, not counting the functions they called
+        Keyword arguments:
+        count -- number of functions to return
+        Returns a list of dicts with the function, its number of calls, and its total and cumulative seconds.
+        Empty if only stacks were sampled"""
+        if self.profile is None:
+            return []
+        stats = pstats.Stats(self.profile)
+        hot = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:count]
+        return [{"function": "{}:{}({})".format(filename, line, name), "calls": calls,
+                 "total_time": total_time, "cumulative_time": cumulative_time}
+                for (filename, line, name), (_, calls, total_time, cumulative_time, _) in hot]
+    def save(self, project_path, name):
+        """Saves the profile into the project's profile folder
+        Keyword arguments:
+        project_path -- path to a timechange project
+        name -- name to start the file names with, such as the job's name and id
+        Returns a dict with the path of the .pstats file, the path of the collapsed stacks file and the top functions.
+        The .pstats path is None if only stacks were sampled"""
+        folder = path.join(project_path, PROFILE_FOLDER)
+        os.makedirs(folder, exist_ok=True)
+        base_path = path.join(folder, "{}-{}".format(name, time.strftime("%Y%m%d-%H%M%S")))
+        pstats_path = None
+        if self.profile is not None:
+            pstats_path = base_path + ".pstats"
+            self.profile.dump_stats(pstats_path)
+        with open(base_path + ".collapsed.txt", "w") as collapsed_file:
+            for stack, samples in sorted(self.stacks.items()):
+                collapsed_file.write("{} {}\n".format(stack, samples))
+        return {"pstats": pstats_path, "collapsed": base_path + ".collapsed.txt", "top": self.top()}
@@ -0,0 +1,362 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For the command line
+import argparse
+import sys
+#For reading csv payloads
+import io
+#For request and response bodies
+import json
+#For timing requests
+import time
+#For serving over HTTP or a Unix socket
+import os
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+#For handing requests to the batching thread
+from collections import deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Event, Lock, Thread
+#For latency percentiles
+import numpy as np
+from . import predict
+from .metrics import StageTimer
+
+#Port to listen on when neither a port nor a socket is given
+DEFAULT_PORT = 8765
+#Most inputs run through the model in one batch
+MAX_BATCH_SIZE = 64
+#Longest time in milliseconds a request waits for others to join its batch
+MAX_LATENCY_MS = 5.0
+#Number of recent requests latency percentiles are computed over
+LATENCY_WINDOW = 10000
+#Largest request body accepted, in bytes
+MAX_BODY_SIZE = 64 << 20
+
+class ServerStats:
+    """Latency and throughput counters of a prediction server
+    Safe to update from several threads"""
+    def __init__(self, window=LATENCY_WINDOW):
+        """Constructor
+        Keyword arguments:
+        window -- number of recent requests latency percentiles are computed over
+        """
+        self.start = time.perf_counter()
+        #Seconds from arrival to response of recent requests
+        self.latencies = deque(maxlen=window)
+        #Time spent reading, transforming and predicting, and counts of requests, inputs and batches
+        self.timer = StageTimer()
+        self.lock = Lock()
+    def record_request(self, latency, num_inputs, failed=False):
+        """Records a finished request
+        Keyword arguments:
+        latency -- seconds from the request's arrival to its response
+        num_inputs -- number of inputs in the request
+        failed -- whether the request failed
+        """
+        with self.lock:
+            self.latencies.append(latency)
+            self.timer.count("requests")
+            if failed:
+                self.timer.count("errors")
+            else:
+                self.timer.count("inputs", num_inputs)
+    def record_batch(self, num_inputs, timer):
+        """Records a batch run through the model
+        Keyword arguments:
+        num_inputs -- number of inputs in the batch
+        timer -- StageTimer with the time spent on the batch
+        """
+        with self.lock:
+            self.timer.count("batches")
+            self.timer.count("batched_inputs", num_inputs)
+            for stage, (seconds, count) in timer.stages.items():
+                self.timer.add_time(stage, seconds, count)
+    def snapshot(self):
+        """Returns the current counters as a JSON serializable dict"""
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            latencies = np.array(self.latencies)
+            counters = dict(self.timer.counters)
+            stages = {stage: {"seconds": seconds, "count": count} for stage, (seconds, count) in self.timer.stages.items()}
+        percentiles = {}
+        if len(latencies) > 0:
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            percentiles = {"p50_ms": p50, "p99_ms": p99, "max_ms": latencies.max() * 1000}
+        batches = counters.get("batches", 0)
+        return {"elapsed": elapsed,
+                "requests": counters.get("requests", 0),
+                "inputs": counters.get("inputs", 0),
+                "errors": counters.get("errors", 0),
+                "batches": batches,
+                "mean_batch_size": counters.get("batched_inputs", 0) / batches if batches else 0.0,
+                "requests_per_second": counters.get("requests", 0) / elapsed if elapsed > 0 else 0.0,
+                "inputs_per_second": counters.get("inputs", 0) / elapsed if elapsed > 0 else 0.0,
+                "latency": percentiles,
+                "stages": stages}
+
+class MicroBatcher:
+    """Groups concurrent prediction requests into batches for the model
+    A single thread owns the model. It takes the oldest waiting request and adds later ones to its batch
+    until the batch holds max_batch_size inputs or the oldest request has waited max_latency seconds"""
+    def __init__(self, project_path, max_batch_size=MAX_BATCH_SIZE, max_latency=MAX_LATENCY_MS / 1000, stats=None):
+        """Constructor
+        Starts the batching thread and waits for it to load the model
+        raises Exception if the model can't be loaded
+        Keyword arguments:
+        project_path -- path to a timechange project with a trained model
+        max_batch_size -- most inputs run through the model in one batch
+        max_latency -- longest time in seconds a request waits for others to join its batch
+        stats -- ServerStats to record batches in, or None
+        """
+        self.project_path = project_path
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.stats = stats if stats is not None else ServerStats()
+        #Holds (arrival time, inputs, future) tuples
+        self.requests = Queue()
+        self.predictor = None
+        self.load_error = None
+        self.ready = Event()
+        self.stopped = Event()
+        #The model is loaded and used on the batching thread only
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.load_error is not None:
+            raise self.load_error
+    def submit(self, series, arrival=None):
+        """Queues inputs for prediction
+        Keyword arguments:
+        series -- list of arrays of shape (channels, samples), read with predictor.read
+        arrival -- perf_counter time the request arrived at, or None for now
+        Returns a Future for an array of shape (inputs, classes) of class probabilities"""
+        future = Future()
+        if self.stopped.is_set():
+            future.set_exception(Exception("The prediction server is shutting down"))
+        else:
+            self.requests.put((arrival if arrival is not None else time.perf_counter(), series, future))
+        return future
+    def close(self):
+        """Stops the batching thread once the waiting requests are done"""
+        self.stopped.set()
+        self.thread.join()
+    def _run(self):
+        """Body of the batching thread"""
+        try:
+            self.predictor = predict.Predictor(self.project_path)
+        except Exception as error:
+            self.load_error = error
+            self.stopped.set()
+            return
+        finally:
+            self.ready.set()
+        while not (self.stopped.is_set() and self.requests.empty()):
+            try:
+                first = self.requests.get(timeout=0.1)
+            except Empty as _:
+                continue
+            batch = [first]
+            num_inputs = len(first[1])
+            deadline = first[0] + self.max_latency
+            while num_inputs < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    request = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get_nowait()
+                except Empty as _:
+                    break
+                batch.append(request)
+                num_inputs += len(request[1])
+            self._predict(batch, num_inputs)
+    def _predict(self, batch, num_inputs):
+        """Runs a batch of requests through the model and resolves their futures"""
+        try:
+            #Pick up weights saved by training since the last batch
+            if not self.predictor.is_current():
+                self.predictor = predict.Predictor(self.project_path)
+            timer = StageTimer()
+            probabilities = self.predictor.predict_series([series for _, request, _ in batch for series in request],
+                                                          batch_size=max(num_inputs, 1), timer=timer)
+        except Exception as error:
+            if len(batch) > 1:
+                #Retry the requests one at a time, so only the ones causing trouble fail
+                for request in batch:
+                    self._predict([request], len(request[1]))
+                return
+            batch[0][2].set_exception(error)
+            return
+        self.stats.record_batch(num_inputs, timer)
+        start = 0
+        for _, series, future in batch:
+            future.set_result(probabilities[start:start + len(series)])
+            start += len(series)
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """Handles prediction server requests
+        POST /predict with a JSON body {"inputs": [array, ...]} or {"input": array}, where each array
+            has the shape (samples, columns) or (samples,) and holds the columns used for training,
+            or with a text/csv body holding a single csv file
+            Responds with {"labels": [...], "probabilities": [[...], ...], "predictions": [label, ...]}
+        GET /stats responds with ServerStats.snapshot()
+        GET /health responds with the project and its labels
+    Errors are sent as {"error": message}"""
+    #Set on the server class by make_server
+    batcher = None
+    stats = None
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send(200, self.stats.snapshot())
+        elif self.path == "/health":
+            predictor = self.batcher.predictor
+            self._send(200, {"status": "ok", "project": predictor.project_path, "labels": predictor.labels})
+        else:
+            self._send(404, {"error": "Unknown path {}".format(self.path)})
+    def do_POST(self):
+        arrival = time.perf_counter()
+        if self.path != "/predict":
+            self._send(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        series = []
+        try:
+            series = self._read_inputs()
+            probabilities = self.batcher.submit(series, arrival).result()
+        except Exception as error:
+            self.stats.record_request(time.perf_counter() - arrival, len(series), failed=True)
+            self._send(400, {"error": str(error)})
+            return
+        labels = self.batcher.predictor.labels
+        self.stats.record_request(time.perf_counter() - arrival, len(series))
+        self._send(200, {"labels": labels,
+                         "probabilities": probabilities.tolist(),
+                         "predictions": [labels[i] for i in probabilities.argmax(axis=1)]})
+    def _read_inputs(self):
+        """Reads the inputs of a prediction request
+        Returns a list of arrays of shape (channels, samples)"""
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0:
+            raise Exception("The request has no body")
+        if length > MAX_BODY_SIZE:
+            raise Exception("The request body is larger than {} bytes".format(MAX_BODY_SIZE))
+        body = self.rfile.read(length)
+        predictor = self.batcher.predictor
+        if self.headers.get("Content-Type", "").split(";")[0].strip() == "text/csv":
+            return [predictor.read(io.BytesIO(body))]
+        payload = json.loads(body.decode("utf-8"))
+        if "inputs" in payload:
+            inputs = payload["inputs"]
+        elif "input" in payload:
+            inputs = [payload["input"]]
+        else:
+            raise Exception("The request body needs an \"inputs\" or \"input\" field")
+        if len(inputs) == 0:
+            raise Exception("There are no inputs to predict")
+        return [predictor.read(data) for data in inputs]
+    def _send(self, status, body):
+        """Sends a JSON response"""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    def address_string(self):
+        #Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+    def log_message(self, format, *args):
+        #Requests are counted in the stats instead of logged
+        pass
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket"""
+    daemon_threads = True
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        #BaseHTTPRequestHandler expects these
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def make_server(project_path, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None,
+                max_batch_size=MAX_BATCH_SIZE, max_latency=MAX_LATENCY_MS / 1000):
+    """Loads a project's model and creates a prediction server for it
+    raises Exception if the model can't be loaded
+    Keyword arguments:
+    project_path -- path to a timechange project with a trained model
+    host -- address to listen on
+    port -- port to listen on, or 0 for any free port
+    socket_path -- path of a Unix socket to listen on instead of host and port, or None
+    max_batch_size -- most inputs run through the model in one batch
+    max_latency -- longest time in seconds a request waits for others to join its batch
+    Returns a server with serve_forever, shutdown and server_close methods and a batcher attribute,
+    which should be closed after the server"""
+    stats = ServerStats()
+    batcher = MicroBatcher(project_path, max_batch_size, max_latency, stats)
+    handler = type("ProjectPredictionHandler", (PredictionHandler,), {"batcher": batcher, "stats": stats})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, handler)
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+    server.batcher = batcher
+    return server
+
+def main(argv=None):
+    """Runs a prediction server from the command line
+    Keyword arguments:
+    argv -- command line arguments after "serve", or None to use sys.argv
+    """
+    parser = argparse.ArgumentParser(prog="python -m timechange serve",
+                                     description="Serves predictions from a timechange project's trained model")
+    parser.add_argument("project", help="path to the timechange project")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--socket", help="path of a Unix socket to listen on instead of a port")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE,
+                        help="most inputs run through the model in one batch")
+    parser.add_argument("--max-latency", type=float, default=MAX_LATENCY_MS,
+                        help="longest time in milliseconds a request waits for others to join its batch")
+    args = parser.parse_args(argv)
+    server = make_server(os.path.abspath(args.project), args.host, args.port, args.socket,
+                         max(1, args.max_batch_size), max(0.0, args.max_latency) / 1000)
+    if args.socket is not None:
+        print("Serving {} on {}".format(args.project, args.socket))
+    else:
+        print("Serving {} on http://{}:{}".format(args.project, *server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt as _:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
@@ -0,0 +1,187 @@
+"""Copyright 2017
+Steven Sheffey <stevensheffey4@gmail.com>,
+John Ford,
+Eyasu Asrat,
+Jordan Flowers,
+Joseph Volmer,
+Luke Stanley,
+Serenah Smith, and
+Chandu Budati
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+#For navigating filesystems
+import os
+from os import path
+#For writing files in parallel
+from concurrent.futures import ProcessPoolExecutor
+#For generating waves
+import numpy as np
+#For adding generated files to a project's index
+from . import index
+
+"""Wave parameters. Each wave gets a random amplitude, frequency and shift per channel
+"""
+#Range the waves are sampled over
+LEFT_BOUND = 0.0
+RIGHT_BOUND = 100.0
+AMPLITUDE_MIN = -5.0
+AMPLITUDE_MAX = 5.0
+FREQUENCY_MIN = -100.0
+FREQUENCY_MAX = 100.0
+SHIFT_MIN = -10.0
+SHIFT_MAX = 10.0
+#Types of waves that can be generated
+WAVE_TYPES = ("sine", "square", "sawtooth", "noise")
+#Most values to generate at once in a single process
+CHUNK_VALUES = 1 << 23
+#Most files to write per task
+CHUNK_FILES = 1024
+
+def generate(wave_type, lengths, channels=3, random_state=None):
+    """Generates a batch of random waves at once
+    Keyword arguments:
+    wave_type -- one of WAVE_TYPES
+    lengths -- number of rows of each wave
+    channels -- number of channels of each wave, each with its own parameters
+    random_state -- numpy RandomState to draw the parameters from
+    Returns an array of shape (number of waves, channels, longest length)
+    Rows past the end of a shorter wave are zero"""
+    if wave_type not in WAVE_TYPES:
+        raise Exception("Invalid wave type")
+    if random_state is None:
+        random_state = np.random.RandomState()
+    lengths = np.asarray(lengths, dtype=np.int64)
+    shape = (len(lengths), channels, 1)
+    amplitude = random_state.uniform(AMPLITUDE_MIN, AMPLITUDE_MAX, shape)
+    max_length = int(lengths.max()) if len(lengths) else 0
+    if wave_type == "noise":
+        waves = amplitude * random_state.standard_normal((len(lengths), channels, max_length))
+    else:
+        frequency = random_state.uniform(FREQUENCY_MIN, FREQUENCY_MAX, shape)
+        shift = random_state.uniform(SHIFT_MIN, SHIFT_MAX, shape)
+        #Every wave spans the whole range, so its step depends on its length
+        step = (RIGHT_BOUND - LEFT_BOUND) / np.maximum(lengths - 1, 1)
+        wave_space = LEFT_BOUND + np.arange(max_length) * step[:, np.newaxis, np.newaxis]
+        #Apply the random changes to the wave
+        wave_space = frequency * (wave_space - shift)
+        if wave_type == "sine":
+            waves = amplitude * np.sin(wave_space)
+        else:
+            #Position within each period, from 0 to 2 pi
+            phase = np.mod(wave_space, 2 * np.pi)
+            if wave_type == "square":
+                waves = amplitude * np.where(phase < np.pi, 1.0, -1.0)
+            else:
+                waves = amplitude * (phase / np.pi - 1.0)
+    #Zero the rows past the end of each wave
+    waves *= np.arange(max_length) < lengths[:, np.newaxis, np.newaxis]
+    return waves
+
+def _write_chunk(task):
+    """Generates and writes a chunk of csv files in one process
+    Keyword arguments:
+    task -- tuple of (folder, label, wave type, file names, minimum rows, maximum rows, channels, seed,
+            decimals, cache folder). Columnar caches are written to the cache folder unless it is None
+    Returns a dict mapping file name -> index entry"""
+    folder, label, wave_type, names, min_rows, max_rows, channels, seed, decimals, cache_folder = task
+    random_state = np.random.RandomState(seed)
+    lengths = random_state.randint(min_rows, max_rows + 1, len(names))
+    #Round so the text holds the values exactly and parses back to the same floats
+    waves = np.round(generate(wave_type, lengths, channels, random_state), decimals)
+    column_names = [str(column) for column in range(channels)]
+    header = ",".join(column_names) + "\n"
+    row_format = ",".join(["%.{}f".format(decimals)] * channels) + "\n"
+    entries = {}
+    for name, length, wave in zip(names, lengths, waves):
+        wave = wave[:, :length]
+        text = header + (row_format * int(length)) % tuple(wave.T.ravel())
+        with open(path.join(folder, label, name), "w", newline="") as csv_file:
+            csv_file.write(text)
+        entry = {"rows": int(length), "size": len(text), "mtime": os.stat(path.join(folder, label, name)).st_mtime_ns}
+        if cache_folder is not None:
+            #Same layout as worker.cache_csv
+            cache_file = path.join(cache_folder, label, "{}.npy".format(path.splitext(name)[0]))
+            np.save(cache_file, np.ascontiguousarray(wave, dtype=np.float64))
+            entry.update(columns=column_names, cached=True)
+        entries[name] = entry
+    return entries
+
+def write_files(folder, num_files, wave_types=("sine", "square", "sawtooth"), min_rows=100, max_rows=1000,
+                channels=3, seed=None, jobs=None, decimals=6, cache_folder=None):
+    """Writes a synthetic data set of csv files, with a subfolder per wave type
+    Files are generated in chunks with vectorized numpy and written by a pool of processes.
+    The same seed always gives the same files, no matter how many processes are used.
+    Keyword arguments:
+    folder -- folder to write the label subfolders into
+    num_files -- number of files per wave type
+    wave_types -- wave types to generate, each becoming a label. See WAVE_TYPES
+    min_rows -- fewest rows per file
+    max_rows -- most rows per file
+    channels -- number of columns per file
+    seed -- seed for the random waves
+    jobs -- number of processes to write files with. Values less than 1 or None use one per cpu
+    decimals -- number of decimals to write values with
+    cache_folder -- folder to write columnar caches into, with a subfolder per label, or None for no caches
+    Returns a dict mapping label -> file name -> index entry"""
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31)
+    #Pick a chunk size that keeps every chunk's waves at a bounded size
+    chunk_size = max(1, min(CHUNK_FILES, CHUNK_VALUES // (channels * max_rows)))
+    name_format = "SAMPLE_{:0" + str(max(5, len(str(num_files - 1)))) + "d}.csv"
+    tasks = []
+    for label_number, wave_type in enumerate(wave_types):
+        os.makedirs(path.join(folder, wave_type), exist_ok=True)
+        if cache_folder is not None:
+            os.makedirs(path.join(cache_folder, wave_type), exist_ok=True)
+        for chunk_number, start in enumerate(range(0, num_files, chunk_size)):
+            names = [name_format.format(file_number) for file_number in range(start, min(start + chunk_size, num_files))]
+            tasks.append((folder, wave_type, wave_type, names, min_rows, max_rows, channels,
+                          [seed, label_number, chunk_number], decimals, cache_folder))
+    entries = {}
+    if jobs == 1 or len(tasks) <= 1:
+        results = map(_write_chunk, tasks)
+        for task, chunk_entries in zip(tasks, results):
+            entries.setdefault(task[1], {}).update(chunk_entries)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for task, chunk_entries in zip(tasks, executor.map(_write_chunk, tasks)):
+                entries.setdefault(task[1], {}).update(chunk_entries)
+    return entries
+
+def write_project(project_path, num_files, wave_types=("sine", "square", "sawtooth"), min_rows=100, max_rows=1000,
+                  channels=3, seed=None, jobs=None, decimals=6, cache=True):
+    """Writes a synthetic data set straight into a timechange project
+    The csv files go into the project's csv folder and are added to its index with a single write,
+    so they don't have to be imported. With cache set, their columnar caches are written as well,
+    so transforms read the binary caches instead of parsing the csv files.
+    TimeChange objects already open on the project have to call verify() to see the new files.
+    Keyword arguments:
+    project_path -- path to a timechange project
+    cache -- whether to write columnar caches
+    See write_files for the other arguments
+    Returns a dict mapping label -> file name -> index entry"""
+    cache_folder = path.join(project_path, index.CACHE_FOLDER) if cache else None
+    entries = write_files(path.join(project_path, "csv"), num_files, wave_types, min_rows, max_rows,
+                          channels, seed, jobs, decimals, cache_folder)
+    index.update_index(project_path, added=entries)
+    return entries
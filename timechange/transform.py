@@ -27,86 +27,670 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+#For loading transform plugins
+import importlib
 import numpy as np
-from scipy import signal
+
+#Module used for ffts, imported on first use by _fft
+fft_module = None
+
+#Number of values normalized at a time by simple_fourier_stream
+STREAM_SLAB_SIZE = 1 << 20
+#Width and height of each channel's image made by gramian_field and recurrence_plot
+IMAGE_SIZE = 64
+
+def _fft():
+    """Returns the module used for ffts, importing scipy on first use"""
+    global fft_module
+    if fft_module is None:
+        try:
+            #scipy's fft keeps single precision input in single precision
+            from scipy import fft as module
+        except ImportError:
+            #Older scipy versions, always computes in double precision
+            module = np.fft
+        fft_module = module
+    return fft_module
 
 def extract(time_series, method, **kwargs):
     """Extracts features from a time series or array of time series and outputs an image
     Keyword arguments:
     time_series -- A numpy array or array of numpy arrays representing the time series data
-    method -- the type of feature extraction to use
+    method -- the type of feature extraction to use, see TRANSFORMS
+    chunk_size -- Used for some feature extraction methods. Pads or truncates data
+    """
+    #Run a batch of one file
+    return extract_batch(time_series[np.newaxis], method, **kwargs)[0]
+
+def extract_batch(batch, method, dtype=np.float64, channels=3, out=None, **kwargs):
+    """Extracts features from many files at once
+    All files have to be padded to the same length and have the same number of channels
+    Keyword arguments:
+    batch -- A 3d numpy array of shape (files, channels, samples)
+    method -- the type of feature extraction to use, see TRANSFORMS
+    dtype -- the float type to compute the features in
+    channels -- 3 to copy the features into 3 identical image channels,
+                1 to return a single channel and leave copying to whoever encodes the image
+    out -- contiguous array of shape (files, height, width) and type dtype to compute the features in,
+           such as a buffer reused between batches, or None to make a new one. See Transform.output_shape
     chunk_size -- Used for some feature extraction methods. Pads or truncates data
+    Any other keyword arguments are settings of the method. Settings it doesn't have are ignored
+    Returns an array of shape (files, height, width, channels)
+    """
+    if batch.ndim != 3:
+        raise Exception("A batch must be a 3d array of shape (files, channels, samples)")
+    features = get_transform(method, dtype=dtype, **kwargs)(batch, out)
+    return to_channels(features, channels)
+
+def _output(out, shape, dtype):
+    """Returns out viewed with a shape, or a new array if out is None
+    raises Exception if out can't be viewed with the shape without copying
+    Keyword arguments:
+    out -- array to view, or None
+    shape -- shape of the result
+    dtype -- type of a new array
     """
-    #Switches on method
-    if method == "fft":
-        return simple_fourier(time_series, **kwargs)
-    elif method == "spectrogram":
-        return spectrogram(time_series)
-    elif method == "nothing":
-        return nothing(time_series)
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    view = out.view()
+    try:
+        #Setting the shape never copies, unlike reshape
+        view.shape = shape
+    except AttributeError as _:
+        raise Exception("The output buffer must be contiguous")
+    return view
+
+def to_channels(features, channels):
+    """Gives single channel features an image channel axis
+    Keyword arguments:
+    features -- array of shape (..., height, width)
+    channels -- 1 for a single channel, 3 for three identical channels
+    Returns an array of shape (..., height, width, channels)"""
+    if channels == 1:
+        return features[..., np.newaxis]
+    elif channels == 3:
+        #TODO: configure whether shuffled or stacked
+        return np.stack((features, features, features), axis=-1)
     else:
-        raise Exception("Invalid feature extraction method")
+        raise Exception("Features can only have 1 or 3 channels")
 
 #Possible enhancements
 #TODO: separate real and imaginary components so as not to lose data
 #TODO: split time series into chunks
 #TODO: ignoring values with little information
 #TODO: version with axes
-def simple_fourier(time_series, chunk_size=64, fft_size=128):
+def simple_fourier(time_series, chunk_size=64, fft_size=128, dtype=np.float64, out=None):
     """Performs a basic fourier transform across the entire time series. The imaginary results are normalized.
     Keyword arguments:
-    time_series -- The time series analyse as a 2d numpy array
+    time_series -- The time series analyse as a 2d numpy array, or a 3d array of files
+                   with the same length and number of channels
     chunk_size -- The size value to be passed to numpy's FFT. Values higher than the data size will pad zeroes.
                  Values lower than the data size will remove elements.
                  With FFT, it is recommended to use powers of 2 here
+    dtype -- the float type to compute the features in
+    out -- contiguous array of shape (..., channels * chunks, fft bins) to write the features to, or None
+    Returns an array of shape (..., channels * chunks, fft bins)
     """
-    #Store the number of time series streams
-    num_time_series = time_series.shape[0]
+    #Store the shape of everything but the samples, (files, channels) or (channels,)
+    leading_shape = time_series.shape[:-1]
     # Pad the data to chunk size
-    pad_length = chunk_size - (time_series.shape[1] % chunk_size)
-    time_series = np.pad(time_series, ((0, 0), (0, pad_length)), 'constant', constant_values=0)
+    # Copies straight into a zeroed buffer so padding and casting take a single copy
+    pad_length = chunk_size - (time_series.shape[-1] % chunk_size)
+    padded = np.zeros(leading_shape + (time_series.shape[-1] + pad_length,), dtype=dtype)
+    padded[..., :time_series.shape[-1]] = time_series
     # Reshape the data to chunks of suitable size
-    time_series = time_series.reshape(int(np.product(time_series.shape) / chunk_size), chunk_size)
-    # Perform FFT on the resulting data
+    time_series = padded.reshape(leading_shape + (-1, chunk_size))
+    # Perform FFT on the resulting data for every chunk of every file at once
     # Store in the time_series variable since that data is no longer needed
     # Normalize the real and complex features
-    time_series = np.abs(np.fft.rfft(time_series, fft_size))
-    # Store the chunked shape
-    chunked_shape = time_series.shape
-    # Reshape it back to num_waves, * for normalization
-    time_series = time_series.reshape((num_time_series, np.product(time_series.shape) // num_time_series))
+    features = _fft().rfft(time_series, fft_size)
+    time_series = _output(out, features.shape, dtype)
+    np.abs(features, out=time_series)
+    del features
     #Normalize against maximum value per row to get all values between 0 and 1
     #Extract max values and replace 0s to avoid divide by 0 issue
-    max_values = np.max(time_series, axis=1)
+    max_values = np.max(time_series, axis=(-2, -1), keepdims=True)
     np.place(max_values, max_values == 0, 1)
     #Normalize the time series data by row
-    time_series = (time_series.T / max_values).T
-    #Reshape the time series back to its chunked shape
-    time_series = time_series.reshape(chunked_shape)
-    #TODO: configure whether shuffled or stacked
-    #Shape of this array is W, H, 3
-    return np.stack((time_series, time_series, time_series), axis=2)
-
-def nothing(time_series):
+    time_series /= max_values
+    #Join the chunks of all channels, giving shape (..., channels * chunks, fft bins)
+    return time_series.reshape(leading_shape[:-1] + (-1, time_series.shape[-1]))
+
+def frames(time_series, frame_size, hop_size):
+    """Splits time series into overlapping frames without copying them
+    Keyword arguments:
+    time_series -- array of shape (..., samples). Its length should be frame_size plus a multiple of hop_size,
+                   samples past the last full frame are left out
+    frame_size -- samples per frame
+    hop_size -- samples between the starts of consecutive frames
+    Returns a read-only view of shape (..., frames, frame_size)"""
+    num_frames = max(0, (time_series.shape[-1] - frame_size) // hop_size + 1)
+    #Consecutive frames start hop_size samples apart, and samples within a frame are consecutive
+    return np.lib.stride_tricks.as_strided(time_series,
+                                           shape=time_series.shape[:-1] + (num_frames, frame_size),
+                                           strides=time_series.strides[:-1] + (time_series.strides[-1] * hop_size,
+                                                                               time_series.strides[-1]),
+                                           writeable=False)
+
+def _stft_layout(num_samples, chunk_size, hop_size):
+    """Returns the (hop size, number of chunks) stft uses for series of num_samples samples"""
+    hop_size = max(1, min(hop_size or chunk_size // 2, chunk_size))
+    #Enough chunks for the last one to end at or past the last sample
+    return hop_size, max(0, -(-(num_samples - chunk_size) // hop_size)) + 1
+
+def stft(time_series, chunk_size=64, fft_size=128, hop_size=None, window="hann", dtype=np.float64, out=None):
+    """Performs a fourier transform of overlapping, windowed chunks. The magnitudes are normalized.
+    Like simple_fourier, but chunks can overlap for finer time resolution, and are windowed to reduce spectral leakage
+    Keyword arguments:
+    time_series -- The time series analyse as a 2d numpy array, or a 3d array of files
+                   with the same length and number of channels
+    chunk_size -- samples per chunk
+    fft_size -- length of the fft of each chunk, padded with zeroes
+    hop_size -- samples between the starts of consecutive chunks, or None for half a chunk.
+                chunk_size // 4 overlaps chunks by 75%
+    window -- window applied to each chunk, such as hann, hamming or boxcar for none,
+              or an array of chunk_size window values
+    dtype -- the float type to compute the features in
+    out -- contiguous array of shape (..., channels * chunks, fft_size // 2 + 1) to write the features to, or None
+    Returns an array of shape (..., channels * chunks, fft_size // 2 + 1)
+    """
+    hop_size, num_chunks = _stft_layout(time_series.shape[-1], chunk_size, hop_size)
+    #Store the shape of everything but the samples, (files, channels) or (channels,)
+    leading_shape = time_series.shape[:-1]
+    # Pad the data so the last chunk ends at or past the last sample
+    # Copies straight into a zeroed buffer so padding and casting take a single copy
+    padded = np.zeros(leading_shape + (chunk_size + hop_size * (num_chunks - 1),), dtype=dtype)
+    padded[..., :time_series.shape[-1]] = time_series
+    #Chunks are views of the padded data, so overlapping them doesn't take more memory
+    chunks = frames(padded, chunk_size, hop_size)
+    if isinstance(window, np.ndarray):
+        window_values = window
+    else:
+        from scipy import signal
+        window_values = signal.get_window(window, chunk_size).astype(dtype)
+    features = _output(out, leading_shape + (num_chunks, fft_size // 2 + 1), dtype)
+    #Window and transform a slab of chunks at a time, so only one slab is ever copied
+    slab_chunks = max(1, STREAM_SLAB_SIZE // max(1, int(np.prod(leading_shape)) * chunk_size))
+    for start in range(0, num_chunks, slab_chunks):
+        windowed = chunks[..., start:start + slab_chunks, :] * window_values
+        features[..., start:start + slab_chunks, :] = np.abs(_fft().rfft(windowed, fft_size))
+    #Normalize against maximum value per channel to get all values between 0 and 1
+    #Extract max values and replace 0s to avoid divide by 0 issue
+    max_values = np.max(features, axis=(-2, -1), keepdims=True)
+    np.place(max_values, max_values == 0, 1)
+    features /= max_values
+    #Join the chunks of all channels, giving shape (..., channels * chunks, fft bins)
+    return features.reshape(leading_shape[:-1] + (-1, features.shape[-1]))
+
+def paa_segments(num_samples, size):
+    """Finds the segments paa averages
+    Segments are as even as possible. Series shorter than size have their samples repeated
+    Keyword arguments:
+    num_samples -- length of the series
+    size -- number of segments
+    Returns a tuple of (start, end) index arrays"""
+    starts = np.arange(size) * num_samples // size
+    return starts, np.maximum((np.arange(1, size + 1) * num_samples) // size, starts + 1)
+
+def paa(time_series, size, dtype=np.float64, segments=None):
+    """Piecewise aggregate approximation, shrinks time series to a number of segment means
+    Keyword arguments:
+    time_series -- array of shape (..., samples)
+    size -- number of segments
+    dtype -- the float type of the result
+    segments -- segments from paa_segments for the series length, or None to find them
+    Returns an array of shape (..., size)"""
+    num_samples = time_series.shape[-1]
+    starts, ends = segments if segments is not None else paa_segments(num_samples, size)
+    #Segment sums are differences of a running sum, which takes one pass however long the series are
+    #Summed in double precision so long single precision series don't lose accuracy
+    sums = np.zeros(time_series.shape[:-1] + (num_samples + 1,), dtype=np.float64)
+    np.cumsum(time_series, axis=-1, out=sums[..., 1:])
+    return ((sums[..., ends] - sums[..., starts]) / (ends - starts)).astype(dtype, copy=False)
+
+def resample(time_series, length, dtype=np.float64):
+    """Stretches or shrinks time series to a number of samples
+    Longer series are shrunk with paa, which averages away the detail the shorter series can't hold.
+    Shorter ones are stretched by linear interpolation
+    Keyword arguments:
+    time_series -- array of shape (..., samples)
+    length -- number of samples to resample to
+    dtype -- the float type of the result
+    Returns an array of shape (..., length)"""
+    num_samples = time_series.shape[-1]
+    if num_samples >= length:
+        return paa(time_series, length, dtype)
+    if num_samples == 0:
+        return np.zeros(time_series.shape[:-1] + (length,), dtype=dtype)
+    #Position of each new sample between the old ones
+    positions = np.linspace(0, num_samples - 1, length)
+    left = np.minimum(positions.astype(np.int64), num_samples - 1)
+    right = np.minimum(left + 1, num_samples - 1)
+    weights = (positions - left).astype(dtype)
+    return (time_series[..., left] * (1 - weights) + time_series[..., right] * weights).astype(dtype, copy=False)
+
+def _tiles(leading_shape, image_size):
+    """Yields (start, stop) row ranges that keep each tile of an image computation near STREAM_SLAB_SIZE values"""
+    tile_rows = max(1, STREAM_SLAB_SIZE // max(1, int(np.prod(leading_shape)) * image_size))
+    for start in range(0, image_size, tile_rows):
+        yield start, min(start + tile_rows, image_size)
+
+def gramian_field(time_series, image_size=IMAGE_SIZE, difference=False, dtype=np.float64, segments=None, out=None):
+    """Encodes time series as Gramian angular fields
+    Series are shrunk to image_size points with paa and rescaled to [-1, 1], which are read as the cosines of angles.
+    The summation field holds cos(a_i + a_j) and the difference field holds sin(a_i - a_j) for every pair of points.
+    Images are filled a tile of rows at a time, so memory use doesn't depend on the series length
+    Keyword arguments:
+    time_series -- The time series analyse as a 2d numpy array, or a 3d array of files
+                   with the same length and number of channels
+    image_size -- width and height of each channel's image
+    difference -- make difference fields (GADF) instead of summation fields (GASF)
+    dtype -- the float type to compute the features in
+    segments -- paa segments from paa_segments, or None to find them
+    out -- contiguous array of shape (..., channels * image_size, image_size) to write the features to, or None
+    Returns an array of shape (..., channels * image_size, image_size) with values between 0 and 1
+    """
+    leading_shape = time_series.shape[:-1]
+    cosines = paa(time_series, image_size, dtype, segments)
+    #Rescale every channel to [-1, 1]
+    low = np.min(cosines, axis=-1, keepdims=True)
+    value_range = np.max(cosines, axis=-1, keepdims=True) - low
+    np.place(value_range, value_range == 0, 1)
+    cosines -= low
+    cosines *= 2 / value_range
+    cosines -= 1
+    np.clip(cosines, -1, 1, out=cosines)
+    sines = np.sqrt(1 - cosines * cosines)
+    features = _output(out, leading_shape + (image_size, image_size), dtype)
+    for start, stop in _tiles(leading_shape, image_size):
+        rows = features[..., start:stop, :]
+        if difference:
+            #sin(a_i - a_j) = sin(a_i)cos(a_j) - cos(a_i)sin(a_j)
+            np.multiply(sines[..., start:stop, np.newaxis], cosines[..., np.newaxis, :], out=rows)
+            rows -= cosines[..., start:stop, np.newaxis] * sines[..., np.newaxis, :]
+        else:
+            #cos(a_i + a_j) = cos(a_i)cos(a_j) - sin(a_i)sin(a_j)
+            np.multiply(cosines[..., start:stop, np.newaxis], cosines[..., np.newaxis, :], out=rows)
+            rows -= sines[..., start:stop, np.newaxis] * sines[..., np.newaxis, :]
+    #Map [-1, 1] to [0, 1]
+    features += 1
+    features *= 0.5
+    np.clip(features, 0, 1, out=features)
+    #Join the images of all channels, giving shape (..., channels * image_size, image_size)
+    return features.reshape(leading_shape[:-1] + (-1, image_size))
+
+def recurrence_plot(time_series, image_size=IMAGE_SIZE, threshold=None, dtype=np.float64, segments=None, out=None):
+    """Encodes time series as recurrence plots, the distances between every pair of points
+    Series are shrunk to image_size points with paa first.
+    Images are filled a tile of rows at a time, so memory use doesn't depend on the series length
+    Keyword arguments:
+    time_series -- The time series analyse as a 2d numpy array, or a 3d array of files
+                   with the same length and number of channels
+    image_size -- width and height of each channel's image
+    threshold -- fraction of each channel's value range within which two points count as recurring,
+                 giving 1 for recurring pairs and 0 otherwise. None gives distances scaled to [0, 1] instead
+    dtype -- the float type to compute the features in
+    segments -- paa segments from paa_segments, or None to find them
+    out -- contiguous array of shape (..., channels * image_size, image_size) to write the features to, or None
+    Returns an array of shape (..., channels * image_size, image_size) with values between 0 and 1
+    """
+    leading_shape = time_series.shape[:-1]
+    points = paa(time_series, image_size, dtype, segments)
+    #Scale distances by the value range of each channel
+    value_range = np.max(points, axis=-1, keepdims=True) - np.min(points, axis=-1, keepdims=True)
+    np.place(value_range, value_range == 0, 1)
+    points /= value_range
+    features = _output(out, leading_shape + (image_size, image_size), dtype)
+    for start, stop in _tiles(leading_shape, image_size):
+        rows = features[..., start:stop, :]
+        np.subtract(points[..., start:stop, np.newaxis], points[..., np.newaxis, :], out=rows)
+        np.abs(rows, out=rows)
+        if threshold is not None:
+            np.less_equal(rows, threshold, out=rows, casting="unsafe")
+    np.clip(features, 0, 1, out=features)
+    #Join the images of all channels, giving shape (..., channels * image_size, image_size)
+    return features.reshape(leading_shape[:-1] + (-1, image_size))
+
+def nothing(time_series, dtype=np.float64, out=None):
     """Normalizes the data to positive values and returns it as a 2d array
     Parameters:
-        time_series -- The data to transform
+        time_series -- The data to transform, as a 2d array or a 3d array of files
+        dtype -- the float type to compute the features in
+        out -- contiguous array the shape of time_series to write the features to,
+               or None to work in place if time_series already has the right type
     """
+    if out is None:
+        #Work on a float copy only if the data isn't already in the right type
+        time_series = time_series.astype(dtype, copy=False)
+    else:
+        features = _output(out, time_series.shape, dtype)
+        features[...] = time_series
+        time_series = features
     #Bring all values up to positive
-    time_series -= np.min(time_series, axis=1).reshape(time_series.shape[0], 1)
+    time_series -= np.min(time_series, axis=-1, keepdims=True)
     #Normalize all rows per row
     #Get normalization values
-    max_values = np.max(time_series, axis=1).reshape(time_series.shape[0], 1)
+    max_values = np.max(time_series, axis=-1, keepdims=True)
     #Fix divby0 errors
     max_values[max_values == 0] = 1
     #Return the array normalized
-    return np.stack([time_series / max_values] * 3, axis=2)
-def spectrogram(time_series):
-    """Performs a spectrogram
+    time_series /= max_values
+    return time_series
+
+def _spectrogram_layout(num_samples, chunk_size, fft_size, nperseg, noverlap):
+    """Returns the (segment length, overlap, fft length, number of segments) spectrogram uses
+    for series of num_samples samples"""
+    nperseg = max(1, min(nperseg or chunk_size, num_samples))
+    noverlap = nperseg // 2 if noverlap is None else max(0, min(noverlap, nperseg - 1))
+    return nperseg, noverlap, max(fft_size, nperseg), (num_samples - noverlap) // (nperseg - noverlap)
+
+def spectrogram(time_series, chunk_size=64, fft_size=128, nperseg=None, noverlap=None, window="hann",
+                log_scale=True, db_range=80.0, dtype=np.float64, out=None):
+    """Performs a spectrogram of every channel, normalized to values between 0 and 1
     Parameters:
-    time_series -- The time series to analyse as a 2d array.
+    time_series -- The time series to analyse as a 2d array, or a 3d array of files
+                   with the same length and number of channels
+    chunk_size -- segment length used when nperseg isn't given
+    fft_size -- length of the fft of each segment, padded with zeroes. At least the segment length is used
+    nperseg -- length of each segment, or None to use chunk_size. Shortened to the series length if it's longer
+    noverlap -- number of samples consecutive segments share, or None for half a segment
+    window -- window applied to each segment, any window scipy.signal.get_window accepts,
+              or an array of window values as long as a segment
+    log_scale -- whether to scale the power in decibels, which shows quiet frequencies next to loud ones
+    db_range -- decibels below each channel's peak that map to 0 when log_scale is set
+    dtype -- the float type to compute the features in
+    out -- contiguous array of shape (..., channels * segments, fft_size // 2 + 1) to write the features to, or None
+    Returns an array of shape (..., channels * segments, fft_size // 2 + 1)
+    """
+    from scipy import signal
+    nperseg, noverlap, nfft, _ = _spectrogram_layout(time_series.shape[-1], chunk_size, fft_size, nperseg, noverlap)
+    # Generate the spectrogram of every channel of every file at once
+    _, _, power = signal.spectrogram(time_series.astype(dtype, copy=False), window=window, nperseg=nperseg,
+                                     noverlap=noverlap, nfft=nfft, axis=-1)
+    power = power.astype(dtype, copy=False)
+    #Normalize against the peak of each channel
+    #Extract peak values and replace 0s to avoid divide by 0 issue
+    peaks = np.max(power, axis=(-2, -1), keepdims=True)
+    np.place(peaks, peaks == 0, 1)
+    if log_scale:
+        #Clip to db_range below the peak, then map decibels to values between 0 and 1
+        floors = peaks * 10 ** (-db_range / 10)
+        np.maximum(power, floors, out=power)
+        power /= floors
+        np.log10(power, out=power)
+        power *= 10 / db_range
+    else:
+        power /= peaks
+    #Put segments before frequencies like simple_fourier's chunks and join the channels,
+    #giving shape (..., channels * segments, frequencies)
+    power = np.swapaxes(power, -1, -2)
+    features = _output(out, power.shape, dtype)
+    features[...] = power
+    return features.reshape(power.shape[:-3] + (-1, power.shape[-1]))
+
+def simple_fourier_stream(blocks, out, chunk_size=64, fft_size=128, dtype=np.float64):
+    """Performs simple_fourier on a time series that arrives in consecutive blocks
+    Features are written to out as they are produced and normalized in a second pass over out,
+    so memory use is bounded by the block size no matter how long the series is.
+    Keyword arguments:
+    blocks -- iterable of 2d arrays of shape (channels, samples) holding consecutive parts of the series
+    out -- array of shape (channels, chunks, fft bins) to write the features to, such as a memory map.
+           Its number of chunks sets the padded length of the series, as in simple_fourier
+    chunk_size -- the number of samples per chunk
+    fft_size -- the size value passed to the FFT
+    dtype -- the float type to compute the features in
+    Returns out as an array of shape (channels * chunks, fft bins), the same result simple_fourier gives
+    """
+    num_channels, num_chunks, _ = out.shape
+    #Samples at the end of the last block that don't fill a chunk yet
+    leftover = np.zeros((num_channels, 0), dtype=dtype)
+    #Index of the next chunk to write
+    position = 0
+    #Running maximum of every row
+    max_values = np.zeros((num_channels, 1, 1), dtype=dtype)
+    for block in blocks:
+        block = np.concatenate((leftover, block.astype(dtype, copy=False)), axis=1)
+        #Number of samples that make up whole chunks
+        usable = block.shape[1] - block.shape[1] % chunk_size
+        if usable:
+            if position + usable // chunk_size > num_chunks:
+                raise Exception("The time series is longer than the output allows")
+            chunks = block[:, :usable].reshape(num_channels, -1, chunk_size)
+            features = np.abs(_fft().rfft(chunks, fft_size)).astype(dtype, copy=False)
+            out[:, position:position + features.shape[1]] = features
+            np.maximum(max_values, np.max(features, axis=(1, 2), keepdims=True), out=max_values)
+            position += features.shape[1]
+        leftover = block[:, usable:]
+    #The last partial chunk is padded with zeros
+    if leftover.shape[1]:
+        if position >= num_chunks:
+            raise Exception("The time series is longer than the output allows")
+        padded = np.zeros((num_channels, 1, chunk_size), dtype=dtype)
+        padded[:, 0, :leftover.shape[1]] = leftover
+        features = np.abs(_fft().rfft(padded, fft_size)).astype(dtype, copy=False)
+        out[:, position:position + 1] = features
+        np.maximum(max_values, np.max(features, axis=(1, 2), keepdims=True), out=max_values)
+        position += 1
+    #Chunks past the end of the series are all zeros
+    out[:, position:] = 0
+    #Normalize against maximum value per row, one slab of chunks at a time
+    np.place(max_values, max_values == 0, 1)
+    slab_size = max(1, STREAM_SLAB_SIZE // out.shape[2])
+    for start in range(0, num_chunks, slab_size):
+        out[:, start:start + slab_size] /= max_values
+    #Join the chunks of all channels
+    return out.reshape(-1, out.shape[2])
+
+def _boolean(value):
+    """Reads a true or false setting"""
+    return value.lower() in ("true", "yes", "1")
+
+#Registered transforms, mapping method name -> Transform subclass
+TRANSFORMS = {}
+#Transforms made by get_transform, mapping (method, settings) -> Transform
+_instances = {}
+
+def register(method):
+    """Class decorator that makes a Transform subclass available as a feature extraction method
+    Transforms outside this module register themselves when their module is imported, see load_plugins
+    Keyword arguments:
+    method -- name of the method, as given in transform.conf
+    """
+    def add(transform_class):
+        TRANSFORMS[method] = transform_class
+        #Forget transforms made by a class registered under the same name before
+        for key in [key for key in _instances if key[0] == method]:
+            del _instances[key]
+        return transform_class
+    return add
+
+def load_plugins(modules):
+    """Imports modules that register transforms
+    Keyword arguments:
+    modules -- names of the modules to import, such as mypackage.transforms
     """
-    # Generate the spectrogram
-    f,t,Sxx = signal.spectrogram(time_series.flatten())
-    # Return the data
-    return np.stack([Sxx] * 3, axis=2)
+    for module in modules:
+        importlib.import_module(module)
+
+def get_transform(method, dtype=np.float64, **settings):
+    """Finds the transform for a method and settings
+    Transforms are made once per method and settings, so their precomputed state is shared by every call
+    raises Exception if the method isn't registered or a setting is invalid
+    Keyword arguments:
+    method -- name of a registered method, see TRANSFORMS
+    dtype -- the float type to compute the features in
+    settings -- values of the method's settings. Settings the method doesn't have are ignored
+    Returns a Transform"""
+    if method not in TRANSFORMS:
+        raise Exception("Invalid feature extraction method")
+    transform_class = TRANSFORMS[method]
+    settings = {name: value for name, value in settings.items() if name in transform_class.settings}
+    key = (method, np.dtype(dtype).name, tuple(sorted(settings.items())))
+    if key not in _instances:
+        _instances[key] = transform_class(dtype=dtype, **settings)
+    return _instances[key]
+
+class Transform:
+    """Base class of feature extraction methods
+    A transform turns a batch of files of shape (files, channels, samples) into features of shape
+    (files, height, width) with values between 0 and 1.
+    Subclasses declare the settings they read from transform.conf, give the shape of their output for
+    an input shape, and can precompute state that only depends on the input shape, like windows or index maps.
+    State is made once per input shape and reused for every batch. Subclasses are made available with register"""
+    #Settings read from transform.conf, mapping name -> (function reading the text value, default value)
+    settings = {}
+    def __init__(self, dtype=np.float64, **settings):
+        """Constructor
+        raises Exception if a setting is invalid
+        Keyword arguments:
+        dtype -- the float type to compute the features in
+        settings -- values of the settings in the class's settings. Missing or None values use the default
+        """
+        self.dtype = np.dtype(dtype)
+        for name, (_, default) in self.settings.items():
+            value = settings.get(name)
+            setattr(self, name, default if value is None else value)
+        #Maps input shape -> state made by prepare
+        self._states = {}
+    @classmethod
+    def read_settings(cls, config):
+        """Reads the class's settings from transform.conf
+        Keyword arguments:
+        config -- mapping of setting name -> text value, like a section of a ConfigParser
+        Returns a dict mapping setting name -> value, with the default for settings left empty"""
+        values = {}
+        for name, (read, default) in cls.settings.items():
+            value = config.get(name, "").strip("\"").strip("\'")
+            values[name] = read(value) if value else default
+        return values
+    def output_shape(self, input_shape):
+        """Gives the shape of the features of one file
+        Keyword arguments:
+        input_shape -- (channels, samples) of one file
+        Returns a tuple of (height, width)"""
+        raise NotImplementedError
+    def prepare(self, input_shape):
+        """Precomputes state for inputs of a shape
+        Keyword arguments:
+        input_shape -- (channels, samples) of one file
+        Returns the state handed to compute, None unless overridden"""
+        return None
+    def compute(self, batch, out, state):
+        """Computes features
+        Keyword arguments:
+        batch -- array of shape (files, channels, samples)
+        out -- contiguous array of shape (files, height, width) and type dtype to write the features to
+        state -- what prepare returned for the batch's input shape
+        """
+        raise NotImplementedError
+    def __call__(self, batch, out=None):
+        """Computes the features of a batch
+        Keyword arguments:
+        batch -- array of shape (files, channels, samples)
+        out -- contiguous array of shape (files, height, width) and type dtype to write the features to,
+               such as a buffer reused between batches, or None to make a new one
+        Returns the features as an array of shape (files, height, width)"""
+        input_shape = tuple(batch.shape[1:])
+        if input_shape not in self._states:
+            self._states[input_shape] = self.prepare(input_shape)
+        shape = (batch.shape[0],) + tuple(self.output_shape(input_shape))
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        elif out.shape != shape or out.dtype != self.dtype:
+            raise Exception("Features of shape {} and type {} can't be written to an array of shape {} and type {}".format(
+                shape, self.dtype, out.shape, out.dtype))
+        self.compute(batch, out, self._states[input_shape])
+        return out
+
+def _check_window(window):
+    """Raises an Exception if scipy doesn't know a window"""
+    from scipy import signal
+    try:
+        signal.get_window(window, 8)
+    except ValueError as _:
+        raise Exception("Invalid window {}. Please use a window scipy.signal.get_window accepts, like hann".format(window))
+
+@register("fft")
+class FourierTransform(Transform):
+    """Fourier transforms of consecutive chunks, see simple_fourier"""
+    settings = {"chunk_size": (int, 64), "fft_size": (int, 128)}
+    def output_shape(self, input_shape):
+        num_channels, num_samples = input_shape
+        #Series are padded by up to a whole chunk
+        return num_channels * (num_samples // self.chunk_size + 1), self.fft_size // 2 + 1
+    def compute(self, batch, out, state):
+        simple_fourier(batch, self.chunk_size, self.fft_size, self.dtype, out=out)
+
+@register("stft")
+class ShortTimeFourierTransform(Transform):
+    """Fourier transforms of overlapping, windowed chunks, see stft"""
+    settings = {"chunk_size": (int, 64), "fft_size": (int, 128), "hop_size": (int, None), "window": (str, "hann")}
+    def __init__(self, dtype=np.float64, **settings):
+        Transform.__init__(self, dtype, **settings)
+        _check_window(self.window)
+    def output_shape(self, input_shape):
+        num_channels, num_samples = input_shape
+        return num_channels * _stft_layout(num_samples, self.chunk_size, self.hop_size)[1], self.fft_size // 2 + 1
+    def prepare(self, input_shape):
+        from scipy import signal
+        return signal.get_window(self.window, self.chunk_size).astype(self.dtype)
+    def compute(self, batch, out, state):
+        stft(batch, self.chunk_size, self.fft_size, self.hop_size, state, self.dtype, out=out)
+
+@register("spectrogram")
+class SpectrogramTransform(Transform):
+    """Spectrograms of every channel, see spectrogram"""
+    settings = {"chunk_size": (int, 64), "fft_size": (int, 128), "nperseg": (int, None), "noverlap": (int, None),
+                "window": (str, "hann"), "log_scale": (_boolean, True), "db_range": (float, 80.0)}
+    def __init__(self, dtype=np.float64, **settings):
+        Transform.__init__(self, dtype, **settings)
+        _check_window(self.window)
+    def output_shape(self, input_shape):
+        num_channels, num_samples = input_shape
+        _, _, nfft, num_segments = _spectrogram_layout(num_samples, self.chunk_size, self.fft_size,
+                                                       self.nperseg, self.noverlap)
+        return num_channels * num_segments, nfft // 2 + 1
+    def prepare(self, input_shape):
+        from scipy import signal
+        nperseg = _spectrogram_layout(input_shape[1], self.chunk_size, self.fft_size, self.nperseg, self.noverlap)[0]
+        return signal.get_window(self.window, nperseg).astype(self.dtype)
+    def compute(self, batch, out, state):
+        spectrogram(batch, self.chunk_size, self.fft_size, self.nperseg, self.noverlap, state,
+                    self.log_scale, self.db_range, self.dtype, out=out)
+
+@register("gasf")
+class GramianSummationField(Transform):
+    """Gramian angular summation fields, see gramian_field"""
+    settings = {"image_size": (int, IMAGE_SIZE)}
+    #Whether to make difference fields instead
+    difference = False
+    def output_shape(self, input_shape):
+        return input_shape[0] * self.image_size, self.image_size
+    def prepare(self, input_shape):
+        return paa_segments(input_shape[1], self.image_size)
+    def compute(self, batch, out, state):
+        gramian_field(batch, self.image_size, self.difference, self.dtype, segments=state, out=out)
+
+@register("gadf")
+class GramianDifferenceField(GramianSummationField):
+    """Gramian angular difference fields, see gramian_field"""
+    difference = True
+
+@register("recurrence")
+class RecurrencePlot(Transform):
+    """Recurrence plots, see recurrence_plot"""
+    settings = {"image_size": (int, IMAGE_SIZE), "threshold": (float, None)}
+    def output_shape(self, input_shape):
+        return input_shape[0] * self.image_size, self.image_size
+    def prepare(self, input_shape):
+        return paa_segments(input_shape[1], self.image_size)
+    def compute(self, batch, out, state):
+        recurrence_plot(batch, self.image_size, self.threshold, self.dtype, segments=state, out=out)
+
+@register("nothing")
+class Nothing(Transform):
+    """The normalized series themselves, see nothing"""
+    def output_shape(self, input_shape):
+        return tuple(input_shape)
+    def compute(self, batch, out, state):
+        nothing(batch, self.dtype, out=out)
@@ -5,20 +5,474 @@ import os
 from os import path
 #For deleting directories
 import shutil
+#For timing job stages
+import time
+#For converting files in parallel
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+#For numbering jobs and interleaving labels
+from itertools import count, zip_longest
+#For loading features only when they're needed
+from functools import partial
+#For running jobs in the background
+from threading import Condition, Event, Thread, local
+#For storing features of files too large to hold in memory
+import tempfile
+#For finding the length bucket of a file
+from bisect import bisect_left
 #For padding data
 import numpy as np
-#For creating images from numpy arrays
-from PIL import Image
-#For reading csv files
-import pandas
 #For performing transformations
 from . import transform
+#For looking up file row counts
+from . import index
+#For writing and reading feature shards
+from . import dataset
+#For timing job stages
+from . import metrics
+#For profiling jobs
+from . import profiling
 
-def convert_all_csv(project_path):
+#Number of csv rows read at a time when streaming a file
+STREAM_BLOCK_ROWS = 1 << 16
+#Most samples per channel in a batch of padded files
+BATCH_SAMPLES = 1 << 24
+#Longest length fit_targets pads files to so their features are big enough for the model
+MAX_TARGET_LENGTH = 1 << 24
+
+def cache_csv(csv_path, cache_file):
+    """Parses a csv file once into a columnar cache
+    The cache is a .npy file of shape (columns, rows), so each column is contiguous and
+    can be memory mapped without reading the others
+    Keyword arguments:
+    csv_path -- path to the csv file to parse
+    cache_file -- path of the .npy file to write
+    raises Exception if the file can't be stored as floats
+    Returns the index entry for the csv file"""
+    #Load pandas only when a csv file has to be parsed
+    import pandas
+    #Stat before reading, so a file changed while it's cached doesn't look current afterwards
+    stat = os.stat(csv_path)
+    num_rows = index.count_rows(csv_path)
+    column_names = list(pandas.read_csv(csv_path, nrows=0).columns)
+    os.makedirs(path.dirname(cache_file), exist_ok=True)
+    try:
+        cache = np.lib.format.open_memmap(cache_file + ".tmp", mode="w+", dtype=np.float64,
+                                          shape=(len(column_names), num_rows))
+        #Parse the file in blocks of rows so it never has to fit in memory
+        position = 0
+        for frame in pandas.read_csv(csv_path, chunksize=STREAM_BLOCK_ROWS):
+            cache[:, position:position + len(frame)] = frame.values.T
+            position += len(frame)
+        if position != num_rows:
+            raise Exception("{} has blank or malformed lines".format(csv_path))
+        cache.flush()
+        #Release the memory map before moving the file
+        del cache
+        os.replace(cache_file + ".tmp", cache_file)
+    except:
+        if path.exists(cache_file + ".tmp"):
+            os.remove(cache_file + ".tmp")
+        raise
+    return {"rows": num_rows, "size": stat.st_size, "mtime": stat.st_mtime_ns, "columns": column_names, "cached": True}
+
+def read_csv(csv_path, columns, cache=None):
+    """Reads the selected columns of a csv file
+    Keyword arguments:
+    csv_path -- path to the csv file to read
+    columns -- csv columns to read, or None to read all of them
+    cache -- tuple of (cache file, column names) if the file has a columnar cache, otherwise None
+             Selected columns are memory mapped from the cache instead of parsing the csv
+    Returns an array of shape (channels, samples)"""
+    if cache is not None:
+        cache_file, column_names = cache
+        if columns is None or all(column in column_names for column in columns):
+            try:
+                data = np.load(cache_file, mmap_mode="r")
+            except OSError as _:
+                #The cache is gone, parse the csv instead
+                pass
+            else:
+                if columns is None:
+                    return data
+                #Columns come out in file order, as they do from pandas
+                return data[sorted(column_names.index(column) for column in columns)]
+    #Load pandas only when a csv file has to be parsed
+    import pandas
+    return pandas.read_csv(csv_path, usecols=columns).values.T
+
+def count_columns(csv_path, columns, cache=None):
+    """Finds the number of channels read_csv gives for a csv file, without reading its rows
+    Keyword arguments:
+    csv_path -- path to the csv file
+    columns -- csv columns to read, or None to read all of them
+    cache -- tuple of (cache file, column names) if the file has a columnar cache, otherwise None
+    Returns the number of channels, or None if the header can't be read"""
+    if columns is not None:
+        return len(columns)
+    if cache is not None:
+        return len(cache[1])
+    #Load pandas only when a csv file has to be parsed
+    import pandas
+    try:
+        return pandas.read_csv(csv_path, nrows=0).shape[1]
+    except Exception as _:
+        return None
+
+def length_config(transform_config):
+    """Reads the length policy from a loaded transform.conf
+    raises Exception if a setting is invalid
+    Keyword arguments:
+    transform_config -- ConfigParser holding transform.conf
+    Returns a dict with length_policy and the setting the policy uses, if any. See length_targets"""
+    config = transform_config["DEFAULT"]
+    policy = config.get("length_policy", "max").strip("\"").strip("\'")
+    if policy == "max":
+        return {"length_policy": policy}
+    if policy == "percentile":
+        percentile = float(config.get("length_percentile", "95").strip("\"").strip("\'"))
+        if not 0 < percentile <= 100:
+            raise Exception("Invalid length_percentile. Please use a value above 0 and at most 100")
+        return {"length_policy": policy, "length_percentile": percentile}
+    if policy == "bucket":
+        buckets = int(config.get("length_buckets", "4").strip("\"").strip("\'"))
+        if buckets < 1:
+            raise Exception("Invalid length_buckets. Please use at least 1")
+        return {"length_policy": policy, "length_buckets": buckets}
+    if policy == "resample":
+        resample_length = config.get("resample_length", "").strip("\"").strip("\'")
+        resample_length = int(resample_length) if resample_length else None
+        if resample_length is not None and resample_length < 1:
+            raise Exception("Invalid resample_length. Please use at least 1")
+        return {"length_policy": policy, "resample_length": resample_length}
+    raise Exception("Invalid length policy. Please use max, percentile, bucket or resample")
+
+def length_targets(lengths, length_policy="max", length_percentile=95, length_buckets=4, resample_length=None):
+    """Picks the lengths time series are brought to before they are transformed
+    max pads every series to the longest one.
+    percentile pads series to the length_percentile percentile of the lengths and truncates longer ones.
+    bucket splits the lengths into length_buckets ranges and pads each series to the longest one in its range.
+    The ranges grow geometrically from the shortest length to the longest, so a few very long files get a range
+    of their own and no series is padded by more than a factor of (longest / shortest) ** (1 / length_buckets).
+    resample stretches or shrinks every series to resample_length, or to the median length if that is None
+    Keyword arguments:
+    lengths -- number of rows of every file
+    length_policy -- one of max, percentile, bucket or resample
+    length_percentile, length_buckets, resample_length -- settings of the policies, see length_config
+    Returns the sorted list of target lengths, empty if there are no lengths. See target_length"""
+    lengths = sorted(lengths)
+    num_lengths = len(lengths)
+    if num_lengths == 0:
+        return []
+    #Percentiles are taken by nearest rank, so targets are lengths of actual files
+    if length_policy == "percentile":
+        return [lengths[max(1, int(np.ceil(length_percentile * num_lengths / 100))) - 1]]
+    if length_policy == "bucket":
+        #Upper edge of every range
+        edges = np.geomspace(max(1, lengths[0]), max(1, lengths[-1]), length_buckets + 1)[1:]
+        #Maps range -> longest length in it. Ranges without lengths are dropped
+        longest = {}
+        for length, bucket in zip(lengths, np.minimum(np.searchsorted(edges, lengths), length_buckets - 1)):
+            longest[bucket] = length
+        return sorted(longest.values())
+    if length_policy == "resample":
+        return [resample_length or lengths[(num_lengths - 1) // 2]]
+    return [lengths[-1]]
+
+def fit_targets(targets, transformer, num_channels, min_size):
+    """Raises target lengths until the features of files brought to them are big enough for the model
+    Lengths are only raised as far as padding makes the features bigger, so transforms whose feature
+    size doesn't depend on the length keep their targets
+    Keyword arguments:
+    targets -- sorted target lengths from length_targets
+    transformer -- transform.Transform the files are transformed with
+    num_channels -- number of channels of the files
+    min_size -- smallest height and width of features the model takes, see min_input_size
+    Returns the sorted list of raised target lengths. Targets raised to the same length are merged"""
+    def fits(length):
+        return min(transformer.output_shape((num_channels, length))) >= min_size
+    fitted = set()
+    for length in targets:
+        if not fits(length):
+            #Double the length until the features are big enough, then search for the shortest length that is
+            longest = max(1, length)
+            while not fits(longest) and longest < MAX_TARGET_LENGTH:
+                longest *= 2
+            if fits(longest):
+                while length < longest:
+                    middle = (length + longest) // 2
+                    if fits(middle):
+                        longest = middle
+                    else:
+                        length = middle + 1
+        fitted.add(length)
+    return sorted(fitted)
+
+def target_length(num_samples, targets):
+    """Finds the length a time series is brought to
+    Keyword arguments:
+    num_samples -- length of the series
+    targets -- sorted target lengths from length_targets
+    Returns the shortest target the series fits in, or the longest target if it fits in none"""
+    return targets[min(bisect_left(targets, num_samples), len(targets) - 1)]
+
+def fit_length(time_series, length, length_policy):
+    """Brings a time series to its target length, apart from padding
+    Series are resampled to the length under the resample policy. Otherwise longer series are truncated,
+    which the max policy never needs, and shorter ones are left for the caller to pad
+    Keyword arguments:
+    time_series -- array of shape (channels, samples)
+    length -- target length from target_length
+    length_policy -- the policy the target was picked with
+    Returns an array of shape (channels, at most length samples)"""
+    if length_policy == "resample":
+        if time_series.shape[1] == length:
+            return time_series
+        return transform.resample(time_series, length)
+    return time_series[:, :length]
+
+def convert_csv(csv_path, max_length, columns, method, **kwargs):
+    """Reads a single csv file and extracts its features
+    Keyword arguments:
+    csv_path -- path to the csv file to read
+    max_length -- length to pad the time series to
+    columns -- csv columns to read, or None to read all of them
+    method -- method used by transform.extract to generate image data
+    Any other keyword arguments, such as chunk_size, fft_size, dtype and channels, are passed to transform.extract
+    Returns the features as an array of shape (height, width, channels)"""
+    # Read the csv into a numpy array
+    data = read_csv(csv_path, columns)
+    # Pad the csv
+    data = np.pad(data, ((0,0), (0, max_length - data.shape[1])), 'constant', constant_values=0.0)
+    # Extract features from the numpy array
+    # Uses same variable name since data is not needed after feature extraction
+    return transform.extract(data, method, **kwargs)
+
+def convert_csv_stream(csv_path, max_length, columns, method, temp_folder, cache=None, truncate=False,
+                       chunk_size=64, fft_size=128, dtype=np.float64):
+    """Extracts the features of a csv file too large to hold in memory
+    The file is read in blocks of rows that are fed straight into transform.simple_fourier_stream,
+    which writes the features to a temporary .npy file as they are produced
+    Keyword arguments:
+    csv_path -- path to the csv file to read
+    max_length -- length to pad the time series to
+    columns -- csv columns to read, or None to read all of them
+    method -- method used to generate image data. Only fft can be streamed
+    temp_folder -- folder to store the temporary .npy file in
+    cache -- tuple of (cache file, column names) if the file has a columnar cache, otherwise None
+             Blocks are then sliced out of the memory mapped cache
+    truncate -- whether to drop rows past max_length instead of failing on them
+    Returns the path of the temporary .npy file, which holds the features as an array of shape (1, height, width)"""
+    if method != "fft":
+        raise Exception("Only the fft method can be streamed")
+    if cache is not None:
+        #Memory map the selected columns
+        data = read_csv(csv_path, columns, cache)
+        if truncate:
+            data = data[:, :max_length]
+        num_channels = data.shape[0]
+        blocks = (data[:, start:start + STREAM_BLOCK_ROWS] for start in range(0, data.shape[1], STREAM_BLOCK_ROWS))
+    else:
+        #Load pandas only when a csv file has to be parsed
+        import pandas
+        # Read the header to find the number of channels
+        num_channels = pandas.read_csv(csv_path, usecols=columns, nrows=0).shape[1]
+        # Read the csv in blocks of rows
+        blocks = (frame.values.T for frame in pandas.read_csv(csv_path, usecols=columns, chunksize=STREAM_BLOCK_ROWS,
+                                                              nrows=max_length if truncate else None))
+    # Shape of the features after padding, as in transform.simple_fourier
+    height, width = transform.get_transform("fft", chunk_size=chunk_size, fft_size=fft_size,
+                                            dtype=dtype).output_shape((num_channels, max_length))
+    # Memory map the output
+    os.makedirs(temp_folder, exist_ok=True)
+    temp_handle, temp_path = tempfile.mkstemp(suffix=".npy", dir=temp_folder)
+    os.close(temp_handle)
+    try:
+        features = np.lib.format.open_memmap(temp_path, mode="w+", dtype=dtype, shape=(1, height, width))
+        transform.simple_fourier_stream(blocks, features.reshape(num_channels, height // num_channels, width),
+                                        chunk_size=chunk_size, fft_size=fft_size, dtype=dtype)
+        features.flush()
+    except:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+def save_image(features, image_path):
+    """Encodes features as a png image
+    Keyword arguments:
+    features -- array of shape (height, width, channels) with values between 0 and 1
+                Single channel features are copied into all three image channels
+    image_path -- path to write the png to"""
+    #Load PIL only when images are written
+    from PIL import Image
+    # Generate an image from the resulting feature representation
+    # Converts a slab of rows at a time so large features don't need a full float copy
+    pixels = np.empty(features.shape, dtype=np.uint8)
+    slab_size = max(1, transform.STREAM_SLAB_SIZE // int(np.prod(features.shape[1:])))
+    for start in range(0, features.shape[0], slab_size):
+        pixels[start:start + slab_size] = features[start:start + slab_size] * 255
+    if pixels.shape[-1] == 1:
+        img = Image.fromarray(pixels[..., 0], "L").convert("RGB")
+    else:
+        img = Image.fromarray(pixels, "RGB")
+    # Save the image to the desired file path
+    img.save(image_path)
+
+#Conversion buffers of each thread, see _buffer
+_buffers = local()
+
+def _buffer(name, shape, dtype):
+    """Gives a contiguous array for a conversion step, reusing the memory the step used last time
+    Buffers belong to the thread that asks for them and only grow, so a conversion run allocates
+    each one about once per process. Their contents are left over from earlier use
+    Keyword arguments:
+    name -- name of the step
+    shape -- shape of the array
+    dtype -- type of the array
+    Returns an array of the shape and type"""
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.dtype != dtype or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        setattr(_buffers, name, buffer)
+    return buffer[:size].reshape(shape)
+
+def _convert_csv_task(task):
+    """Converts a batch of csv files, catching any error
+    Files with the same number of channels and target length are transformed together with transform.extract_batch.
+    Files longer than the stream_rows setting are streamed one at a time with convert_csv_stream instead.
+    Used by convert_all_csv so one bad file doesn't stop the whole run.
+    Keyword arguments:
+    task -- see _convert_batch
+    Returns a tuple of (results, stats), where results is the list returned by _convert_batch and stats
+    holds the time spent on each stage as returned by metrics.StageTimer.stats"""
+    timer = metrics.StageTimer()
+    return _convert_batch(task, timer), timer.stats()
+
+def _convert_batch(task, timer):
+    """Converts a batch of csv files for _convert_csv_task
+    Keyword arguments:
+    task -- tuple of (csv paths, image paths, caches, lengths, settings)
+            image paths may be None to skip writing a png
+            caches holds a (cache file, column names) tuple for every file with a columnar cache, otherwise None
+            lengths holds the length every file is brought to, see target_length
+            settings is a dict with keep_features, length_policy, columns, method, stream_rows (0 never streams),
+            temp_folder and options, a dict of keyword arguments for transform.extract_batch
+    Returns a list with (content hash, features, None) for every file that succeeded
+    and (None, None, error message) for every file that failed
+    features is None unless keep_features is set. It is either an array or the path of a temporary .npy file
+    timer -- metrics.StageTimer to add the time spent hashing, reading, padding, transforming and encoding to"""
+    csv_paths, image_paths, caches, lengths, settings = task
+    length_policy = settings["length_policy"]
+    options = settings["options"]
+    #Worker processes need the plugins too
+    transform.load_plugins(settings["plugins"])
+    transformer = transform.get_transform(settings["method"], **options)
+    results = [None] * len(csv_paths)
+    #Read the files, grouping them by their number of channels and length so they can be stacked
+    #Maps (number of channels, length) -> list of (position in batch, content hash, data)
+    groups = {}
+    for position, csv_path in enumerate(csv_paths):
+        length = lengths[position]
+        try:
+            #Hash the file here so it happens in parallel with the other conversions
+            with timer.time("hash"):
+                digest = index.hash_file(csv_path)
+            timer.count("bytes", path.getsize(csv_path))
+            if length > settings["stream_rows"] > 0:
+                #Too large to read at once
+                with timer.time("stream"):
+                    features = convert_csv_stream(csv_path, length, settings["columns"], settings["method"],
+                                                  settings["temp_folder"], caches[position],
+                                                  truncate=length_policy != "max", **options)
+                results[position] = _save_features(digest, np.load(features, mmap_mode="r")[0][..., np.newaxis],
+                                                   features, image_paths[position], settings["keep_features"], timer)
+                continue
+            with timer.time("read"):
+                data = read_csv(csv_path, settings["columns"], caches[position])
+            if length_policy == "max" and data.shape[1] > length:
+                raise Exception("{} has more rows than the longest indexed file".format(csv_path))
+            if length_policy != "max":
+                with timer.time("resample" if length_policy == "resample" else "pad"):
+                    data = fit_length(data, length, length_policy)
+            groups.setdefault((data.shape[0], length), []).append((position, digest, data))
+        except Exception as err:
+            results[position] = (None, None, str(err))
+    for (num_channels, length), group in groups.items():
+        # Pad the csvs into one array
+        try:
+            with timer.time("pad"):
+                #The padded files and their features go in buffers shared by every batch of the run
+                batch = _buffer("input", (len(group), num_channels, length), transformer.dtype)
+                for row, (_, _, data) in enumerate(group):
+                    batch[row, :, :data.shape[1]] = data
+                    batch[row, :, data.shape[1]:] = 0
+                out = _buffer("features", (len(group),) + tuple(transformer.output_shape((num_channels, length))),
+                              transformer.dtype)
+            # Extract features from every file at once
+            # Features keep a single channel until they are encoded
+            with timer.time("transform"):
+                batch = transform.extract_batch(batch, settings["method"], channels=1, out=out, **options)
+        except Exception as err:
+            if len(group) == 1:
+                results[group[0][0]] = (None, None, str(err))
+                continue
+            #Retry the files one at a time to find the ones causing trouble
+            for position, _, _ in group:
+                results[position] = _convert_batch(([csv_paths[position]], [image_paths[position]],
+                                                    [caches[position]], [lengths[position]], settings), timer)[0]
+            continue
+        #Write out each file's features
+        for row, (position, digest, _) in enumerate(group):
+            #Store channels first, as the model expects them
+            #Copied, the buffer is overwritten by the next batch. Runs that only write pngs don't need it
+            features = None
+            if settings["keep_features"]:
+                features = np.array(batch[row].transpose(2, 0, 1), dtype=np.float32)
+            results[position] = _save_features(digest, batch[row], features, image_paths[position], settings["keep_features"], timer)
+    return results
+
+def _save_features(digest, features, stored_features, image_path, keep_features, timer):
+    """Writes the png for a converted file and builds its _convert_csv_task result
+    Keyword arguments:
+    digest -- content hash of the csv file
+    features -- array of shape (height, width, channels) to encode
+    stored_features -- what to hand back for the shards, an array or the path of a temporary .npy file
+    image_path -- path to write the png to, or None to skip it
+    keep_features -- whether to hand stored_features back
+    timer -- metrics.StageTimer to add the time spent encoding to"""
+    try:
+        if image_path is not None:
+            with timer.time("encode"):
+                save_image(features, image_path)
+    except Exception as err:
+        keep_features = False
+        result = (None, None, str(err))
+    else:
+        result = (digest, stored_features if keep_features else None, None)
+    #Temporary files that aren't handed back are no longer needed
+    if isinstance(stored_features, str) and not keep_features:
+        os.remove(stored_features)
+    return result
+
+def convert_all_csv(project_path, jobs=None, stream=None, cancel=None, progress=None):
     """Iterates over the training files set and generates corresponding images
     using the feature extraction method
+    Only images whose csv file or transform parameters changed since the last run are regenerated.
+    Features are written as png images, as memory-mappable .npy shards under project/tensors, or both,
+    depending on the output setting in transform.conf.
+    Files are padded, truncated or resampled to the lengths the length_policy setting picks, see length_targets.
     Keyword arguments:
-    method -- Method used by extract_features to generate image data. Default: fft"""
+    project_path -- path to a timechange project
+    jobs -- number of processes to convert files with. Read from transform.conf if None.
+            Values less than 1 use one process per cpu
+    stream -- dataset.StreamDataset to offer the features to as they are made, or None
+    cancel -- threading.Event that stops the run early when set. Files that weren't converted are retried next run
+    progress -- metrics.Metrics to add stage times and counts to and send progress events with, or None
+    Returns a dict mapping the path of every csv file that failed to convert to its error message"""
+    if progress is None:
+        progress = metrics.Metrics("transform")
+    stage_start = time.perf_counter()
     # Extract parameters from project path
     transform_config = ConfigParser()
     transform_config.read(path.join(project_path, "transform.conf"))
@@ -27,71 +481,490 @@ def convert_all_csv(project_path):
     #Default to reading all columns if this fails 
     if columns == [""]:
         columns = None
+    #Modules that register more transformations
+    plugins = [plugin for plugin in transform_config["DEFAULT"].get("plugins", "").replace(" ", "").split(",") if plugin]
+    transform.load_plugins(plugins)
     #Type of transformation to apply 
     method = transform_config["DEFAULT"].get("method", "fft").strip("\"").strip("\'")
     #Size of chunks
     chunk_size = int(transform_config["DEFAULT"].get("chunk_size", "64").strip("\"").strip("\'"))
     #Size of fft output
     fft_size = int(transform_config["DEFAULT"].get("fft_size", "128").strip("\"").strip("\'"))
-    #Clear subfolders in image folder without deleting images folder
-    #This is to make sure old images don't stick around
-    #In case a file has been removed
-    for label in os.scandir(path.join(project_path, "images")):
-        #Delete the folder
-        try:
-            shutil.rmtree(label.path)
-        except FileNotFoundError as _:
-            #Do nothing
-            pass
-    #Get length of longest csv file
-    max_length = -1
+    #Float type to compute features in
+    dtype = transform_config["DEFAULT"].get("dtype", "float32").strip("\"").strip("\'")
+    if dtype not in ("float32", "float64"):
+        raise Exception("Invalid dtype. Please use float32 or float64")
+    #Formats to write the features in
+    output = sorted(set(transform_config["DEFAULT"].get("output", "png").strip("\"").strip("\'").replace(" ", "").split(",")))
+    if not output or not set(output) <= {"png", "npy"}:
+        raise Exception("Invalid output format. Please use png, npy or both")
+    write_png = "png" in output
+    write_npy = "npy" in output
+    #Number of files to transform per vectorized call
+    batch_size = max(1, int(transform_config["DEFAULT"].get("batch_size", "32").strip("\"").strip("\'")))
+    #Files are streamed instead of read at once if they have to be padded to more rows than this. 0 never streams
+    stream_rows = int(transform_config["DEFAULT"].get("stream_rows", "1000000").strip("\"").strip("\'"))
+    #How files of different lengths are brought to the lengths they are transformed at
+    length_settings = length_config(transform_config)
+    length_policy = length_settings["length_policy"]
+    #Number of processes to use
+    if jobs is None:
+        jobs = int(transform_config["DEFAULT"].get("jobs", "1").strip("\"").strip("\'"))
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    #Parameters that change the generated images
+    parameters = {"columns": columns, "method": method, "chunk_size": chunk_size, "fft_size": fft_size,
+                  "dtype": dtype, "output": output}
+    #Settings of the method that aren't read above
+    parameters.update((name, value) for name, value in method_config(transform_config, method).items()
+                      if name not in parameters)
+    if plugins:
+        parameters["plugins"] = plugins
+    #The default policy isn't recorded, so projects transformed before there were policies stay current
+    if length_policy != "max":
+        parameters.update(length_settings)
+    #Keyword arguments for transform.extract_batch
+    options = extract_options(parameters)
+    #Make the transform now, so invalid settings are reported before any file is converted
+    transformer = transform.get_transform(method, **options)
+    #Get the length of every csv file
+    #Row counts are looked up in the project index, which is filled in by add_training_file
+    files = index.load_index(project_path)["files"]
+    progress.add_time("config", time.perf_counter() - stage_start)
+    stage_start = time.perf_counter()
+    #Stores entries for files missing from the index or changed since they were indexed
+    stale = {}
+    #Stores (label name, csv file, stat result, cache, rows) for every csv file
+    csv_files = []
     #Iterate over labels
     for label in os.scandir(path.join(project_path, "csv")):
         #Iterate over a label's csv files
         for csv_file in os.scandir(label.path):
-            with open(csv_file.path, 'r') as csv_file_handle:
-                #Get number of lines in file and keep track of longest file
-                max_length = max(max_length, len(csv_file_handle.readlines()) - 1)
-    #Generate new images
-    #Iterate over labels
-    for label in os.scandir(path.join(project_path, "csv")):
-        #Make a folder for the label
-        os.mkdir(path.join(project_path, "images", label.name))
-        #Iterate over a label's csv files
-        for csv_file in os.scandir(label.path):
-            # Read the csv into a numpy array
-            data = pandas.read_csv(csv_file.path, usecols=columns).as_matrix().T
-            # Pad the csv
-            data = np.pad(data, ((0,0), (0, max_length - data.shape[1])), 'constant', constant_values=0.0)
-            # Extract features from the numpy array
-            # Uses same variable name since data is not needed after feature extraction
-            data = transform.extract(data, method, chunk_size=chunk_size, fft_size=fft_size)
-            # TODO: normalize and imageize here
-            # TODO: Don't imagize at all
-            # Generate an image from the resulting feature representation
-            img = Image.fromarray((data * 255).astype(np.uint8), "RGB")
-            # Save the image to the desired file path
+            stat = csv_file.stat()
+            info = files.get(label.name, {}).get(csv_file.name)
+            if info is None or not index.is_current(info, stat):
+                #A cache of an older version of the file can't be used
+                if info is not None and info.get("cached"):
+                    try:
+                        os.remove(index.cache_path(project_path, label.name, csv_file.name))
+                    except FileNotFoundError as _:
+                        pass
+                #Count the rows directly
+                info = index.file_info(csv_file.path)
+                stale.setdefault(label.name, {})[csv_file.name] = info
+            #Use the columnar cache if it was made from this version of the file
+            cache = None
+            if info.get("cached"):
+                cache = (index.cache_path(project_path, label.name, csv_file.name), info["columns"])
+            csv_files.append((label.name, csv_file, stat, cache, info["rows"]))
+    #Store the counts so the next run doesn't need them
+    if stale:
+        index.update_index(project_path, added=stale)
+    #Convert in a fixed order so shards are laid out the same way every run
+    csv_files.sort(key=lambda entry: (entry[0], entry[1].name))
+    #Pick the lengths to bring the files to
+    targets = length_targets([entry[4] for entry in csv_files], **length_settings)
+    #Short files are padded further if their features would be too small for the model
+    if targets:
+        num_channels = count_columns(csv_files[0][1].path, columns, csv_files[0][3])
+        if num_channels:
+            targets = fit_targets(targets, transformer, num_channels, min_input_size(project_path))
+    #Load the record of the last run
+    manifest = index.load_manifest(project_path)
+    if manifest is None:
+        #Clear subfolders in image folder without deleting images folder
+        #There is no record of which images are current, so none of them can be kept
+        for label in os.scandir(path.join(project_path, "images")):
+            #Delete the folder
+            try:
+                shutil.rmtree(label.path)
+            except FileNotFoundError as _:
+                #Do nothing
+                pass
+        manifest = {"files": {}}
+    #Images can only be kept if they were generated the same way
+    #Manifests from before there were length policies only record the longest length
+    reuse = (manifest.get("parameters") == parameters
+             and manifest.get("lengths", [manifest.get("max_length")]) == targets)
+    #Shard rows of the last run, mapping (label, bucket) -> csv filename -> row
+    old_rows = {}
+    #Maps bucket -> shape of the features in its shards, for the last run
+    old_shapes = {}
+    if reuse and manifest.get("tensors") is not None:
+        for bucket, shape, labels in dataset.tensor_buckets(manifest["tensors"]):
+            old_shapes[bucket] = shape
+            for label_name, rows in labels.items():
+                old_rows[(label_name, bucket)] = rows
+    #Entries left in here after the scan belong to removed csv files
+    old_files = manifest["files"]
+    #Manifest entries for this run
+    new_files = {}
+    #Maps (label name, csv file name) -> bucket for every unchanged file
+    kept_buckets = {}
+    #Build the list of files to convert
+    #Stores (label name, csv file name, stat result, csv path, image path, cache, length, bucket) for every file to convert
+    conversions = []
+    for label_name, csv_file, stat, cache, rows in csv_files:
+        length = target_length(rows, targets)
+        #Shards are only split by length if files are bucketed
+        bucket = length if length_policy == "bucket" else None
+        old_entry = old_files.get(label_name, {}).pop(csv_file.name, None)
+        if (reuse and old_entry is not None and old_entry["size"] == stat.st_size
+                and (not write_npy or csv_file.name in old_rows.get((label_name, bucket), {}))):
+            #Unchanged file
+            if old_entry["mtime"] == stat.st_mtime_ns:
+                new_files.setdefault(label_name, {})[csv_file.name] = old_entry
+                kept_buckets[(label_name, csv_file.name)] = bucket
+                continue
+            #Touched but with the same contents
+            if old_entry["hash"] == index.hash_file(csv_file.path):
+                new_files.setdefault(label_name, {})[csv_file.name] = dict(old_entry, mtime=stat.st_mtime_ns)
+                kept_buckets[(label_name, csv_file.name)] = bucket
+                continue
+        image_path = None
+        if write_png:
+            #Make a folder for the label
+            os.makedirs(path.join(project_path, "images", label_name), exist_ok=True)
             # project/csv/example/1.csv becomes
             # project/images/example/1.png
-            img.save(path.join(project_path, "images", label.name, "{}.png".format(path.splitext(csv_file.name)[0])))
-def build_model(project_path):
+            image_path = path.join(project_path, "images", label_name, "{}.png".format(path.splitext(csv_file.name)[0]))
+        conversions.append((label_name, csv_file.name, stat, csv_file.path, image_path, cache, length, bucket))
+    progress.add_time("scan", time.perf_counter() - stage_start)
+    progress.count("reused", len(csv_files) - len(conversions))
+    progress.emit(force=True, total=len(conversions))
+    stage_start = time.perf_counter()
+    #Names of the labels in the project
+    label_names = sorted(set(entry[0] for entry in csv_files))
+    #Delete images of removed csv files
+    for label_name, entries in old_files.items():
+        for csv_file_name in entries:
+            try:
+                os.remove(path.join(project_path, "images", label_name, "{}.png".format(path.splitext(csv_file_name)[0])))
+            except FileNotFoundError as _:
+                pass
+    #Delete image folders of removed labels, or all of them if pngs aren't wanted
+    for label in os.scandir(path.join(project_path, "images")):
+        if not write_png or label.name not in label_names:
+            shutil.rmtree(label.path)
+    #Set up the shards that have to be rewritten. Shards of removed labels and buckets are deleted once they're done
+    #Maps (label, bucket) -> shard writer
+    shard_writers = {}
+    #Maps (label, bucket) -> csv filename -> row, for this run
+    new_rows = {}
+    if write_npy:
+        #Number of files to convert per shard
+        num_tasks = {}
+        for conversion in conversions:
+            num_tasks[(conversion[0], conversion[7])] = num_tasks.get((conversion[0], conversion[7]), 0) + 1
+        #Unchanged files per shard
+        kept_files = {}
+        for (label_name, csv_file_name), bucket in kept_buckets.items():
+            kept_files.setdefault((label_name, bucket), []).append(csv_file_name)
+        #Every shard of a bucket stores features of one shape. Buckets with unchanged files keep their shape,
+        #others take the shape most of their files have. Files with another shape, such as files
+        #with extra columns, fail when they're written instead of breaking the whole run
+        bucket_shapes = {bucket: old_shapes[bucket] for _, bucket in kept_files}
+        #Maps (bucket, shape) -> number of files to convert with features of that shape
+        votes = {}
+        for conversion in conversions:
+            if conversion[7] in bucket_shapes:
+                continue
+            num_channels = count_columns(conversion[3], columns, conversion[5])
+            if num_channels is not None:
+                shape = (1,) + tuple(transformer.output_shape((num_channels, conversion[6])))
+                votes[(conversion[7], shape)] = votes.get((conversion[7], shape), 0) + 1
+        for (bucket, shape), _ in sorted(votes.items(), key=lambda vote: vote[1]):
+            bucket_shapes[bucket] = shape
+        for shard in set(num_tasks) | set(kept_files):
+            label_name, bucket = shard
+            kept = kept_files.get(shard, [])
+            #Keep shards that still hold exactly the right files
+            if shard in old_rows and shard not in num_tasks and set(kept) == set(old_rows[shard]):
+                new_rows[shard] = old_rows[shard]
+                continue
+            shard_writers[shard] = dataset.ShardWriter(project_path, label_name, len(kept) + num_tasks.get(shard, 0), bucket,
+                                                       bucket_shapes.get(bucket))
+            #Copy kept features out of the old shard
+            if kept:
+                old_shard = np.load(dataset.shard_path(project_path, label_name, bucket), mmap_mode="r")
+                for csv_file_name in kept:
+                    shard_writers[shard].write(csv_file_name, old_shard[old_rows[shard][csv_file_name]])
+                del old_shard
+    progress.add_time("prepare", time.perf_counter() - stage_start)
+    #Tell the stream what the finished data set holds
+    if stream is not None:
+        #Alternate between labels so the first samples training sees cover every class
+        label_conversions = {}
+        for conversion in conversions:
+            label_conversions.setdefault(conversion[0], []).append(conversion)
+        conversions = [conversion for group in zip_longest(*label_conversions.values()) for conversion in group
+                       if conversion is not None]
+        #Features of files in different length buckets can differ in size
+        shapes = [(1,) + tuple(transformer.output_shape((1, length))) for length in targets]
+        varying = [axis for axis, size in enumerate(dataset.combine_shapes(shapes)) if size is None] if shapes else []
+        stream.start(label_names, len(conversions) + sum(len(entries) for entries in new_files.values()), varying)
+        #Kept files are only offered if training has to wait for new ones anyway
+        if conversions:
+            for label_name, entries in sorted(new_files.items()):
+                for csv_file_name in entries:
+                    bucket = kept_buckets[(label_name, csv_file_name)]
+                    stream.offer(label_name, partial(_load_features, project_path, label_name, csv_file_name,
+                                                     old_rows.get((label_name, bucket)) if write_npy else None, bucket))
+    else:
+        #Put files of the same length next to each other, so batches can stack them
+        conversions.sort(key=lambda conversion: conversion[6])
+    #Settings shared by every batch
+    settings = {"keep_features": write_npy or stream is not None, "length_policy": length_policy, "columns": columns,
+                "method": method, "options": options, "plugins": plugins, "temp_folder": path.join(project_path, "tmp"),
+                #Only the fft method can stream, and resampled files are read whole
+                "stream_rows": stream_rows if method == "fft" and length_policy != "resample" else 0}
+    #Split the files into batches
+    #Batches are kept small enough that padding their files doesn't run out of memory
+    tasks = []
+    def add_task(batch):
+        tasks.append(([conversion[3] for conversion in batch], [conversion[4] for conversion in batch],
+                      [conversion[5] for conversion in batch], [conversion[6] for conversion in batch], settings))
+    batch = []
+    longest = 0
+    for conversion in conversions:
+        longest = max(longest, conversion[6])
+        if batch and len(batch) >= max(1, min(batch_size, BATCH_SAMPLES // max(1, longest))):
+            add_task(batch)
+            batch = []
+            longest = conversion[6]
+        batch.append(conversion)
+    if batch:
+        add_task(batch)
+    #Generate new images
+    stage_start = time.perf_counter()
+    if jobs == 1 or len(tasks) <= 1:
+        #Convert in this thread
+        results = map(_convert_csv_task, tasks)
+        failures = _record_results(conversions, _merge_stats(results, progress, cancel), new_files, shard_writers,
+                                   stream, progress)
+    else:
+        #Fan the batches out to a process pool
+        #Batches are handed out in groups to keep the per-batch overhead low
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(_convert_csv_task, tasks, chunksize=max(1, len(tasks) // (jobs * 16)))
+            #Batches that haven't started are dropped on cancel, the ones already running are still recorded
+            stop = partial(executor.shutdown, wait=False, cancel_futures=True)
+            failures = _record_results(conversions, _merge_stats(results, progress, cancel, stop), new_files,
+                                       shard_writers, stream, progress)
+    progress.add_time("convert", time.perf_counter() - stage_start)
+    stage_start = time.perf_counter()
+    #Finish the shards
+    tensors = None
+    #Paths of the shards this run stores features in
+    shard_paths = set()
+    if write_npy:
+        for shard, shard_writer in shard_writers.items():
+            new_rows[shard] = shard_writer.close()
+        #Every shard of a bucket stores samples of the same shape
+        #Maps bucket -> manifest entry
+        buckets = {}
+        for (label_name, bucket), rows in new_rows.items():
+            if rows:
+                shard_paths.add(dataset.shard_path(project_path, label_name, bucket))
+                if bucket not in buckets:
+                    shard_shape = np.load(dataset.shard_path(project_path, label_name, bucket), mmap_mode="r").shape[1:]
+                    buckets[bucket] = {"length": bucket, "shape": list(shard_shape), "labels": {}}
+                buckets[bucket]["labels"][label_name] = rows
+        if length_policy == "bucket" and buckets:
+            tensors = {"buckets": [buckets[bucket] for bucket in sorted(buckets)]}
+        elif buckets:
+            tensors = {"shape": buckets[None]["shape"], "labels": buckets[None]["labels"]}
+    #Delete shards of removed labels and buckets, or all of them if npy output isn't wanted
+    tensor_folder = path.join(project_path, dataset.TENSOR_FOLDER)
+    for folder, _, file_names in os.walk(tensor_folder, topdown=False):
+        for file_name in file_names:
+            if path.join(folder, file_name) not in shard_paths:
+                os.remove(path.join(folder, file_name))
+        if folder != tensor_folder and not os.listdir(folder):
+            os.rmdir(folder)
+    #Free the conversion buffers of this thread
+    _buffers.__dict__.clear()
+    #Remove the folder for temporary files if streaming left it behind
+    try:
+        os.rmdir(settings["temp_folder"])
+    except OSError as _:
+        pass
+    #Save the record of this run. Failed files are left out so they are retried
+    index.save_manifest(project_path, {"parameters": parameters,
+                                       "lengths": targets,
+                                       "max_length": targets[-1] if targets else -1,
+                                       "files": new_files,
+                                       "tensors": tensors})
+    progress.add_time("finish", time.perf_counter() - stage_start)
+    return failures
+
+def _merge_stats(task_results, progress, cancel=None, stop=None):
+    """Unpacks _convert_csv_task results, adding the time spent on each stage to progress
+    Once cancel is set, every batch that has already finished or started is still unpacked, so none of
+    the work done is lost
+    Keyword arguments:
+    task_results -- iterable of _convert_csv_task results. Batches that were dropped raise CancelledError
+    progress -- metrics.Metrics to add stage times and counts to
+    cancel -- threading.Event that stops the run when set, or None
+    stop -- function that drops the batches that haven't started, or None if task_results
+            only runs a batch once it is asked for the next result
+    Yields the result of every file"""
+    task_results = iter(task_results)
+    stopped = False
+    while True:
+        try:
+            results, stats = next(task_results)
+        except (StopIteration, CancelledError) as _:
+            return
+        progress.merge(stats)
+        progress.count("batches")
+        yield from results
+        if cancel is not None and cancel.is_set() and not stopped:
+            if stop is None:
+                return
+            #Keep unpacking the batches that were running
+            stop()
+            stopped = True
+
+def _record_results(conversions, results, new_files, shard_writers, stream=None, progress=None):
+    """Stores the results of conversions as they arrive
+    Keyword arguments:
+    conversions -- (label name, csv file name, stat result, csv path, image path, cache, length, bucket) for every converted file
+    results -- iterable of per-file _convert_csv_task results, in conversion order
+    new_files -- manifest entries to add successful files to
+    shard_writers -- dict mapping (label, bucket) -> ShardWriter to write features to
+    stream -- dataset.StreamDataset to offer features to, or None
+    progress -- metrics.Metrics to add write times and file counts to and send progress events with, or None
+    Returns a dict mapping the path of every csv file that failed to convert to its error message"""
+    if progress is None:
+        progress = metrics.Metrics("transform")
+    failures = {}
+    for (label_name, csv_file_name, stat, csv_path, image_path, _, _, bucket), (digest, features, error) in zip(conversions, results):
+        shard = (label_name, bucket)
+        stage_start = time.perf_counter()
+        if error is None and features is not None:
+            #Features of a streamed file are stored in a temporary file
+            streamed = isinstance(features, str)
+            stored_features = np.load(features, mmap_mode="r") if streamed else features
+            try:
+                if shard in shard_writers:
+                    shard_writers[shard].write(csv_file_name, stored_features)
+            except Exception as err:
+                #Features that don't fit the shard, such as those of a file with extra columns
+                error = str(err)
+            else:
+                if stream is not None:
+                    stream.offer(label_name, partial(np.array if streamed else np.asarray, stored_features))
+            del stored_features
+            if streamed:
+                os.remove(features)
+        if error is None:
+            progress.count("files")
+            new_files.setdefault(label_name, {})[csv_file_name] = {"size": stat.st_size,
+                                                                   "mtime": stat.st_mtime_ns,
+                                                                   "hash": digest}
+        else:
+            progress.count("failures")
+            failures[csv_path] = error
+            #Don't leave an outdated image behind
+            if image_path is not None:
+                try:
+                    os.remove(image_path)
+                except FileNotFoundError as _:
+                    pass
+        progress.add_time("write", time.perf_counter() - stage_start)
+        progress.emit(total=len(conversions))
+    return failures
+
+def _load_features(project_path, label_name, csv_file_name, rows=None, bucket=None):
+    """Loads the features of an already transformed csv file
+    Keyword arguments:
+    project_path -- path to a timechange project
+    label_name -- label of the csv file
+    csv_file_name -- name of the csv file
+    rows -- dict mapping csv filename -> row of the label's feature shard, or None to read the png instead
+    bucket -- length bucket of the shard, see dataset.shard_path
+    Returns a float array of shape (1, height, width)"""
+    if rows is not None:
+        return np.array(np.load(dataset.shard_path(project_path, label_name, bucket), mmap_mode="r")[rows[csv_file_name]])
+    #Load PIL only when images are read
+    from PIL import Image
+    image_path = path.join(project_path, "images", label_name, "{}.png".format(path.splitext(csv_file_name)[0]))
+    #Every channel of the image holds the same values
+    with Image.open(image_path) as img:
+        return np.asarray(img.convert("L"), dtype=np.float32)[np.newaxis] / 255
+
+def get_data_shape(project_path):
+    """Finds the number of classes and the model input shape of a project's transformed data
+    Feature shards are used if the project has them, otherwise the png images are
+    Keyword arguments:
+    project_path -- path to a timechange project
+    Returns a tuple of (number of classes, (channels, height, width)). Sizes that differ between
+    length buckets are None"""
+    manifest = index.load_manifest(project_path)
+    if manifest is not None and manifest.get("tensors") is not None:
+        buckets = dataset.tensor_buckets(manifest["tensors"])
+        num_classes = len(set(label for _, _, labels in buckets for label in labels))
+        #Shards store a single channel, which is copied into all three when batches are made
+        return num_classes, (3,) + dataset.combine_shapes(shape for _, shape, _ in buckets)[1:]
+    # Extract parameters from project folder
+    image_folder = path.join(project_path, "images")
+    # Extract number of classes from project by finding image folders
+    num_classes = len(list(os.scandir(image_folder)))
+    # Extract height and width of image
+    from PIL import Image
+    if manifest is not None and len(manifest.get("lengths", [])) > 1:
+        #Images of different length buckets can differ in size, so every image has to be looked at
+        sizes = set()
+        for label in os.scandir(image_folder):
+            for image_file in os.scandir(label.path):
+                with Image.open(image_file.path) as img:
+                    sizes.add(img.size)
+        image_width, image_height = dataset.combine_shapes(sizes)
+        return num_classes, (3, image_height, image_width)
+    image_width, image_height = Image.open(os.scandir(os.scandir(image_folder).__next__().path).__next__().path).size
+    return num_classes, (3, image_height, image_width)
+
+def min_input_size(project_path):
+    """Finds the smallest height and width of features the model in parameters.conf can take
+    Every block of a convolutional_basic model shrinks its input by a 3x3 convolution and halves it by pooling
+    Keyword arguments:
+    project_path -- path to a timechange project
+    Returns the smallest size, in pixels"""
+    config = ConfigParser()
+    config.read(path.join(project_path, 'parameters.conf'))
+    model_type = config['DEFAULT'].get('model_type', 'convolutional_basic').strip('\"').strip('\'')
+    if model_type != 'convolutional_basic' or 'convolutional_basic' not in config:
+        return 1
+    num_blocks = int(config['convolutional_basic'].get('num_blocks', 3))
+    #The last block needs at least 3 pixels to convolve, and each block before it needs twice what the next one does
+    return 3 * 2 ** max(0, num_blocks - 1)
+
+def build_model(project_path, data_shape=None, progress=None):
     """Generates a compiled keras model for use in timechange training
     Parameters: 
-    project_path -- path to a timechange project"""
+    project_path -- path to a timechange project
+    data_shape -- tuple of (number of classes, input shape) to build for. Read with get_data_shape if None
+    progress -- metrics.Metrics to add stage times to, or None"""
+    if progress is None:
+        progress = metrics.Metrics("build_model")
+    stage_start = time.perf_counter()
     #Load keras
     from keras.models import Sequential
     from keras.layers import Convolution2D, ZeroPadding2D, MaxPooling2D
-    from keras.layers import Input, Dense, Flatten, Dropout
+    from keras.layers import Input, Dense, Flatten, Dropout, GlobalMaxPooling2D
     from keras.optimizers import SGD
     #Set dimension ordering
     from keras.backend import common as K
     K.set_image_dim_ordering('th')
-    # Extract parameters from project folder
-    image_folder = path.join(project_path, "images")
-    # Extract number of classes from project by finding image folders
-    num_classes = len(list(os.scandir(image_folder)))
-    # Extract height and width of image
-    image_height, image_width = Image.open(os.scandir(os.scandir(image_folder).__next__().path).__next__().path).size
+    progress.add_time("import", time.perf_counter() - stage_start)
+    stage_start = time.perf_counter()
+    # Extract number of classes and input shape from the transformed data
+    if data_shape is None:
+        data_shape = get_data_shape(project_path)
+    num_classes, input_shape = data_shape
+    progress.add_time("shape", time.perf_counter() - stage_start)
+    stage_start = time.perf_counter()
     # Extract configuration
     config = ConfigParser()
     config.read(path.join(project_path,'parameters.conf'))
@@ -125,7 +998,7 @@ def build_model(project_path):
         #Add the initial blocks
         model.add(Convolution2D(num_filters[0], 3, 3,
                                 activation='relu',
-                                input_shape=(3, image_height, image_width),
+                                input_shape=input_shape,
                                 dim_ordering='th'))
         model.add(ZeroPadding2D((1, 1)))
         model.add(MaxPooling2D(pool_size=(2,2), dim_ordering='th'))
@@ -139,54 +1012,154 @@ def build_model(project_path):
             model.add(MaxPooling2D(pool_size=(2,2),
                                    dim_ordering='th'))
         #Create the final layers
-        model.add(Flatten())
+        if None in input_shape:
+            #Inputs of different length buckets differ in size, so pool each feature map to a single value
+            model.add(GlobalMaxPooling2D(dim_ordering='th'))
+        else:
+            model.add(Flatten())
         #TODO: Allow configuring the parameters and existence of these
         model.add(Dense(64, activation='relu'))
         model.add(Dropout(0.3))
         model.add(Dense(num_classes, activation=final_activation))
     else:
         raise Exception("Invalid neural net type")
+    progress.add_time("build", time.perf_counter() - stage_start)
+    stage_start = time.perf_counter()
     #Compile the model
     optimizer = SGD(lr=learning_rate)
     #Compile the model
     model.compile(loss=loss_measure,
                   optimizer=optimizer,
                   metrics=['accuracy'])
+    progress.add_time("compile", time.perf_counter() - stage_start)
     #Output the model
     return model
 
-def train(project_path, model, output_queue):
+def method_config(transform_config, method):
+    """Reads the settings of a transform method from a loaded transform.conf
+    raises Exception if the method isn't registered
+    Keyword arguments:
+    transform_config -- ConfigParser holding transform.conf
+    method -- transform method, see transform.TRANSFORMS
+    Returns a dict of the method's settings, see transform.Transform.read_settings"""
+    if method not in transform.TRANSFORMS:
+        raise Exception("Invalid feature extraction method")
+    return transform.TRANSFORMS[method].read_settings(transform_config["DEFAULT"])
+
+def extract_options(parameters):
+    """Builds the keyword arguments for transform.extract_batch from transform parameters
+    Plugins listed in the parameters have to be loaded first, see transform.load_plugins
+    raises Exception if the method isn't registered
+    Keyword arguments:
+    parameters -- parameters dict, as stored in the transform manifest
+    Returns a dict of keyword arguments"""
+    if parameters["method"] not in transform.TRANSFORMS:
+        raise Exception("Invalid feature extraction method")
+    options = {"dtype": parameters.get("dtype", "float64")}
+    for name in transform.TRANSFORMS[parameters["method"]].settings:
+        if name in parameters:
+            options[name] = parameters[name]
+    return options
+
+def training_config(project_path):
+    """Reads the training settings from parameters.conf
+    Keyword arguments:
+    project_path -- path to a timechange project
+    Returns a dict with batch_size, num_epochs, seed (None to shuffle differently every time)
+    and prefetch, the number of batches to make ahead of time (0 to make them as they're needed)"""
+    config = ConfigParser()
+    config.read(path.join(project_path, "parameters.conf"))
+    seed = config["DEFAULT"].get("shuffle_seed", "").strip("\"").strip("\'")
+    return {"batch_size": max(1, int(config["DEFAULT"].get("batch_size", "64").strip("\"").strip("\'"))),
+            "num_epochs": max(1, int(config["DEFAULT"].get("num_epochs", "20").strip("\"").strip("\'"))),
+            "seed": int(seed) if seed else None,
+            "prefetch": max(0, int(config["DEFAULT"].get("prefetch", "4").strip("\"").strip("\'")))}
+
+def _training_data(project_path):
+    """Loads the project's transformed data for training
+    Feature shards are memory-mapped if the project has them, otherwise the png images are decoded into memory
+    Keyword arguments:
+    project_path -- path to a timechange project
+    Returns a dataset.Dataset"""
+    manifest = index.load_manifest(project_path)
+    if manifest is not None and manifest.get("tensors") is not None:
+        return dataset.TensorDataset(project_path)
+    return dataset.ImageDataset(project_path)
+
+def _training_batches(project_path, batch_size, seed=None):
+    """Creates a generator of training batches from the project's transformed data
+    The data is loaded once and the samples are shuffled every epoch
+    Keyword arguments:
+    project_path -- path to a timechange project
+    batch_size -- number of samples per batch
+    seed -- seed for the shuffle
+    Returns a tuple of (generator, number of samples)"""
+    training_data = _training_data(project_path)
+    return training_data.batches(batch_size, seed=seed), training_data.num_samples
+
+def _stream_batches(project_path, stream, batch_size, min_samples, seed=None):
+    """Generates training batches from a stream until its transform finishes, then from the full data set
+    Keyword arguments:
+    project_path -- path to a timechange project
+    stream -- dataset.StreamDataset being filled by a transform
+    batch_size -- number of samples per batch
+    min_samples -- number of samples the stream should hold before the first batch
+    seed -- seed for the shuffle of the full data set"""
+    yield from stream.batches(batch_size, min_samples)
+    #The transform is finished, so the rest of training sees every sample
+    yield from _training_batches(project_path, batch_size, seed)[0]
+
+def _timed_batches(batches, progress):
+    """Passes batches through, adding the time spent making each one to progress
+    Keyword arguments:
+    batches -- generator of training batches
+    progress -- metrics.Metrics to add load times to"""
+    while True:
+        stage_start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            return
+        progress.add_time("load", time.perf_counter() - stage_start)
+        yield batch
+
+def train(project_path, model, output_queue, stream=None, min_samples=256, cancel=None, progress=None):
     """Trains a neural net model on the project's dataset
     Parameters:
-    project_path -- 
+    project_path -- path to a timechange project
+    model -- compiled keras model to train
+    output_queue -- queue to send messages to the main thread on
+    stream -- dataset.StreamDataset filled by a running transform to start training on, or None
+    min_samples -- number of samples the stream should hold before training starts
+    cancel -- threading.Event that stops training at the end of the current epoch when set, or None
+    progress -- metrics.Metrics to add batch and epoch times to and send progress events with, or None
     """
-    #Load keras
-    from keras.preprocessing.image import ImageDataGenerator
+    if progress is None:
+        progress = metrics.Metrics("train")
     #Set dimension ordering
     from keras.backend import common as K
     K.set_image_dim_ordering('th')
-    #Load the image size
-    image_size = Image.open(os.scandir(os.scandir(path.join(project_path, "images")).__next__().path).__next__().path).size
     #Check to see if a model has been generated
     if model is None:
         raise Exception("There is no model stored. Please generate a model before training")
-    #Determine class mode based on folder structure
-    num_classes = len(list(os.scandir(path.join(project_path, "images"))))
+    config = training_config(project_path)
+    batch_size = config["batch_size"]
+    if stream is not None and stream.wait(min_samples) > 0:
+        #Start on the samples the transform has made so far
+        num_classes = len(stream.labels)
+        train_generator = _stream_batches(project_path, stream, batch_size, min_samples, config["seed"])
+        num_samples = stream.num_samples
+    else:
+        #Determine the number of classes from the transformed data
+        num_classes = get_data_shape(project_path)[0]
+        train_generator = None
     if num_classes == 1:
         raise Exception("The training data only contains one class")
-    else:
-        class_mode = "categorical"
-    #Create a training data generator from the images folder
-    train_generator = ImageDataGenerator(
-            rescale = 1.0/255.0, #Scale the 0-255 pixel values down to 0.0-1.0
-            dim_ordering = 'th' #samples, channels, width, height
-            ).flow_from_directory(
-            path.join(project_path, 'images'), #Read training data from the project's images dir
-            target_size=image_size, #Resize must be set or the generator will automatically choose dimensions
-            color_mode='rgb', #TODO: take another look at this
-            batch_size=64, #TODO: customize this
-            shuffle=True, #Shuffle the data inputs. TODO: set a random seed
-            class_mode=class_mode) #TODO: consider binary mode for systems with only 2 labels
+    if train_generator is None:
+        train_generator, num_samples = _training_batches(project_path, batch_size, config["seed"])
+    if config["prefetch"] > 0:
+        #Make the next batches while the model trains on the current one
+        train_generator = dataset.prefetch(train_generator, config["prefetch"])
     #Design a callback to store training progress
     import keras
     class ProgressBarCallback(keras.callbacks.Callback):
@@ -195,63 +1168,356 @@ def train(project_path, model, output_queue):
         def on_train_end(self, logs={}):
             return
         def on_epoch_begin(self, epoch, logs={}):
+            self.epoch_start = time.perf_counter()
             return
         def on_epoch_end(self, epoch, logs={}):
-            print("Training epoch {} ended".format(epoch))
+            progress.add_time("epoch", time.perf_counter() - self.epoch_start)
+            progress.count("epochs")
+            progress.emit(force=True, epoch=epoch, logs={name: float(value) for name, value in logs.items()})
             return
         def on_batch_begin(self, batch, logs={}):
+            self.batch_start = time.perf_counter()
+            return
+        def on_batch_end(self, batch, logs={}):
+            progress.add_time("batch", time.perf_counter() - self.batch_start)
+            progress.count("batches")
+            progress.count("samples", logs.get("size", 0))
+            progress.emit()
+            #Keras stops at the end of the epoch
+            if cancel is not None and cancel.is_set():
+                self.model.stop_training = True
             return
     #Train the model
     #TODO: k-fold validation
     try:
         return model.fit_generator(
-            train_generator,
-            samples_per_epoch=len(train_generator.filenames), #TODO: better solution
-            nb_epoch=20,
-            callbacks=[ProgressBarCallback()]).history #TODO: customize this
+            _timed_batches(train_generator, progress),
+            samples_per_epoch=num_samples,
+            nb_epoch=config["num_epochs"],
+            callbacks=[ProgressBarCallback()]).history
     except Exception as err:
         #TODO: Handle error better
         raise Exception("Something went wrong with the training process: {}".format(str(err)))
-def worker_thread(project_path, input_queue, output_queue):
-    #Import keras immediately to get it set up
-    import keras
-    try:
-        model = generate_model(project_path)
-    except:
-        model = None
-    while True:
-        job = input_queue.get()
-        #Transform the data
-        if job["command"] == "transform":
-            #Attempt to transform data
-            try:
-                #Run the conversion process
-                convert_all_csv(project_path)
-                #Inform the main thread that transformation is finished
-                output_queue.put({"type":"success", "job":"transform"})
-            except Exception as err:
-                output_queue.put({"type":"error", "job":"transform", "message": str(err)})
-        #Build the keras model
-        elif job["command"] == "build_model":
-            #Attempt to generate the model
-            try:
-                #Build the model
-                model = build_model(project_path)
-                #Inform the main thread that model generated properly
-                output_queue.put({"type":"success", "job":"build_model"})
-            except Exception as err:
-                output_queue.put({"type":"error", "job":"build_model", "message": str(err)})
-        #Train the keras model
-        elif job["command"] == "train":
-            #Attempt to train the model
+
+#Resources each command needs to itself. Jobs sharing a resource run one at a time, in the order they were queued
+#Predictions use the saved weights and a model of their own, so they run alongside transforms and training
+JOB_RESOURCES = {"transform": {"data"},
+                 "build_model": {"data", "model"},
+                 "train": {"data", "model"},
+                 "pipeline": {"data", "model"},
+                 "predict": {"predictor"}}
+
+class Job:
+    """A command queued on or running in a Scheduler"""
+    def __init__(self, job_id, command, priority, order):
+        """Constructor
+        Keyword arguments:
+        job_id -- id the job's messages are tagged with
+        command -- the command dict the job was made from
+        priority -- jobs with a higher priority start first
+        order -- position in the queue, which breaks ties between priorities
+        """
+        self.id = job_id
+        self.command = command
+        self.name = command["command"]
+        self.priority = priority
+        self.order = order
+        self.resources = JOB_RESOURCES[self.name]
+        #Set to ask the job to stop
+        self.cancelled = Event()
+
+class Scheduler:
+    """Runs commands from the main thread as jobs
+    Commands are dicts read from an input queue:
+        {"command": "transform", "jobs": n} -- converts the csv files, see convert_all_csv
+        {"command": "build_model"} -- builds a new model from parameters.conf
+        {"command": "train"} -- trains the model on the transformed data
+        {"command": "pipeline", "jobs": n} -- transforms and trains at the same time. Training starts on the
+            first min_batches batches of features the transform makes, then moves on to the full data set
+            once the transform has finished. Builds a model if there isn't one that fits the data
+        {"command": "predict", "inputs": inputs} -- classifies inputs with the saved model, see predict.Predictor.
+            The result message holds the probabilities of each label and the labels, in order
+        {"command": "cancel", "id": job_id} -- cancels a queued or running job
+        {"command": "shutdown"} -- stops the scheduler once every queued job has finished
+    Every job command can also have an "id" to tag its messages with, a "priority" (default 0) and
+    "profile", which profiles the job and adds the profile to its result message, see profiling.JobProfiler.
+    Jobs with a higher priority start first. Jobs that need the same resources (the transformed data,
+    the model or the predictor) run one at a time, see JOB_RESOURCES. Transform, build_model, train and
+    pipeline jobs all need the transformed data, so they are serialized; a pipeline is the way to transform
+    and train at the same time. Predict jobs run alongside them.
+    Messages put on the output queue have a type (started, success, error or cancelled), the job's
+    name and the job's id. Pipelines send transform and train messages.
+    Running transforms stop after the current batch of files when cancelled, and training stops at the
+    end of the current epoch. While they run, jobs send progress messages with the time spent on each
+    stage, see metrics.Metrics."""
+    def __init__(self, project_path, input_queue, output_queue):
+        """Constructor
+        Keyword arguments:
+        project_path -- path to a timechange project
+        input_queue -- queue to read commands from
+        output_queue -- queue to send messages to the main thread on
+        """
+        self.project_path = project_path
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        #The keras model, once one has been built
+        self.model = None
+        #predict.Predictor used by predict jobs, loaded on first use
+        self.predictor = None
+        #Guards the job lists and wakes up shutdown when jobs finish
+        self.condition = Condition()
+        self.queued = []
+        #Maps job id -> running job
+        self.running = {}
+        #Makes ids for commands without one, and orders the queue
+        self.job_ids = count(1)
+        self.order = count()
+    def run(self):
+        """Reads and handles commands until a shutdown command arrives"""
+        while True:
+            command = self.input_queue.get()
+            if command["command"] == "shutdown":
+                break
+            elif command["command"] == "cancel":
+                self.cancel(command["id"])
+            else:
+                self.submit(command)
+        #Let every queued job finish first
+        with self.condition:
+            self.condition.wait_for(lambda: not self.queued and not self.running)
+    def submit(self, command):
+        """Queues a job command
+        Keyword arguments:
+        command -- command dict
+        Returns the job's id"""
+        job_id = command.get("id")
+        if job_id is None:
+            job_id = "job-{}".format(next(self.job_ids))
+        if command["command"] not in JOB_RESOURCES:
+            self.output_queue.put({"type":"error", "job":command["command"], "id":job_id,
+                                   "message":"Unknown command {}".format(command["command"])})
+            return job_id
+        with self.condition:
+            self.queued.append(Job(job_id, command, command.get("priority", 0), next(self.order)))
+            self._start_jobs()
+        return job_id
+    def cancel(self, job_id):
+        """Cancels a job. Queued jobs are dropped and running jobs are asked to stop
+        Keyword arguments:
+        job_id -- id of the job to cancel
+        """
+        with self.condition:
+            for job in self.queued:
+                if job.id == job_id:
+                    self.queued.remove(job)
+                    self.output_queue.put({"type":"cancelled", "job":job.name, "id":job_id})
+                    #Jobs waiting behind this one may be able to start
+                    self._start_jobs()
+                    self.condition.notify_all()
+                    return
+            if job_id in self.running:
+                self.running[job_id].cancelled.set()
+                return
+        self.output_queue.put({"type":"error", "job":"cancel", "id":job_id,
+                               "message":"There is no queued or running job with id {}".format(job_id)})
+    def _start_jobs(self):
+        """Starts every queued job that can run now. Must be called with the condition held"""
+        busy = set()
+        for job in self.running.values():
+            busy |= job.resources
+        for job in sorted(self.queued, key=lambda job: (-job.priority, job.order)):
+            if not job.resources & busy:
+                self.queued.remove(job)
+                self.running[job.id] = job
+                Thread(target=self._run_job, name="job {}".format(job.id), args=(job,), daemon=True).start()
+            #Later jobs can't jump ahead of a waiting job that needs the same resources
+            busy |= job.resources
+    def _run_job(self, job):
+        """Runs a job and starts the next ones once it's done
+        Keyword arguments:
+        job -- the job to run
+        """
+        self.output_queue.put({"type":"started", "job":job.name, "id":job.id})
+        try:
+            if job.name == "transform":
+                self._transform(job)
+            elif job.name == "build_model":
+                self._build_model(job)
+            elif job.name == "train":
+                self._train(job)
+            elif job.name == "pipeline":
+                self._pipeline(job)
+            elif job.name == "predict":
+                self._predict(job)
+        finally:
+            with self.condition:
+                del self.running[job.id]
+                self._start_jobs()
+                self.condition.notify_all()
+    def _metrics(self, name, job):
+        """Creates the metrics.Metrics object a job reports progress with
+        Progress events are also appended to the metrics_file set in parameters.conf, if there is one
+        Keyword arguments:
+        name -- name of the job's stage, such as transform
+        job -- the job
+        """
+        config = ConfigParser()
+        config.read(path.join(self.project_path, "parameters.conf"))
+        metrics_file = config["DEFAULT"].get("metrics_file", "").strip("\"").strip("\'")
+        metrics_path = path.join(self.project_path, metrics_file) if metrics_file else None
+        return metrics.Metrics(name, job.id, self.output_queue, metrics_path)
+    def _start_profiler(self, job):
+        """Starts profiling the calling thread if the job's command has "profile" set
+        Keyword arguments:
+        job -- the job
+        Returns the profiling.JobProfiler, or None"""
+        if not job.command.get("profile"):
+            return None
+        profiler = profiling.JobProfiler()
+        profiler.start()
+        return profiler
+    def _report(self, message, profiler=None):
+        """Sends the result message of a job
+        If the job was profiled, the profile is saved first and the message gets a "profile" entry
+        with the paths of the .pstats and collapsed stacks files and the top functions
+        Keyword arguments:
+        message -- message dict
+        profiler -- profiling.JobProfiler started by the job, or None
+        """
+        if profiler is not None:
+            profiler.stop()
             try:
-                #Run training
-                results = train(project_path, model, output_queue)
-                #Save the model's most recent weights
-                model.save_weights(path.join(project_path, "models", "latest.h5"))
-                #Inform the main thread that the model trained properly
-                output_queue.put({"type":"success", "job":"train", "message": results})
+                message["profile"] = profiler.save(self.project_path, "{}-{}".format(message["job"], message["id"]))
             except Exception as err:
-                output_queue.put({"type":"error", "job":"train", "message": str(err)})
-        elif job["command"] == "shutdown":
-            break
+                message["profile"] = {"error": str(err)}
+        self.output_queue.put(message)
+    def _transform(self, job, stream=None):
+        """Runs a transform job
+        Keyword arguments:
+        job -- the job to run
+        stream -- dataset.StreamDataset to hand features to, or None
+        """
+        error = None
+        progress = self._metrics("transform", job)
+        profiler = None
+        #Attempt to transform data
+        try:
+            profiler = self._start_profiler(job)
+            #Run the conversion process
+            failures = convert_all_csv(self.project_path, job.command.get("jobs"), stream, job.cancelled, progress)
+            progress.emit(done=True)
+            #Inform the main thread that transformation is finished
+            if job.cancelled.is_set():
+                self._report({"type":"cancelled", "job":"transform", "id":job.id}, profiler)
+            elif failures:
+                #Report the files that could not be converted
+                message = "{} file(s) failed to transform:\n".format(len(failures))
+                message += "\n".join("{}: {}".format(csv_path, error) for csv_path, error in sorted(failures.items())[:10])
+                self._report({"type":"error", "job":"transform", "id":job.id, "message": message, "failures": failures}, profiler)
+            else:
+                self._report({"type":"success", "job":"transform", "id":job.id}, profiler)
+        except Exception as err:
+            error = str(err)
+            progress.emit(done=True)
+            self._report({"type":"error", "job":"transform", "id":job.id, "message": error}, profiler)
+        finally:
+            if stream is not None:
+                stream.close(error)
+    def _build_model(self, job):
+        """Runs a build_model job
+        Keyword arguments:
+        job -- the job to run
+        """
+        progress = self._metrics("build_model", job)
+        profiler = None
+        #Attempt to generate the model
+        try:
+            profiler = self._start_profiler(job)
+            #Build the model
+            self.model = build_model(self.project_path, progress=progress)
+            progress.emit(done=True)
+            #Inform the main thread that model generated properly
+            self._report({"type":"success", "job":"build_model", "id":job.id}, profiler)
+        except Exception as err:
+            progress.emit(done=True)
+            self._report({"type":"error", "job":"build_model", "id":job.id, "message": str(err)}, profiler)
+    def _train(self, job, stream=None):
+        """Runs a train job
+        Keyword arguments:
+        job -- the job to run
+        stream -- dataset.StreamDataset filled by a running transform to start on, or None
+        """
+        progress = self._metrics("train", job)
+        profiler = None
+        #Attempt to train the model
+        try:
+            profiler = self._start_profiler(job)
+            min_samples = training_config(self.project_path)["batch_size"] * job.command.get("min_batches", 4)
+            if stream is not None:
+                #The model has to fit the data the transform is making
+                if stream.wait(min_samples) > 0:
+                    data_shape = (len(stream.labels), stream.input_shape)
+                else:
+                    #Nothing had to be transformed, so training uses the data that's already there
+                    data_shape = get_data_shape(self.project_path)
+                if (self.model is None or self.model.output_shape[-1] != data_shape[0]
+                        or tuple(self.model.input_shape[1:]) != data_shape[1]):
+                    self.model = build_model(self.project_path, data_shape, progress)
+            #Run training
+            results = train(self.project_path, self.model, self.output_queue, stream, min_samples, job.cancelled, progress)
+            #Save the model's most recent weights
+            with progress.time("save"):
+                self.model.save_weights(path.join(self.project_path, "models", "latest.h5"))
+            progress.emit(done=True)
+            #Inform the main thread that the model trained properly
+            if job.cancelled.is_set():
+                self._report({"type":"cancelled", "job":"train", "id":job.id}, profiler)
+            else:
+                self._report({"type":"success", "job":"train", "id":job.id, "message": results}, profiler)
+        except Exception as err:
+            progress.emit(done=True)
+            self._report({"type":"error", "job":"train", "id":job.id, "message": str(err)}, profiler)
+    def _predict(self, job):
+        """Runs a predict job
+        Keyword arguments:
+        job -- the job to run
+        """
+        #Imported here, as predict imports this module
+        from . import predict
+        progress = self._metrics("predict", job)
+        profiler = None
+        try:
+            profiler = self._start_profiler(job)
+            #Load the model again if training saved new weights
+            if self.predictor is None or not self.predictor.is_current():
+                with progress.time("load"):
+                    self.predictor = predict.Predictor(self.project_path)
+            with progress.time("predict"):
+                probabilities = self.predictor.predict(job.command["inputs"],
+                                                       job.command.get("batch_size", predict.PREDICT_BATCH_SIZE))
+            progress.emit(done=True)
+            self._report({"type":"success", "job":"predict", "id":job.id, "message": probabilities.tolist(),
+                          "labels": self.predictor.labels}, profiler)
+        except Exception as err:
+            progress.emit(done=True)
+            self._report({"type":"error", "job":"predict", "id":job.id, "message": str(err)}, profiler)
+    def _pipeline(self, job):
+        """Runs a pipeline job, transforming on a second thread while training on this one
+        Keyword arguments:
+        job -- the job to run
+        """
+        stream = dataset.StreamDataset()
+        transform_thread = Thread(target=self._transform, name="job {} transform".format(job.id), args=(job, stream), daemon=True)
+        transform_thread.start()
+        self._train(job, stream)
+        transform_thread.join()
+
+def worker_thread(project_path, input_queue, output_queue):
+    """Runs the worker's job scheduler until a shutdown command arrives
+    Keyword arguments:
+    project_path -- path to a timechange project
+    input_queue -- queue to read commands from, see Scheduler
+    output_queue -- queue to send messages to the main thread on
+    """
+    #keras is imported by the jobs that need it, so transforms start without it
+    Scheduler(project_path, input_queue, output_queue).run()